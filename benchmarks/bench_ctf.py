@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+"""
+Measure how the CTF kernels and the image simulation scale with the image size, over-sample, number of CTFs and the
+envelope functions, and check that they still produce the same numbers. It does not need Streamlit.
+The result cache is disabled and the in-memory caches (frequency grids, envelopes, radial bins) are cleared before each run,
+so every run measures the computation from scratch.
+Every run first checks the kernels against the frozen copy of the code before the optimizations (ctf_baseline.py) and the
+optimized paths against straightforward implementations, and reports the differences as MISMATCH lines.
+
+Kernels:
+    ctf1d      CTFSet.ctf1d                          pixels = n x len(s)
+    psf1d      CTFSet.psf1d                          pixels = n x imagesize
+    psfzoom    CTFSet.psf1d_zoom: 512 samples at apix/4 from the imagesize*over_sample CTF samples, pixels = n x 512
+    ctf2d      CTFSet.ctf2d (float64)                pixels = n x (imagesize*over_sample)^2
+    ctf2dzoom  CTFSet.ctf2d_zoom: a 256x256 region at 1/(4*over_sample) of the ctf2d sampling, pixels = n x 256^2
+    radial     compute_radial_profile (histogram) of the 2D CTFs
+    normalize  normalize of an image of the 2D CTF size
+    apply      apply_ctfs: the "CTF Applied" step for n CTFs on one image
+
+Usage:
+    python benchmarks/bench_ctf.py                                # default sweep, print a table
+    python benchmarks/bench_ctf.py --imagesize 256,1024,4096 --over-sample 1,2,6 --n 1,10 --envelopes none,all
+    python benchmarks/bench_ctf.py --json bench.json              # also save the results
+    python benchmarks/bench_ctf.py --baseline bench.json          # exit with status 1 if a case got slower/larger than the baseline
+    python benchmarks/bench_ctf.py --save-reference ref.npz       # save the results of the equivalence cases
+    python benchmarks/bench_ctf.py --reference ref.npz            # exit with status 1 if they differ from the saved results
+"""
+
+import argparse, itertools, json, os, platform, statistics, sys, time, tracemalloc
+
+os.environ["CTF_CACHE_DISABLE"] = "1"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(1, os.path.dirname(os.path.abspath(__file__)))   # ctf_baseline
+
+import numpy as np
+import ctf_core
+from ctf_core import CTF, CTFSet, CTFMemoryError, apply_ctf, apply_ctfs, compute_radial_profile, normalize
+
+kernels = "ctf1d psf1d psfzoom ctf2d ctf2dzoom radial normalize apply".split()
+
+envelope_settings = dict(
+    none = dict(),
+    bfactor = dict(bfactor=50.0),
+    temporal = dict(dE=1.0, dI=1.0, cc=2.7),
+    all = dict(bfactor=50.0, alpha=0.1, dE=1.0, dI=1.0, cc=2.7, dZ=200.0, dXY=2.0),
+)
+
+def make_ctfset(imagesize, over_sample, n, envelopes, dfdiff=0.0):
+    # n CTFs with different defocuses, so that nothing is shared between the members
+    params = dict(envelope_settings[envelopes], imagesize=imagesize, over_sample=over_sample, dfdiff=dfdiff, dfang=30.0)
+    return CTFSet([CTF(defocus=0.5 + 2.5*i/max(1, n-1), **params) for i in range(n)])
+
+def clear_caches():
+    ctf_core.get_frequency_grid_cache().clear()
+    ctf_core.get_envelope_cache().clear()
+    ctf_core.radial_bin_index.cache_clear()
+
+def prepare(kernel, imagesize, over_sample, n, envelopes, apix=1.0):
+    """Returns (func, pixels): func() runs the kernel once, pixels is the number of output values"""
+    ctfset = make_ctfset(imagesize, over_sample, n, envelopes)
+    size = imagesize*over_sample
+    if kernel == "ctf1d":
+        return (lambda: ctfset.ctf1d(apix, 0)), n*len(ctf_core.ctf1d_axis(apix, imagesize, over_sample)[0])
+    if kernel == "psf1d":
+        return (lambda: ctfset.psf1d(apix, 0)), n*imagesize
+    if kernel == "psfzoom":
+        return (lambda: ctfset.psf1d_zoom(apix, 0, window=256*apix/4, samples=512)), n*512
+    if kernel == "ctf2d":
+        return (lambda: ctfset.ctf2d(apix, 0)), n*size*size
+    if kernel == "ctf2dzoom":
+        width = 256/(4*over_sample) / (apix*size)
+        return (lambda: ctfset.ctf2d_zoom(apix, 0, center=(0., 0.3/apix), width=width, samples=256)), n*256*256
+    if kernel == "radial":
+        images = np.stack([ctf for _, _, ctf in ctfset.ctf2d(apix, 0)])
+        return (lambda: compute_radial_profile(images)), images.size
+    if kernel == "normalize":
+        image = np.random.default_rng(0).random((size, size))
+        return (lambda: normalize(image)), image.size
+    if kernel == "apply":
+        image = np.random.default_rng(0).random((size, size))
+        ctfs = [ctf for _, _, ctf in ctfset.ctf2d(apix, 0, layout="rfft")]
+        return (lambda: apply_ctfs(image, ctfs)), n*image.size
+    raise ValueError(f"unknown kernel {kernel}")
+
+def measure(kernel, imagesize, over_sample, n, envelopes, repeat=3):
+    func, pixels = prepare(kernel, imagesize, over_sample, n, envelopes)
+    times = []
+    for _ in range(repeat):
+        clear_caches()
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter()-t0)
+    clear_caches()
+    tracemalloc.start()     # numpy reports its allocations to tracemalloc
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    t = statistics.median(times)
+    return dict(time=t, peak_mb=peak/2**20, pixels=pixels, throughput=pixels/t if t else float("inf"), repeat=repeat)
+
+def case_name(kernel, imagesize, over_sample, n, envelopes):
+    return f"{kernel}/imagesize={imagesize}/over_sample={over_sample}/n={n}/envelopes={envelopes}"
+
+# small cases whose outputs are saved with --save-reference and compared with --reference
+equivalence_cases = [(kernel, imagesize, over_sample, n, envelopes) for kernel in ("ctf1d", "psf1d", "ctf2d", "rotavg", "apply")
+    for imagesize, over_sample in ((64, 1), (65, 1), (128, 3)) for n in (1, 3) for envelopes in ("none", "all")]
+
+def equivalence_outputs(kernel, imagesize, over_sample, n, envelopes, apix=1.0):
+    # astigmatic CTFs, so that the 2D paths are exercised as well
+    ctfset = make_ctfset(imagesize, over_sample, n, envelopes, dfdiff=0.05)
+    if kernel == "ctf1d": return np.stack([ctf for _, _, ctf in ctfset.ctf1d(apix, 0)])
+    if kernel == "psf1d": return np.stack([psf for _, psf in ctfset.psf1d(apix, 0)])
+    if kernel == "ctf2d": return np.stack([ctf for _, _, ctf in ctfset.ctf2d(apix, 0)])
+    if kernel == "rotavg": return np.stack([ctf for _, _, ctf in ctfset.ctf1d_rotavg(apix, 0)])
+    if kernel == "apply":
+        size = imagesize*over_sample
+        image = np.random.default_rng(0).random((size, size))
+        return apply_ctfs(image, [ctf for _, _, ctf in ctfset.ctf2d(apix, 0, layout="rfft")])
+    raise ValueError(f"unknown kernel {kernel}")
+
+def builtin_equivalence(rtol=1e-6, atol=1e-8):
+    """Optimized paths against straightforward implementations. Returns a list of failures"""
+    failures = []
+    for envelopes, dfdiff in itertools.product(("none", "all"), (0.0, 0.05)):
+        ctfset = make_ctfset(128, 2, 2, envelopes, dfdiff=dfdiff)
+        for ctf, (ds, _, ctf2d) in zip(ctfset, ctfset.ctf2d(1.0, 0)):
+            # the 2D CTF (radial lookup table or tiled evaluation) against the formula on the full frequency grid
+            size = ctf.imagesize*ctf.over_sample
+            k = np.arange(size) - size//2
+            sx, sy = np.meshgrid(k*ds, k*ds, indexing='ij')
+            s2 = sx*sx + sy*sy
+            angle = -np.arctan2(sy, sx)     # the convention of FrequencyGrid.theta
+            p = {attr: getattr(ctf, attr) for attr in ctf.get_dict()}
+            defocus = p["defocus"] + p["dfdiff"]/2*np.cos(2*(angle - p["dfang"]*np.pi/180.))
+            expected = ctf_core.ctf_formula(np.sqrt(s2), s2, 0, dict(p, defocus=defocus), defocus_alpha=p["defocus"])
+            if not np.allclose(ctf2d, expected, rtol=rtol, atol=1e-6):
+                failures.append(f"ctf2d envelopes={envelopes} dfdiff={dfdiff}: max difference {np.abs(ctf2d-expected).max():.3g}")
+        # the batched apply_ctfs against apply_ctf of each CTF
+        size = 256
+        image = np.random.default_rng(0).random((size, size))
+        ctfs = [ctf for _, _, ctf in ctfset.ctf2d(1.0, 0, layout="rfft")]
+        expected = np.stack([apply_ctf(image, ctf) for ctf in ctfs])
+        result = apply_ctfs(image, ctfs)
+        if not np.allclose(result, expected, rtol=rtol, atol=atol):
+            failures.append(f"apply envelopes={envelopes} dfdiff={dfdiff}: max difference {np.abs(result-expected).max():.3g}")
+        # the zoom FFT PSFs over the whole image at the pixel size against the inverse FFTs
+        for ctf, (_, expected) in zip(ctfset, ctfset.psf1d(1.0, 0)):
+            _, result = CTF(**dict(ctf.get_dict(), over_sample=1)).psf1d_zoom(1.0, 0, window=ctf.imagesize/2, samples=ctf.imagesize)  # psf1d ignores over_sample
+            if not np.allclose(result, expected, rtol=rtol, atol=atol):
+                failures.append(f"psf1d_zoom envelopes={envelopes} dfdiff={dfdiff}: max difference {np.abs(result-expected).max():.3g}")
+            ds, _, ctf2d = ctf.ctf2d(1.0, 0)
+            expected = np.abs(np.fft.fftshift(np.fft.ifft2(np.fft.ifftshift(ctf2d))))
+            expected /= np.linalg.norm(expected)
+            _, result = ctf.psf2d(1.0, 0, window=ctf2d.shape[0]/2, samples=ctf2d.shape[0])
+            if not np.allclose(result, expected, rtol=rtol, atol=atol):
+                failures.append(f"psf2d envelopes={envelopes} dfdiff={dfdiff}: max difference {np.abs(result-expected).max():.3g}")
+            _, _, result = ctf.ctf2d_zoom(1.0, 0, center=(0., 0.), width=ctf2d.shape[0]*ds, samples=ctf2d.shape[0])
+            if not np.allclose(result, ctf2d, rtol=rtol, atol=1e-4):   # ctf2d may use the radial lookup table (lut_tolerance=1e-4)
+                failures.append(f"ctf2d_zoom envelopes={envelopes} dfdiff={dfdiff}: max difference {np.abs(result-ctf2d).max():.3g}")
+    return failures
+
+def bandlimited_image(size, seed=0):
+    # a random image without the frequencies |k| >= size//2 along either axis: there the baseline 2D CTF samples
+    # -(size//2+1) instead of +size//2 for odd sizes, and the sign of the Nyquist frequency of even sizes is ambiguous
+    image_fft = np.fft.fft2(np.random.default_rng(seed).random((size, size)))
+    edge = np.abs(np.fft.fftfreq(size)*size) >= size//2
+    image_fft[edge, :] = 0
+    image_fft[:, edge] = 0
+    return np.fft.ifft2(image_fft).real
+
+def baseline_equivalence():
+    """The kernels against the frozen pre-optimization implementation in ctf_baseline.py. Returns a list of failures
+    The baseline evaluates the 1D CTFs and PSFs in float32 and the optimized 2D CTFs may use the radial lookup table,
+    hence the absolute tolerances
+    """
+    import ctf_baseline
+    failures = []
+    def check(name, result, expected, atol):
+        if np.shape(result) != np.shape(expected):
+            failures.append(f"{name}: shape {np.shape(result)} instead of {np.shape(expected)} of the baseline")
+        elif not np.allclose(result, expected, rtol=0, atol=atol):
+            failures.append(f"{name}: max difference from the baseline {np.abs(np.asarray(result)-expected).max():.3g}")
+    # odd sizes too: the rfft layout has to put the zero frequency at [0, 0] also without a center pixel
+    for (imagesize, over_sample), envelopes, dfdiff in itertools.product(((64, 1), (65, 1), (33, 3), (128, 3)), ("none", "all"), (0.0, 0.05)):
+        ctfset = make_ctfset(imagesize, over_sample, 3, envelopes, dfdiff=dfdiff)
+        baseline = [ctf_baseline.CTF(**ctf.get_dict()) for ctf in ctfset]
+        for abs, plot_s2 in itertools.product((0, 1, 2), (False, True)):
+            case = f"imagesize={imagesize} over_sample={over_sample} envelopes={envelopes} dfdiff={dfdiff} abs={abs} plot_s2={plot_s2}"
+            for (s, s2, ctf), ref in zip(ctfset.ctf1d(1.0, abs, plot_s2), baseline):
+                s_ref, s2_ref, ctf_ref = ref.ctf1d(1.0, abs, plot_s2)
+                check(f"ctf1d {case}", np.stack([s, s2, ctf]), np.stack([s_ref, s2_ref, ctf_ref]), 1e-4)
+            for (ds, ds2, ctf), ref in zip(ctfset.ctf2d(1.0, abs, plot_s2), baseline):
+                ds_ref, ds2_ref, ctf_ref = ref.ctf2d(1.0, abs, plot_s2)
+                check(f"ctf2d {case}", ctf, ctf_ref, 1e-4)
+                if not np.isclose(ds2 if plot_s2 else ds, ds2_ref if plot_s2 else ds_ref):
+                    failures.append(f"ctf2d {case}: pixel size {ds2 if plot_s2 else ds} instead of {ds2_ref if plot_s2 else ds_ref} of the baseline")
+            if not plot_s2:
+                for (x, psf), ref in zip(ctfset.psf1d(1.0, abs), baseline):
+                    x_ref, psf_ref = ref.psf1d(1.0, abs)
+                    check(f"psf1d {case}", np.stack([x, psf]), np.stack([x_ref, psf_ref]), 1e-5)
+        # "CTF Applied": apply_ctfs on the rfft layout against the full FFT of the image times fftshift of the baseline 2D CTF
+        size = imagesize*over_sample
+        image = bandlimited_image(size)
+        result = apply_ctfs(image, [ctf for _, _, ctf in ctfset.ctf2d(1.0, 0, layout="rfft")])
+        expected = np.stack([np.abs(np.fft.ifft2(np.fft.fft2(image)*np.fft.fftshift(ref.ctf2d(1.0, 0)[2]))) for ref in baseline])
+        check(f"apply imagesize={imagesize} over_sample={over_sample} envelopes={envelopes} dfdiff={dfdiff}", result, expected, 1e-8)
+        _, _, image = baseline[0].ctf2d(1.0, 0)
+        check(f"radial profile imagesize={imagesize} over_sample={over_sample} envelopes={envelopes} dfdiff={dfdiff}",
+            compute_radial_profile(image, method="interpolation"), ctf_baseline.compute_radial_profile(image), 1e-8)
+        check(f"normalize imagesize={imagesize} over_sample={over_sample} envelopes={envelopes} dfdiff={dfdiff}",
+            normalize(image), ctf_baseline.normalize(image), 1e-8)
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description="scaling and equivalence benchmark of the CTF kernels")
+    parser.add_argument("--kernels", default=",".join(kernels), help="comma separated kernels (default: %(default)s)")
+    parser.add_argument("--imagesize", default="256,1024,4096", help="comma separated image sizes (default: %(default)s)")
+    parser.add_argument("--over-sample", default="1,2", help="comma separated over-samples (default: %(default)s)")
+    parser.add_argument("--n", default="1,4", help="comma separated numbers of CTFs (default: %(default)s)")
+    parser.add_argument("--envelopes", default="none,all", help=f"comma separated envelope settings: {','.join(envelope_settings)} (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs per case. The median time is reported (default: %(default)s)")
+    parser.add_argument("--max-pixels", type=float, default=2**26, help="skip the 2D cases with more output pixels than this (default: %(default)d)")
+    parser.add_argument("--json", metavar="FILE", help="save the results to a json file")
+    parser.add_argument("--baseline", metavar="FILE", help="compare with the results saved by --json")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative increase of time/peak memory over the baseline (default: %(default)s)")
+    parser.add_argument("--save-reference", metavar="FILE", help="save the outputs of the equivalence cases to an .npz file")
+    parser.add_argument("--reference", metavar="FILE", help="compare the outputs of the equivalence cases with an .npz file saved by --save-reference")
+    parser.add_argument("--rtol", type=float, default=1e-6, help="relative tolerance of the equivalence checks (default: %(default)s)")
+    parser.add_argument("--atol", type=float, default=1e-8, help="absolute tolerance of the equivalence checks (default: %(default)s)")
+    args = parser.parse_args()
+
+    failures = []
+    if args.save_reference or args.reference:
+        outputs = {case_name(*case): equivalence_outputs(*case) for case in equivalence_cases}
+        if args.save_reference:
+            np.savez_compressed(args.save_reference, **outputs)
+            print(f"{len(outputs)} reference outputs saved to {args.save_reference}")
+        if args.reference:
+            reference = np.load(args.reference)
+            for name, value in outputs.items():
+                if name not in reference.files: continue
+                if reference[name].shape != value.shape or not np.allclose(value, reference[name], rtol=args.rtol, atol=args.atol):
+                    diff = np.abs(value-reference[name]).max() if reference[name].shape == value.shape else "shape"
+                    failures.append(f"{name} differs from the reference: {diff}")
+            print(f"{len(outputs)} outputs compared with {args.reference}")
+    failures += baseline_equivalence()
+    failures += builtin_equivalence(args.rtol, args.atol)
+    for failure in failures: print(f"MISMATCH {failure}")
+
+    results = {}
+    print(f"{'case':62s} {'time (s)':>9s} {'peak (MB)':>10s} {'Mpixels/s':>10s}")
+    for kernel, imagesize, over_sample, n, envelopes in itertools.product(args.kernels.split(","),
+            [int(v) for v in args.imagesize.split(",")], [int(v) for v in args.over_sample.split(",")],
+            [int(v) for v in args.n.split(",")], args.envelopes.split(",")):
+        if kernel not in kernels: parser.error(f"unknown kernel {kernel}. Valid kernels: {','.join(kernels)}")
+        if envelopes not in envelope_settings: parser.error(f"unknown envelopes {envelopes}. Valid settings: {','.join(envelope_settings)}")
+        if kernel == "psf1d" and over_sample>1: continue   # the PSF does not depend on over_sample
+        name = case_name(kernel, imagesize, over_sample, n, envelopes)
+        if kernel not in ("ctf1d", "psf1d", "psfzoom", "ctf2dzoom") and n*(imagesize*over_sample)**2 > args.max_pixels:
+            print(f"{name:62s} skipped: more than --max-pixels")
+            continue
+        try:
+            r = measure(kernel, imagesize, over_sample, n, envelopes, args.repeat)
+        except (CTFMemoryError, MemoryError) as err:
+            print(f"{name:62s} skipped: {err}")
+            continue
+        results[name] = r
+        print(f"{name:62s} {r['time']:9.4f} {r['peak_mb']:10.1f} {r['throughput']/1e6:10.1f}", flush=True)
+
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(dict(python=sys.version, numpy=np.__version__, platform=platform.platform(), cpu_count=os.cpu_count(),
+                memory_budget_mb=ctf_core.get_memory_budget()/2**20, results=results), fp, indent=2)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)["results"]
+        for name, r in results.items():
+            if name not in baseline: continue
+            for metric in ("time", "peak_mb"):
+                if r[metric] > baseline[name][metric]*(1+args.tolerance):
+                    regressions.append(f"{name} {metric}: {baseline[name][metric]:.4g} -> {r[metric]:.4g}")
+        for regression in regressions: print(f"REGRESSION {regression}")
+    if failures or regressions: sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+A frozen copy of the CTF functions of the web app before the optimizations (ctf_simulation.py of the first commit), the
+reference of the baseline equivalence checks of bench_ctf.py. Only the Streamlit cache decorators are removed.
+Do not change it: it is what the optimized ctf_core is compared with
+"""
+
+import numpy as np
+
+class CTF:
+    def __init__(self, voltage=300.0, cs=2.7, ampcontrast=7.0, defocus=0.5, dfdiff=0.0, dfang=0.0, phaseshift=0.0, bfactor=0.0, alpha=0.0, cc=2.7, dE=0.0, dI=0.0, dZ=0.0, dXY=0.0, imagesize=256, over_sample=1):
+        self.voltage = voltage
+        self.cs = cs
+        self.ampcontrast = ampcontrast
+        self.defocus = defocus
+        self.dfdiff = dfdiff
+        self.dfang = dfang
+        self.phaseshift = phaseshift
+        self.bfactor = bfactor
+        self.alpha = alpha
+        self.cc = cc
+        self.dE = dE
+        self.dI = dI
+        self.dZ = dZ
+        self.dXY = dXY
+        self.imagesize = int(imagesize)
+        self.over_sample = int(over_sample)
+    
+    def __str__(self):
+        return str(self.get_dict())
+
+    def __repr__(self):
+        return self.__str__()
+    
+    def get_dict(self):
+        ret = {}
+        ret.update(self.__dict__)
+        return ret
+
+    def ctf1d(self, apix, abs, plot_s2=False, defocus_override=None):
+        defocus_final = defocus_override if defocus_override is not None else self.defocus
+        s_nyquist = 1./(2*apix)
+        if plot_s2:
+            ds2 = s_nyquist*s_nyquist/(self.imagesize//2*self.over_sample)
+            s2 = np.arange(self.imagesize//2*self.over_sample+1, dtype=np.float32)*ds2
+            s = np.sqrt(s2)
+        else:
+            ds = s_nyquist/(self.imagesize//2*self.over_sample)
+            s = np.arange(self.imagesize//2*self.over_sample+1, dtype=np.float32)*ds
+            s2 = s*s
+        wl = 12.2639 / np.sqrt(self.voltage * 1000.0 + 0.97845 * self.voltage * self.voltage)  # Angstrom
+        phaseshift = self.phaseshift * np.pi / 180.0 + np.arcsin(self.ampcontrast/100.)
+        gamma =2*np.pi*(-0.5*defocus_final*1e4*wl*s2 + .25*self.cs*1e7*wl**3*s2**2) - phaseshift
+        
+        from scipy.special import j0, sinc
+        env = np.ones_like(gamma)
+        if self.bfactor: env *= np.exp(-self.bfactor*s2/4.0)
+        if self.alpha: env *= np.exp(-np.power(np.pi*self.alpha*(1.0e7*self.cs*wl*wl*s*s*s-1e4*defocus_final*s), 2.0)*1e-6)
+        if self.dE: env *= np.exp(-np.power(np.pi*self.cc*wl*s*s* self.dE/self.voltage, 2.0)/(16*np.log(2))*1e8)
+        if self.dI: env *= np.exp(-np.power(np.pi*self.cc*wl*s*s* self.dI,              2.0)/(4*np.log(2))*1e2)
+        if self.dZ: env *= j0(np.pi*self.dZ*wl*s*s)
+        if self.dXY: env *= sinc(np.pi*self.dXY*s)
+
+        ctf = np.sin(gamma) * env
+        if abs>=2: ctf = ctf*ctf
+        elif abs==1: ctf = np.abs(ctf)
+
+        return s, s2, ctf
+
+    def psf1d(self, apix, abs, defocus_override=None):
+        defocus_final = defocus_override if defocus_override is not None else self.defocus
+        s_nyquist = 1./(2*apix)
+        ds = s_nyquist/(self.imagesize//2)
+        s = (np.arange(self.imagesize, dtype=np.float32) - self.imagesize//2)*ds
+        s2 = s*s
+        wl = 12.2639 / np.sqrt(self.voltage * 1000.0 + 0.97845 * self.voltage * self.voltage)  # Angstrom
+        phaseshift = self.phaseshift * np.pi / 180.0 + np.arcsin(self.ampcontrast/100.)
+        gamma =2*np.pi*(-0.5*defocus_final*1e4*wl*s2 + .25*self.cs*1e7*wl**3*s2**2) - phaseshift
+        
+        from scipy.special import j0, sinc
+        env = np.ones_like(gamma)
+        if self.bfactor: env *= np.exp(-self.bfactor*s2/4.0)
+        if self.alpha: env *= np.exp(-np.power(np.pi*self.alpha*(1.0e7*self.cs*wl*wl*s*s*s-1e4*defocus_final*s), 2.0)*1e-6)
+        if self.dE: env *= np.exp(-np.power(np.pi*self.cc*wl*s*s* self.dE/self.voltage, 2.0)/(16*np.log(2))*1e8)
+        if self.dI: env *= np.exp(-np.power(np.pi*self.cc*wl*s*s* self.dI,              2.0)/(4*np.log(2))*1e2)
+        if self.dZ: env *= j0(np.pi*self.dZ*wl*s*s)
+        if self.dXY: env *= sinc(np.pi*self.dXY*s)
+
+        ctf = np.sin(gamma) * env
+        if abs>=2: ctf = ctf*ctf
+        elif abs==1: ctf = np.abs(ctf)
+
+        unity = np.ones((self.imagesize,), dtype=np.complex64)
+        psf = np.abs( np.fft.ifft( unity * np.fft.ifftshift(ctf) ) )
+        psf = np.fft.fftshift(psf)
+        psf /= np.linalg.norm(psf, ord=2)
+        x = (np.arange(self.imagesize)-self.imagesize//2) * apix
+
+        return x, psf
+
+    def ctf2d(self, apix, abs, plot_s2=False):    
+        s_nyquist = 1./(2*apix)
+        if plot_s2:
+            ds = None
+            ds2 = s_nyquist*s_nyquist/(self.imagesize//2*self.over_sample)
+            sx2 = np.arange(-self.imagesize*self.over_sample//2, self.imagesize*self.over_sample//2) * ds2
+            sy2 = np.arange(-self.imagesize*self.over_sample//2, self.imagesize*self.over_sample//2) * ds2
+            sx2, sy2 = np.meshgrid(sx2, sy2, indexing='ij')
+            theta = -np.arctan2(sy2, sx2)
+            s2 = np.hypot(sx2, sy2)
+            s = np.sqrt(s2)
+        else:
+            ds2 = None
+            ds = s_nyquist/(self.imagesize//2*self.over_sample)
+            sx = np.arange(-self.imagesize*self.over_sample//2, self.imagesize*self.over_sample//2) * ds
+            sy = np.arange(-self.imagesize*self.over_sample//2, self.imagesize*self.over_sample//2) * ds
+            sx, sy = np.meshgrid(sx, sy, indexing='ij')
+            theta = -np.arctan2(sy, sx)
+            s2 = sx*sx + sy*sy
+            s = np.sqrt(s2)
+
+        defocus2d = self.defocus + self.dfdiff/2*np.cos( 2*(theta-self.dfang*np.pi/180.))
+
+        wl = 12.2639 / np.sqrt(self.voltage * 1000.0 + 0.97845 * self.voltage * self.voltage)  # Angstrom
+        phaseshift = self.phaseshift * np.pi / 180.0 + np.arcsin(self.ampcontrast/100.)
+
+        gamma =2*np.pi*(-0.5*defocus2d*1e4*wl*s2 + .25*self.cs*1e7*wl**3*s2**2) - phaseshift
+
+        from scipy.special import j0, sinc
+        env = np.ones_like(gamma)
+        if self.bfactor: env *= np.exp(-self.bfactor*s2/4.0)
+        if self.alpha: env *= np.exp(-np.power(np.pi*self.alpha*(1.0e7*self.cs*wl*wl*s*s*s-1e4*self.defocus*s), 2.0)*1e-6)
+        if self.dE: env *= np.exp(-np.power(np.pi*self.cc*wl*s*s* self.dE/self.voltage, 2.0)/(16*np.log(2))*1e8)
+        if self.dI: env *= np.exp(-np.power(np.pi*self.cc*wl*s*s* self.dI,              2.0)/(4*np.log(2))*1e2)
+        if self.dZ: env *= j0(np.pi*self.dZ*wl*s*s)
+        if self.dXY: env *= sinc(np.pi*self.dXY*s)
+
+        ctf = np.sin(gamma) * env
+        if abs>=2: ctf = ctf*ctf
+        elif abs==1: ctf = np.abs(ctf)
+
+        return ds, ds2, ctf
+
+def compute_radial_profile(image):
+    ny, nx = image.shape
+    rmax = min(nx//2, ny//2)+1
+    
+    r = np.arange(0, rmax, 1, dtype=np.float32)
+    theta = np.arange(0, 360, 1, dtype=np.float32) * np.pi/180.
+    n_theta = len(theta)
+
+    theta_grid, r_grid = np.meshgrid(theta, r, indexing='ij', copy=False)
+    y_grid = ny//2 + r_grid * np.sin(theta_grid)
+    x_grid = nx//2 + r_grid * np.cos(theta_grid)
+
+    coords = np.vstack((y_grid.flatten(), x_grid.flatten()))
+
+    from scipy.ndimage.interpolation import map_coordinates
+    polar = map_coordinates(image, coords, order=1).reshape(r_grid.shape)
+
+    rad_profile = polar.mean(axis=0)
+    return rad_profile
+
+def normalize(data, percentile=(0, 100)):
+    p0, p1 = percentile
+    vmin, vmax = sorted(np.percentile(data, (p0, p1)))
+    data2 = (data-vmin)/(vmax-vmin)
+    return data2
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+Measure the cold-start cost of the app: the time to import the modules and run the first computation of each code path,
+and the peak memory (RSS) of the process. Each measurement runs in a fresh Python process with the result cache disabled.
+
+Paths:
+    python  the interpreter alone, for reference
+    core    ctf_core and the 1D CTF, as used by the command line tool
+    embed   the app module and the 1D CTF plot, as shown in embed mode
+    full    embed + 2D CTF figures, rotational average, image simulation and the data table
+
+Usage:
+    python benchmarks/startup.py                          # print a table
+    python benchmarks/startup.py --json startup.json      # also save the results
+    python benchmarks/startup.py --baseline startup.json  # exit with status 1 if a path got slower/larger than the baseline
+"""
+
+import argparse, json, os, statistics, subprocess, sys, time
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+heavy_modules = "streamlit bokeh.plotting bokeh.layouts scipy.special scipy.ndimage scipy.fft skimage pandas".split()
+
+prologue = """
+import time
+t0 = time.perf_counter()
+"""
+
+epilogue = """
+import json, resource, sys
+maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+maxrss = maxrss/2**20 if sys.platform == "darwin" else maxrss/2**10   # bytes on macOS, kB on Linux
+print(json.dumps(dict(time=time.perf_counter()-t0, maxrss=maxrss, modules=[m for m in %r if m in sys.modules])))
+""" % (heavy_modules,)
+
+paths = {}
+
+paths["python"] = ""
+
+paths["core"] = """
+from ctf_core import CTF, CTFSet
+CTFSet([CTF()]).ctf1d(1.0, 0)
+"""
+
+paths["embed"] = """
+import ctf_simulation as app
+curves = app.CTFSet([app.CTF()]).ctf1d(1.0, 0)
+from bokeh.plotting import figure
+from bokeh.embed import json_item
+fig = figure()
+fig.line(curves[0][0], curves[0][2])
+json_item(fig)
+"""
+
+paths["full"] = paths["embed"] + """
+import numpy as np
+ctfset = app.CTFSet([app.CTF(dfdiff=0.1)])
+ds, ds2, ctf2d = ctfset.ctf2d(1.0, 0)[0]
+fig2ds = [app.generate_image_figure(ctf2d, ds, "CTF", f"CTF - {i+1}") for i in range(2)]
+from bokeh.layouts import gridplot
+json_item(gridplot(children=[fig2ds]))
+app.compute_radial_profile(ctf2d)
+image = app.ImagePyramid(np.random.rand(300, 300)).resize((256, 256))
+list(app.iter_apply_ctfs(image, [ctfset.ctf2d(1.0, 0, layout="rfft")[0][2]]))
+import pandas as pd
+pd.DataFrame(dict(s=curves[0][0], ctf=curves[0][2])).to_csv()
+"""
+
+def measure(path, repeat=5):
+    env = dict(os.environ, CTF_CACHE_DISABLE="1", PYTHONPATH=os.pathsep.join([repo, os.environ.get("PYTHONPATH", "")]))
+    runs = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        out = subprocess.run([sys.executable, "-c", prologue + paths[path] + epilogue], cwd=repo, env=env, capture_output=True, text=True)
+        wall = time.perf_counter()-t0
+        if out.returncode:
+            raise RuntimeError(f"path {path} failed:\n{out.stderr}")
+        run = json.loads(out.stdout.strip().split("\n")[-1])
+        run["wall"] = wall
+        runs.append(run)
+    return dict(wall=statistics.median(r["wall"] for r in runs), time=statistics.median(r["time"] for r in runs),
+        maxrss=statistics.median(r["maxrss"] for r in runs), modules=runs[-1]["modules"], repeat=repeat)
+
+def main():
+    parser = argparse.ArgumentParser(description="cold-start time and memory of the app code paths")
+    parser.add_argument("--paths", default=",".join(paths), help="comma separated paths to measure (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=5, help="number of processes per path. The median is reported (default: %(default)s)")
+    parser.add_argument("--json", metavar="FILE", help="save the results to a json file")
+    parser.add_argument("--baseline", metavar="FILE", help="compare with the results saved by --json")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative increase over the baseline (default: %(default)s)")
+    args = parser.parse_args()
+
+    results = {}
+    print(f"{'path':8s} {'wall (s)':>9s} {'in-process (s)':>15s} {'max RSS (MB)':>13s}  heavy modules loaded")
+    for path in args.paths.split(","):
+        if path not in paths: parser.error(f"unknown path {path}. Valid paths: {','.join(paths)}")
+        r = measure(path, args.repeat)
+        results[path] = r
+        print(f"{path:8s} {r['wall']:9.3f} {r['time']:15.3f} {r['maxrss']:13.1f}  {' '.join(r['modules'])}", flush=True)
+
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(dict(python=sys.version, results=results), fp, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)["results"]
+        regressions = []
+        for path, r in results.items():
+            if path not in baseline: continue
+            for metric in ("wall", "maxrss"):
+                if r[metric] > baseline[path][metric]*(1+args.tolerance):
+                    regressions.append(f"{path} {metric}: {baseline[path][metric]:.3f} -> {r[metric]:.3f}")
+            new_modules = set(r["modules"]) - set(baseline[path]["modules"])
+            if new_modules:
+                regressions.append(f"{path} now loads {' '.join(sorted(new_modules))}")
+        for regression in regressions: print(f"REGRESSION {regression}")
+        if regressions: sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+Compute CTF curves, 2D CTFs and PSFs in batch from the command line, without Streamlit
+
+The CTF parameters (see ctf_core.CTF) come from a parameter file and/or sweeps. The members are the rows of the file
+times all combinations of the sweep values, with --set overriding a parameter for all of them:
+    ctf-simulate --sweep defocus=0.5:3:26 --sweep bfactor=0,50,100 --ctf1d --psf -o ctfs.npz
+    ctf-simulate --params ctfs.csv --set imagesize=512 --ctf2d --float32 -o ctf2ds/
+
+Parameter files are CSV files with a header line of parameter names, or JSON files with a list of {name: value} dicts
+or a dict of {name: [values]}.
+The output is an .npz file, or a directory of .npy files (written incrementally) if the output path does not end with .npz:
+    <parameter name>     the value of each parameter for each member, shape (n,)
+    s, s2, ctf1d         the 1D CTFs on the s (or s2 with --s2) axis, shape (n, len(s))
+    rotavg               the rotational averages of the 2D CTFs on the same axis, shape (n, len(s))
+    x, psf               the PSFs, shape (n, imagesize), or (n, --psf-samples) on the window set by --psf-window
+    ds, ds2, ctf2d       the 2D CTFs and their pixel size (in 1/Å, or 1/Å^2 with --s2), shape (n, ny, nx)
+    zeros, extrema       s of the first K zeros and peaks of the 1D CTFs (closed form, padded with nan), shape (n, K)
+    envelope_resolution  s where the envelope falls below 10% (nan if not before s=1/Å), shape (n,)
+If the members have different imagesize/over_sample, the arrays are written per group with the suffix
+_<imagesize>_<over_sample> and index_<imagesize>_<over_sample> lists the members of each group.
+"""
+
+import argparse, csv, itertools, json, os, sys
+import numpy as np
+import result_cache
+from ctf_core import CTF, CTFSet, CTFMemoryError, get_memory_budget
+
+ctf_types = {"ctf": 0, "abs": 1, "ctf2": 2}
+
+def parse_value(name, value):
+    try:
+        return int(value) if name in ("imagesize", "over_sample") else float(value)
+    except ValueError:
+        raise ValueError(f"invalid value {value!r} for parameter {name}")
+
+def parse_assignment(text):
+    name, sep, value = text.partition("=")
+    name = name.strip()
+    if not sep or not value:
+        raise ValueError(f"expected name=value, got {text!r}")
+    if name not in CTF().get_dict():
+        raise ValueError(f"unknown CTF parameter {name}. Valid parameters: {' '.join(CTF().get_dict())}")
+    return name, value.strip()
+
+def parse_sweep(text):
+    # name=start:stop:num (inclusive, like np.linspace) or name=v1,v2,...
+    name, value = parse_assignment(text)
+    if ":" in value:
+        try:
+            start, stop, num = value.split(":")
+            values = np.linspace(float(start), float(stop), int(num))
+        except ValueError:
+            raise ValueError(f"expected {name}=start:stop:num, got {text!r}")
+    else:
+        values = [float(v) for v in value.split(",")]
+    return name, [parse_value(name, v) for v in values]
+
+def read_parameter_file(filename):
+    # returns a list of {name: value} dicts
+    with open(filename) as fp:
+        if filename.lower().endswith(".json"):
+            data = json.load(fp)
+            if isinstance(data, dict):
+                if all(np.ndim(v)==0 for v in data.values()): data = [data]
+                else:
+                    n = max(np.size(v) for v in data.values())
+                    data = [{k: np.broadcast_to(v, (n,))[i] for k, v in data.items()} for i in range(n)]
+        else:
+            data = [row for row in csv.DictReader(fp) if any(v.strip() for v in row.values() if v)]
+    rows = []
+    valid = CTF().get_dict()
+    for row in data:
+        unknown = [k for k in row if k not in valid]
+        if unknown:
+            raise ValueError(f"{filename}: unknown CTF parameter(s) {' '.join(unknown)}")
+        rows.append({k: parse_value(k, v) for k, v in row.items() if str(v).strip()})
+    return rows
+
+def build_ctfset(param_files=(), sweeps=(), sets=()):
+    rows = []
+    for filename in param_files: rows += read_parameter_file(filename)
+    if not rows: rows = [{}]
+    sweeps = [parse_sweep(s) for s in sweeps]
+    sweep_names = [name for name, _ in sweeps]
+    fixed = {name: parse_value(name, value) for name, value in map(parse_assignment, sets)}
+    repeated = sorted({name for name in sweep_names if sweep_names.count(name)>1} | (set(sweep_names) & set(fixed)))
+    if repeated:
+        raise ValueError(f"{' '.join(repeated)}: a parameter can only be swept once, and not also be set with --set")
+    members = []
+    for row in rows:
+        for values in itertools.product(*[values for _, values in sweeps]):
+            members.append(dict(row, **dict(zip(sweep_names, values)), **fixed))
+    defaults = CTF().get_dict()
+    params = {attr: np.array([m.get(attr, default) for m in members]) for attr, default in defaults.items()}
+    return CTFSet(**params)
+
+class OutputWriter:
+    """Collects the output arrays in an .npz file or writes them as memory-mapped .npy files in a directory"""
+    def __init__(self, path, compress=False):
+        self.path = path
+        self.npz = path.lower().endswith(".npz")
+        self.compress = compress
+        self.arrays = {}
+        if not self.npz: os.makedirs(path, exist_ok=True)
+
+    def allocate(self, name, shape, dtype):
+        if self.npz:
+            a = np.empty(shape, dtype=dtype)
+        else:
+            a = np.lib.format.open_memmap(os.path.join(self.path, f"{name}.npy"), mode="w+", dtype=dtype, shape=shape)
+        self.arrays[name] = a
+        return a
+
+    def add(self, name, value):
+        self.allocate(name, np.shape(value), np.asarray(value).dtype)[...] = value
+
+    def close(self):
+        if self.npz:
+            save = np.savez_compressed if self.compress else np.savez
+            save(self.path, **self.arrays)
+        else:
+            for a in self.arrays.values():
+                if isinstance(a, np.memmap): a.flush()
+        self.arrays = {}
+
+def compute(ctfset, writer, apix, abs=0, plot_s2=False, ctf1d=True, rotavg=False, psf=False, ctf2d=False, zeros=0, dtype=np.float64, chunk_size=1024, progress=None, psf_window=0, psf_samples=512):
+    for attr, vals in ctfset.params.items(): writer.add(attr, vals)
+    if zeros:   # cheap closed-form results for all members at once
+        writer.add("zeros", ctfset.zeros(zeros))
+        writer.add("extrema", ctfset.extrema(zeros))
+        writer.add("envelope_resolution", ctfset.envelope_resolution(0.1))
+    groups = ctfset.groups()
+    for (imagesize, over_sample), indices in groups.items():
+        suffix = "" if len(groups)==1 else f"_{imagesize}_{over_sample}"
+        if suffix: writer.add(f"index{suffix}", indices)
+        outputs = {}
+        chunk = chunk_size
+        if ctf2d:   # keep the 2D CTFs of a chunk within half of the memory budget
+            nbytes = (imagesize*over_sample)**2 * np.dtype(dtype).itemsize
+            chunk = max(1, min(chunk_size, get_memory_budget()//2//nbytes))
+        for c0 in range(0, len(indices), chunk):
+            sub = CTFSet(**{attr: vals[indices[c0:c0+chunk]] for attr, vals in ctfset.params.items()})
+            results = []    # (name, {axis name: axis shared by the group}, values of the members)
+            if ctf1d:
+                curves = sub.ctf1d(apix, abs, plot_s2)
+                results.append(("ctf1d", dict(s=curves[0][0], s2=curves[0][1]), [c for _, _, c in curves]))
+            if rotavg:
+                curves = sub.ctf1d_rotavg(apix, abs, plot_s2)
+                results.append(("rotavg", dict(s=curves[0][0], s2=curves[0][1]), [c for _, _, c in curves]))
+            if psf:
+                psfs = sub.psf1d_zoom(apix, abs, psf_window, psf_samples) if psf_window else sub.psf1d(apix, abs)
+                results.append(("psf", dict(x=psfs[0][0]), [p for _, p in psfs]))
+            if ctf2d:
+                ctf2ds = sub.ctf2d(apix, abs, plot_s2, dtype=dtype)
+                ds, ds2, _ = ctf2ds[0]
+                axes = dict(ds=np.nan if ds is None else ds, ds2=np.nan if ds2 is None else ds2)
+                results.append(("ctf2d", axes, [c for _, _, c in ctf2ds]))
+            for name, axes, values in results:
+                for axis, value in axes.items():
+                    if axis+suffix not in writer.arrays: writer.add(axis+suffix, value)
+                if name not in outputs:
+                    outputs[name] = writer.allocate(name+suffix, (len(indices),)+values[0].shape, values[0].dtype)
+                outputs[name][c0:c0+len(values)] = values
+            if progress: progress(min(c0+chunk, len(indices)), len(indices), (imagesize, over_sample))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="ctf-simulate", description=__doc__.strip().split("\n")[0],
+        epilog="\n".join(__doc__.strip().split("\n")[1:]), formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-p", "--params", metavar="FILE", action="append", default=[], help="CSV or JSON parameter file. Can be repeated")
+    parser.add_argument("--sweep", metavar="NAME=START:STOP:NUM", action="append", default=[], help="sweep a parameter over np.linspace(START, STOP, NUM) or a list NAME=V1,V2,... Can be repeated")
+    parser.add_argument("--set", metavar="NAME=VALUE", action="append", default=[], help="set a parameter for all members. Can be repeated")
+    parser.add_argument("--apix", type=float, default=1.0, help="pixel size in Å/pixel (default: %(default)s)")
+    parser.add_argument("--type", choices=list(ctf_types), default="ctf", help="ctf: CTF, abs: |CTF|, ctf2: CTF^2 (default: %(default)s)")
+    parser.add_argument("--s2", action="store_true", help="sample the 1D/2D CTFs uniformly in s^2 instead of s")
+    parser.add_argument("--ctf1d", action="store_true", help="compute the 1D CTF curves (the default if no output is selected)")
+    parser.add_argument("--rotavg", action="store_true", help="compute the rotational averages of the 2D CTFs")
+    parser.add_argument("--psf", action="store_true", help="compute the 1D PSFs")
+    parser.add_argument("--psf-window", metavar="HALF_WIDTH", type=float, default=0, help="compute the PSFs on [-HALF_WIDTH, HALF_WIDTH) Å with a zoom FFT instead of on the whole image at the pixel size")
+    parser.add_argument("--psf-samples", type=int, default=512, help="number of samples of the PSFs with --psf-window (default: %(default)s)")
+    parser.add_argument("--ctf2d", action="store_true", help="compute the 2D CTFs")
+    parser.add_argument("--zeros", metavar="K", type=int, default=0, help="compute the first K zeros and peaks of the 1D CTFs and where their envelope falls below 10%%")
+    parser.add_argument("--float32", action="store_true", help="compute the 2D CTFs in single precision")
+    parser.add_argument("--chunk-size", type=int, default=1024, help="number of CTFs evaluated together (default: %(default)s)")
+    parser.add_argument("--compress", action="store_true", help="write a compressed .npz file")
+    parser.add_argument("--cache", action="store_true", help="use the on-disk result cache of the web app")
+    parser.add_argument("-q", "--quiet", action="store_true", help="do not report progress")
+    parser.add_argument("-o", "--output", required=True, help="output .npz file or directory")
+    args = parser.parse_args(argv)
+
+    try:
+        ctfset = build_ctfset(args.params, args.sweep, args.set)
+    except (OSError, ValueError) as err:
+        parser.error(str(err))
+    if not (args.ctf1d or args.rotavg or args.psf or args.ctf2d or args.zeros): args.ctf1d = True
+    if args.chunk_size < 1: parser.error("--chunk-size must be >= 1")
+    if args.psf_window < 0 or args.psf_samples < 1: parser.error("--psf-window must be >= 0 and --psf-samples >= 1")
+    if not args.cache: result_cache.default_cache.enabled = False
+
+    def progress(done, total, group):
+        if not args.quiet: print(f"imagesize={group[0]} over_sample={group[1]}: {done}/{total} CTFs", file=sys.stderr)
+
+    writer = OutputWriter(args.output, compress=args.compress)
+    try:
+        compute(ctfset, writer, args.apix, abs=ctf_types[args.type], plot_s2=args.s2,
+            ctf1d=args.ctf1d, rotavg=args.rotavg, psf=args.psf, ctf2d=args.ctf2d, zeros=args.zeros,
+            dtype=np.float32 if args.float32 else np.float64, chunk_size=args.chunk_size, progress=progress,
+            psf_window=args.psf_window, psf_samples=args.psf_samples)
+    except CTFMemoryError as err:
+        sys.exit(f"ctf-simulate: {err}. Increase CTF_MEMORY_BUDGET_MB or use --float32")
+    writer.close()
+    if not args.quiet: print(f"{len(ctfset)} CTFs written to {args.output}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
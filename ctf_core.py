@@ -0,0 +1,971 @@
+"""
+Streamlit-free CTF physics shared by the web app (ctf_simulation.py) and the command line tool (ctf_cli.py)
+"""
+
+import collections, functools, hashlib, math, os, threading
+import numpy as np
+import result_cache
+
+def electron_wavelength(voltage):
+    return 12.2639 / np.sqrt(voltage * 1000.0 + 0.97845 * voltage * voltage)  # Angstrom
+
+def ctf_formula(s, s2, abs, p, defocus_alpha=None, cache=None, axis_key=None):
+    # p: dict of CTF parameters, each a scalar or an array broadcastable against s/s2
+    # cache, axis_key: see ctf_envelope
+    wl = electron_wavelength(p["voltage"])
+    phaseshift = p["phaseshift"] * np.pi / 180.0 + np.arcsin(p["ampcontrast"]/100.)
+    gamma =2*np.pi*(-0.5*p["defocus"]*1e4*wl*s2 + .25*p["cs"]*1e7*wl**3*s2**2) - phaseshift
+
+    ctf = np.sin(gamma)
+    env = ctf_envelope(s, s2, p, defocus_alpha, cache=cache, axis_key=axis_key)
+    if env is not None: ctf = ctf * env
+    if abs>=2: ctf = ctf*ctf
+    elif abs==1: ctf = np.abs(ctf)
+    return ctf
+
+# the parameters that each envelope function depends on, besides the frequency
+envelope_parameters = dict(bfactor=("bfactor",), alpha=("alpha", "cs", "voltage", "defocus_alpha"), dE=("dE", "cc", "voltage"),
+    dI=("dI", "cc", "voltage"), dZ=("dZ", "voltage"), dXY=("dXY",))
+
+def envelope_factor(term, s, s2, p, defocus_alpha):
+    wl = electron_wavelength(p["voltage"])
+    if term == "bfactor": return np.exp(-p["bfactor"]*s2/4.0)
+    if term == "alpha": return np.exp(-np.power(np.pi*p["alpha"]*(1.0e7*p["cs"]*wl*wl*s*s*s-1e4*defocus_alpha*s), 2.0)*1e-6)
+    if term == "dE": return np.exp(-np.power(np.pi*p["cc"]*wl*s*s* p["dE"]/p["voltage"], 2.0)/(16*math.log(2))*1e8)
+    if term == "dI": return np.exp(-np.power(np.pi*p["cc"]*wl*s*s* p["dI"],              2.0)/(4*math.log(2))*1e2)
+    if term == "dZ":
+        from scipy.special import j0
+        return j0(np.pi*p["dZ"]*wl*s*s)
+    if term == "dXY": return np.sinc(np.pi*p["dXY"]*s)
+    raise ValueError(f"unknown envelope function {term}")
+
+def envelope_product(terms, s, s2, p, defocus_alpha):
+    env = None
+    for term in terms:
+        factor = envelope_factor(term, s, s2, p, defocus_alpha)
+        if env is None: env = factor
+        elif np.shape(env) == np.broadcast(env, factor).shape: env *= factor
+        else: env = env * factor
+    return env
+
+def ctf_envelope(s, s2, p, defocus_alpha=None, cache=None, axis_key=None):
+    """product of the envelope functions that are on in p, None if all of them are off
+    cache: an EnvelopeCache to reuse the envelope computed earlier for the same frequencies, identified by axis_key
+    (or by the values of s if it is a small array), and the same values of the parameters that each factor depends on.
+    The factors that do not depend on the defocus are cached as one product, so a change of the defocus only recomputes
+    the alpha term. The returned array can be read-only
+    """
+    if defocus_alpha is None: defocus_alpha = p["defocus"]
+    terms = [term for term in envelope_parameters if np.any(p[term])]
+    if not terms: return None
+    if cache is not None and axis_key is None and np.size(s) <= 1<<16:
+        s, s2 = np.ascontiguousarray(s), np.ascontiguousarray(s2)
+        axis_key = hashlib.blake2b(f"{s.shape}{s.dtype.str}{s2.dtype.str}".encode() + s.tobytes() + s2.tobytes(), digest_size=16).digest()
+    if cache is None or axis_key is None:
+        return envelope_product(terms, s, s2, p, defocus_alpha)
+
+    env = None
+    static = tuple(term for term in terms if term != "alpha")
+    if static:
+        key = envelope_key(static, axis_key, p, defocus_alpha)
+        env = cache.get(key, lambda: envelope_product(static, s, s2, p, defocus_alpha))
+    if "alpha" in terms:
+        key = envelope_key(("alpha",), axis_key, p, defocus_alpha)
+        factor = cache.get(key, lambda: envelope_factor("alpha", s, s2, p, defocus_alpha))
+        env = factor if env is None else env * factor
+    return env
+
+def envelope_key(terms, axis_key, p, defocus_alpha):
+    h = hashlib.blake2b(repr((terms, axis_key)).encode(), digest_size=16)
+    for name in sorted(set(name for term in terms for name in envelope_parameters[term])):
+        v = np.ascontiguousarray(defocus_alpha if name == "defocus_alpha" else p[name])
+        h.update(f"{name}{v.dtype.str}{v.shape}".encode())
+        h.update(v.tobytes())
+    return h.digest()
+
+class EnvelopeCache:
+    """Memory-bounded LRU cache of envelope factors (see ctf_envelope) shared by all CTFs"""
+    def __init__(self, max_bytes=256*2**20):
+        self.max_bytes = max_bytes
+        self.arrays = collections.OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, compute):
+        with self.lock:
+            if key in self.arrays:
+                self.arrays.move_to_end(key)
+                self.hits += 1
+                return self.arrays[key]
+            self.misses += 1
+        value = compute()
+        value.setflags(write=False)
+        if value.nbytes <= self.max_bytes//4:
+            with self.lock:
+                self.arrays[key] = value
+                self.evict()
+        return value
+
+    @property
+    def nbytes(self):
+        with self.lock:
+            return sum(a.nbytes for a in self.arrays.values())
+
+    def evict(self):
+        with self.lock:
+            nbytes = self.nbytes
+            while nbytes > self.max_bytes and len(self.arrays)>1:
+                _, a = self.arrays.popitem(last=False)
+                nbytes -= a.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.arrays.clear()
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, entries=len(self.arrays), nbytes=self.nbytes, max_bytes=self.max_bytes)
+
+_envelope_cache = None
+
+def get_envelope_cache():
+    # one cache per process, shared by all sessions and reruns of the app
+    global _envelope_cache
+    if _envelope_cache is None:
+        max_bytes = int(float(os.environ.get("CTF_ENVELOPE_CACHE_MB", 256))*2**20)
+        _envelope_cache = EnvelopeCache(max_bytes=max_bytes)
+    return _envelope_cache
+
+def gamma_coefficients(p):
+    # gamma = a*x^2 + b*x - phi with x = s^2 (see ctf_formula)
+    wl = electron_wavelength(p["voltage"])
+    a = 2*np.pi*.25*p["cs"]*1e7*wl**3
+    b = -2*np.pi*0.5*p["defocus"]*1e4*wl
+    phi = p["phaseshift"] * np.pi / 180.0 + np.arcsin(p["ampcontrast"]/100.)
+    return a, b, phi
+
+def gamma_roots(a, b, phi, offset, K=None, x_max=np.inf):
+    """The first K solutions x >= 0 of a*x^2 + b*x - phi = offset + k*pi (k: any integer) in increasing order, for each of
+    the n sets of coefficients. Returns a (n, K) array padded with nan. K=None: all solutions with x <= x_max
+    offset=0 gives the zeros of sin(gamma) and offset=pi/2 its extrema
+    """
+    a, b, phi, x_max = [np.asarray(v, dtype=float).ravel() for v in np.broadcast_arrays(a, b, phi, x_max)]
+    # {offset + k*pi} is symmetric under negation for offset 0 or pi/2: flip the signs so that gamma is a parabola opening
+    # upwards (a>0) or an increasing line (a=0, b>=0)
+    flip = (a<0) | ((a==0) & (b<0))
+    a, b, phi = np.where(flip, -a, a), np.where(flip, -b, b), np.where(flip, -phi, phi)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        g0 = -phi                                           # gamma(0)
+        descending = (a>0) & (b<0)                          # gamma first decreases to its minimum at the vertex x=-b/(2a)>0
+        gmin = np.where(descending, g0 - b*b/(4*a), g0)
+        if K is None:
+            if not np.all(np.isfinite(x_max)): raise ValueError("K or a finite x_max is needed")
+            # the number of multiples of pi in the range of gamma on [0, x_max]
+            x_low = np.where(descending, np.minimum(-b/(2*a), x_max), 0)
+            g_low = a*x_low*x_low + b*x_low - phi
+            g_max = a*x_max*x_max + b*x_max - phi
+            K = int(np.nanmax(np.append((g0-g_low + g_max-g_low)/np.pi, 0))) + 2
+        j = np.arange(K)
+        k0 = np.floor((g0-offset)/np.pi)
+        t_desc = offset + np.pi*(k0[:, None] - j)           # descending branch: gamma from g0 down to gmin
+        t_asc = offset + np.pi*(np.where(descending, np.floor((gmin-offset)/np.pi)+1, np.ceil((g0-offset)/np.pi))[:, None] + j)
+        roots = []
+        for t, branch in ((t_desc, "desc"), (t_asc, "asc")):
+            c = phi[:, None] + t
+            D = b[:, None]**2 + 4*a[:, None]*c
+            # numerically stable roots: q = -(b + sign(b)*sqrt(D))/2, x1 = q/a, x2 = -c/q
+            q = -0.5*(b[:, None] + np.where(b[:, None]<0, -1, 1)*np.sqrt(D))
+            if branch == "desc":
+                x = np.where(descending[:, None] & (t >= gmin[:, None]), -c/q, np.nan)
+            else:
+                x = np.where(b[:, None]<0, q/a[:, None], -c/q)
+                x = np.where((a[:, None]>0) | (b[:, None]>0), x, np.nan)   # gamma is constant if a=b=0
+            roots.append(np.where((D>=0) & (x>=0) & (x<=x_max[:, None]), x, np.nan))
+    roots = np.sort(np.concatenate(roots, axis=1), axis=1)[:, :K]   # nan sorts last
+    return roots
+
+def ctf1d_axis(apix, imagesize, over_sample, plot_s2=False):
+    s_nyquist = 1./(2*apix)
+    n = imagesize//2*over_sample
+    if plot_s2:
+        ds2 = s_nyquist*s_nyquist/n
+        s2 = np.arange(n+1, dtype=np.float32)*ds2
+        s = np.sqrt(s2)
+    else:
+        ds = s_nyquist/n
+        s = np.arange(n+1, dtype=np.float32)*ds
+        s2 = s*s
+    return s, s2
+
+def psf1d_axis(apix, imagesize, over_sample=1):
+    s_nyquist = 1./(2*apix)
+    ds = s_nyquist/(imagesize//2*over_sample)
+    n = imagesize*over_sample
+    s = (np.arange(n, dtype=np.float32) - n//2)*ds
+    s2 = s*s
+    return s, s2
+
+def zoom_dft(a, s0, ds, x0, dx, m, axis=-1, workers=-1):
+    """y[j] = sum_k a[k]*exp(2πi*(s0+k*ds)*(x0+j*dx)) for j < m along axis, by the chirp-z transform (Bluestein's algorithm)
+    The same sum as an inverse DFT (without the 1/n), but on a window of m points of x at any spacing dx, using FFTs of
+    length ~n+m instead of zero-padding a to the length 1/(ds*dx) that an inverse FFT would need for that spacing
+    """
+    from scipy import fft
+    a = np.moveaxis(np.asarray(a), axis, -1)
+    n = a.shape[-1]
+    L = fft.next_fast_len(n+m-1)
+    k = np.arange(max(n, m), dtype=np.float64)
+    chirp = np.exp(1j*np.pi*ds*dx*k*k)   # exp(2πi*ds*dx*k*j) = chirp[k]*chirp[j]*conj(chirp[j-k])
+    u = np.zeros(a.shape[:-1] + (L,), dtype=np.complex128)
+    u[..., :n] = a * (np.exp(2j*np.pi*ds*x0*k[:n]) * chirp[:n])
+    v = np.zeros(L, dtype=np.complex128)
+    v[:m] = np.conj(chirp[:m])
+    v[L-n+1:] = np.conj(chirp[1:n][::-1])    # negative j-k
+    y = fft.ifft(fft.fft(u, workers=workers) * fft.fft(v), workers=workers, overwrite_x=True)[..., :m]
+    y *= chirp[:m] * np.exp(2j*np.pi*s0*(x0 + dx*k[:m]))
+    return np.moveaxis(y, -1, axis)
+
+class FrequencyGrid:
+    """Read-only frequency grid of an (imagesize*over_sample)^2 2D CTF, or of the rows rows[0]:rows[1] of it. Each array is computed on first use
+    layout: "centered" - zero frequency at the center as displayed
+            "rfft" - the half-plane of np.fft.rfft2 with zero frequency at [0, 0], i.e. ready to multiply the rfft2 of an image without fftshift
+    """
+    fields = ("s", "s2", "theta", "cos2theta", "sin2theta")
+
+    def __init__(self, imagesize, over_sample, apix, plot_s2=False, dtype=np.float64, layout="centered", rows=None, cache=None, axes=None):
+        # axes: the uniformly spaced (axis0, axis1) of any region, e.g. a zoomed view, instead of those of the whole grid
+        self.imagesize = imagesize
+        self.over_sample = over_sample
+        self.apix = apix
+        self.plot_s2 = plot_s2
+        self.dtype = np.dtype(dtype)
+        self.layout = layout
+        self.cache = cache
+        s_nyquist = 1./(2*apix)
+        n = imagesize*over_sample
+        if plot_s2:
+            self.ds = None
+            self.ds2 = s_nyquist*s_nyquist/(imagesize//2*over_sample)
+            d = self.ds2
+        else:
+            self.ds2 = None
+            self.ds = s_nyquist/(imagesize//2*over_sample)
+            d = self.ds
+        if layout == "centered":
+            self.axis0 = self.axis1 = (np.arange(-n//2, n//2) * d).astype(self.dtype)
+        elif layout == "rfft":
+            self.axis0 = (np.fft.fftfreq(n) * n * d).astype(self.dtype)    # the order of rfft2, also for odd n
+            self.axis1 = (np.arange(n//2+1) * d).astype(self.dtype)
+        else:
+            raise ValueError(f"unknown layout {layout}")
+        self.axes = axes
+        if axes is not None:
+            self.axis0, self.axis1 = [np.asarray(axis).astype(self.dtype) for axis in axes]
+            d = float(axes[0][1]-axes[0][0]) if len(axes[0])>1 else d
+            if plot_s2: self.ds2 = d
+            else: self.ds = d
+        self.rows = rows if rows is not None else (0, len(self.axis0))
+        self.shape = (self.rows[1]-self.rows[0], len(self.axis1))
+        self._arrays = {}
+        self._lock = threading.RLock()
+
+    @property
+    def rmax(self):     # the radius of the corner pixels
+        return float(np.hypot(np.abs(self.axis0).max(), np.abs(self.axis1).max()))
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in list(self._arrays.values()))
+
+    def get(self, name):
+        if name not in self._arrays:
+            with self._lock:
+                if name not in self._arrays:
+                    sx, sy = self.axis0[self.rows[0]:self.rows[1], None], self.axis1[None, :]     # indexing='ij'
+                    if name == "s2":
+                        a = np.hypot(sx, sy) if self.plot_s2 else sx*sx + sy*sy
+                    elif name == "s":
+                        a = np.sqrt(self.get("s2"))
+                    elif name == "theta":
+                        a = -np.arctan2(sy, sx)
+                    elif name == "cos2theta":
+                        a = np.cos(2*self.get("theta"))
+                    elif name == "sin2theta":
+                        a = np.sin(2*self.get("theta"))
+                    else:
+                        raise KeyError(name)
+                    a.setflags(write=False)
+                    self._arrays[name] = a
+            if self.cache is not None: self.cache.evict()
+        return self._arrays[name]
+
+    def tile(self, r0, r1):
+        """Rows r0:r1 of this grid. Arrays already computed for this grid are shared as views, the others are only computed for the tile"""
+        tile = FrequencyGrid(self.imagesize, self.over_sample, self.apix, self.plot_s2, self.dtype, self.layout, rows=(self.rows[0]+r0, self.rows[0]+min(r1, self.shape[0])), axes=self.axes)
+        tile._arrays = {name: a[r0:r1] for name, a in self._arrays.items()}
+        return tile
+
+    s = property(lambda self: self.get("s"))
+    s2 = property(lambda self: self.get("s2"))
+    theta = property(lambda self: self.get("theta"))
+    cos2theta = property(lambda self: self.get("cos2theta"))
+    sin2theta = property(lambda self: self.get("sin2theta"))
+
+    @property
+    def r(self):    # the radius of each pixel in the units of the grid axis
+        return self.s2 if self.plot_s2 else self.s
+
+class FrequencyGridCache:
+    """Memory-bounded LRU cache of FrequencyGrid objects shared by all CTFs"""
+    def __init__(self, max_bytes=512*2**20):
+        self.max_bytes = max_bytes
+        self.grids = collections.OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, imagesize, over_sample, apix, plot_s2=False, dtype=np.float64, layout="centered"):
+        key = (int(imagesize), int(over_sample), float(apix), bool(plot_s2), np.dtype(dtype), layout)
+        with self.lock:
+            if key in self.grids:
+                self.hits += 1
+                self.grids.move_to_end(key)
+                return self.grids[key]
+            self.misses += 1
+            grid = FrequencyGrid(*key, cache=self)
+            self.grids[key] = grid
+            return grid
+
+    @property
+    def nbytes(self):
+        with self.lock:
+            return sum(grid.nbytes for grid in self.grids.values())
+
+    def evict(self):
+        # drop the least recently used grids until within max_bytes. A grid larger than max_bytes is not kept at all
+        with self.lock:
+            while self.grids and self.nbytes > self.max_bytes:
+                self.grids.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.grids.clear()
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, entries=len(self.grids), nbytes=self.nbytes, max_bytes=self.max_bytes)
+
+_frequency_grid_cache = None
+
+def get_frequency_grid_cache():
+    # one cache per process, shared by all sessions and reruns of the app
+    global _frequency_grid_cache
+    if _frequency_grid_cache is None:
+        max_bytes = int(float(os.environ.get("CTF_GRID_CACHE_MB", 512))*2**20)
+        _frequency_grid_cache = FrequencyGridCache(max_bytes=max_bytes)
+    return _frequency_grid_cache
+
+class CTF:
+    def __init__(self, voltage=300.0, cs=2.7, ampcontrast=7.0, defocus=0.5, dfdiff=0.0, dfang=0.0, phaseshift=0.0, bfactor=0.0, alpha=0.0, cc=2.7, dE=0.0, dI=0.0, dZ=0.0, dXY=0.0, imagesize=256, over_sample=1):
+        self.voltage = voltage
+        self.cs = cs
+        self.ampcontrast = ampcontrast
+        self.defocus = defocus
+        self.dfdiff = dfdiff
+        self.dfang = dfang
+        self.phaseshift = phaseshift
+        self.bfactor = bfactor
+        self.alpha = alpha
+        self.cc = cc
+        self.dE = dE
+        self.dI = dI
+        self.dZ = dZ
+        self.dXY = dXY
+        self.imagesize = int(imagesize)
+        self.over_sample = int(over_sample)
+
+    def __str__(self):
+        return str(self.get_dict())
+
+    def __repr__(self):
+        return self.__str__()
+
+    def get_dict(self):
+        ret = {}
+        ret.update(self.__dict__)
+        return ret
+
+    def ctf1d(self, apix, abs, plot_s2=False, defocus_override=None):
+        return CTFSet([self]).ctf1d(apix, abs, plot_s2, defocus_override=defocus_override)[0]
+
+    def psf1d(self, apix, abs, defocus_override=None):
+        return CTFSet([self]).psf1d(apix, abs, defocus_override=defocus_override)[0]
+
+    def psf1d_zoom(self, apix, abs, window, samples=512, defocus_override=None):
+        return CTFSet([self]).psf1d_zoom(apix, abs, window, samples, defocus_override=defocus_override)[0]
+
+    def psf2d(self, apix, abs, window, samples=256, dtype=np.float64, memory_budget=None):
+        return CTFSet([self]).psf2d(apix, abs, window, samples, dtype=dtype, memory_budget=memory_budget)[0]
+
+    def ctf1d_rotavg(self, apix, abs, plot_s2=False, n_angles=360):
+        return CTFSet([self]).ctf1d_rotavg(apix, abs, plot_s2, n_angles=n_angles)[0]
+
+    def zeros(self, K=None, s_max=None, plot_s2=False):
+        return CTFSet([self]).zeros(K, s_max, plot_s2)[0]
+
+    def extrema(self, K=None, s_max=None, plot_s2=False):
+        return CTFSet([self]).extrema(K, s_max, plot_s2)[0]
+
+    def envelope_resolution(self, threshold=0.1, s_max=1.0):
+        return CTFSet([self]).envelope_resolution(threshold, s_max)[0]
+
+    def aliasing_resolution(self, apix, samples_per_period=2, plot_s2=False):
+        return CTFSet([self]).aliasing_resolution(apix, samples_per_period, plot_s2)[0]
+
+    def min_over_sample(self, apix, samples_per_period=2, plot_s2=False):
+        return CTFSet([self]).min_over_sample(apix, samples_per_period, plot_s2)[0]
+
+    def ctf2d(self, apix, abs, plot_s2=False, lut_tolerance=1e-4, dtype=np.float64, memory_budget=None, layout="centered"):
+        return CTFSet([self]).ctf2d(apix, abs, plot_s2, lut_tolerance=lut_tolerance, dtype=dtype, memory_budget=memory_budget, layout=layout)[0]
+
+    def ctf2d_zoom(self, apix, abs, center, width, samples=256, plot_s2=False, dtype=np.float64, memory_budget=None):
+        return CTFSet([self]).ctf2d_zoom(apix, abs, center, width, samples, plot_s2, dtype=dtype, memory_budget=memory_budget)[0]
+
+# the plot settings of the web app that can be set in its URL, besides the CTF parameters and embed
+query_plot_settings = "ctf_type apix show_1d show_2d show_psf plot_s2 show_marker show_zeros float32 preview".split()
+
+def parse_query_parameters(query_params):
+    """The CTFs, plot settings and embed mode of the web app from its URL query parameters {name: [value, ...]}, as returned
+    by st.experimental_get_query_params() or urllib.parse.parse_qs(). A CTF parameter can be repeated to set the CTFs one by one,
+    the last value applying to the remaining CTFs. ctfs is None if the URL has no CTF parameters. Raises ValueError for invalid numbers
+    """
+    embed = "embed" in query_params and query_params["embed"][0]!='0'
+    attrs = CTF().get_dict().keys()
+    ns = [len(query_params[attr]) for attr in attrs if attr in query_params]
+    if not ns:
+        ctfs = None
+    else:
+        n = int(max(ns))
+        ctfs = [CTF() for i in range(n)]
+        for attr in attrs:
+            if attr in query_params:
+                for i in range(n):
+                    setattr(ctfs[i], attr, float(query_params[attr][-1]))
+                for i in range(len(query_params[attr])):
+                    setattr(ctfs[i], attr, float(query_params[attr][i]))
+        for i in range(len(ctfs)):
+            ctfs[i].imagesize = max(32, int(ctfs[i].imagesize))
+            ctfs[i].over_sample = max(1, int(ctfs[i].over_sample))
+
+    plot_settings = {}
+    for attr in query_plot_settings:
+        if attr in query_params:
+            plot_settings[attr] = query_params[attr][0]
+    return ctfs, plot_settings, embed
+
+class CTFSet:
+    """N CTFs with each parameter stored as a length N array so that all of them are evaluated in one vectorized pass"""
+    def __init__(self, ctfs=(), **params):
+        ctfs = list(ctfs)
+        n = max([len(ctfs)] + [np.size(v) for v in params.values()])
+        self.params = {}
+        for attr, default in CTF().get_dict().items():
+            if attr in params: vals = params[attr]
+            elif ctfs: vals = [getattr(ctf, attr) for ctf in ctfs]
+            else: vals = default
+            dtype = int if attr in ("imagesize", "over_sample") else float
+            self.params[attr] = np.broadcast_to(np.asarray(vals, dtype=dtype), (n,)).copy()
+
+    def __len__(self):
+        return len(self.params["defocus"])
+
+    def __getitem__(self, i):
+        return CTF(**{attr: vals[i].item() for attr, vals in self.params.items()})
+
+    def __str__(self):
+        return str(self.get_dict())
+
+    def __repr__(self):
+        return self.__str__()
+
+    def get_dict(self):
+        ret = {}
+        ret.update(self.params)
+        return ret
+
+    def varying_parameters(self):
+        if len(self)<2: return []
+        attrs = "voltage cs ampcontrast defocus dfdiff dfang phaseshift bfactor alpha cc dE dI dZ dXY imagesize over_sample".split()
+        return [attr for attr in attrs if np.std(self.params[attr])]
+
+    def varying_parameter_labels(self):
+        attrs = self.varying_parameters()
+        if attrs:
+            return ['/'.join([f'{attr}={self.params[attr][i].item()}' for attr in attrs]) for i in range(len(self))]
+        else:
+            return [f'{i+1}' for i in range(len(self))]
+
+    def groups(self, attrs=("imagesize", "over_sample")):
+        # members that share the same frequency axis/grid can be stacked and evaluated together
+        keys = np.stack([self.params[attr] for attr in attrs], axis=-1)
+        ret = {}
+        for i, key in enumerate(map(tuple, keys.tolist())):
+            ret.setdefault(key, []).append(i)
+        return {key: np.array(indices) for key, indices in ret.items()}
+
+    def broadcast_params(self, indices, ndim=1, dtype=None):
+        # reshape each parameter array of the selected members to (n,1,...) to broadcast against a frequency axis/grid
+        shape = (-1,) + (1,)*ndim
+        ret = {attr: vals[indices].reshape(shape) for attr, vals in self.params.items()}
+        if dtype is not None:
+            ret = {attr: vals.astype(dtype) if vals.dtype.kind == 'f' else vals for attr, vals in ret.items()}
+        return ret
+
+    def ctf_at(self, s, abs):
+        # the 1D CTF of each member at its own frequencies s: (n, m) array, nan allowed
+        s = np.asarray(s, dtype=float)
+        return ctf_formula(s, s*s, abs, self.broadcast_params(np.arange(len(self))))
+
+    def zeros(self, K=None, s_max=None, plot_s2=False):
+        """s (or s^2 if plot_s2) of the first K zeros of the 1D CTF of each member, computed in closed form as gamma is a
+        quadratic function of s^2. Returns a (n, K) array padded with nan. K=None: all zeros up to s_max"""
+        x_max = np.inf if s_max is None else s_max*s_max
+        x = gamma_roots(*gamma_coefficients(self.params), 0, K, x_max)
+        return x if plot_s2 else np.sqrt(x)
+
+    def extrema(self, K=None, s_max=None, plot_s2=False):
+        """s (or s^2 if plot_s2) of the first K extrema (peaks of |CTF|) of the 1D CTF of each member, padded with nan:
+        where gamma = pi/2 + k*pi, and where gamma itself has its extremum (x=-b/(2a)) if that is at s>0"""
+        x_max = np.inf if s_max is None else s_max*s_max
+        a, b, phi = gamma_coefficients(self.params)
+        x = gamma_roots(a, b, phi, np.pi/2, K, x_max)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vertex = -b/(2*a)
+        vertex = np.where((vertex>0) & (vertex<=x_max), vertex, np.nan)
+        x = np.sort(np.concatenate([x, vertex[:, None]], axis=1), axis=1)
+        if K is not None: x = x[:, :K]
+        return x if plot_s2 else np.sqrt(x)
+
+    def envelope_resolution(self, threshold=0.1, s_max=1.0, n=1024):
+        """s where the envelope of each member first falls below threshold, nan if it does not before s_max"""
+        p = self.broadcast_params(np.arange(len(self)))
+        s = np.linspace(0, s_max, n+1)
+        env = ctf_envelope(s, s*s, p)
+        if env is None: return np.full(len(self), np.nan)
+        below = np.abs(np.broadcast_to(env, (len(self), n+1))) < threshold
+        i = np.argmax(below, axis=1)
+        lo, hi = s[np.maximum(i-1, 0)], s[i]
+        for _ in range(40):     # bisection between the last sample above and the first sample below the threshold
+            mid = (lo+hi)/2
+            mid_below = np.abs(np.broadcast_to(ctf_envelope(mid[:, None], (mid*mid)[:, None], p), (len(self), 1))[:, 0]) < threshold
+            lo, hi = np.where(mid_below, lo, mid), np.where(mid_below, mid, hi)
+        return np.where(below.any(axis=1), hi, np.nan)
+
+    def _zero_spacings(self, apix, plot_s2=False):
+        # zeros up to Nyquist and the spacing to the next zero (half of the local period of the rings), for the
+        # smallest and the largest defocus of astigmatic CTFs
+        s_nyquist = 1./(2*apix)
+        for sign in (-1, 1):
+            p = dict(self.params, defocus=self.params["defocus"] + sign*np.abs(self.params["dfdiff"])/2)
+            z = gamma_roots(*gamma_coefficients(p), 0, None, s_nyquist*s_nyquist)
+            if not plot_s2: z = np.sqrt(z)
+            yield z[:, :-1], np.diff(z, axis=1)
+
+    def sampling_interval(self, apix, plot_s2=False):
+        # the pixel size of the 1D/2D CTF in 1/Å, or 1/Å^2 if plot_s2
+        s_nyquist = 1./(2*apix)
+        n = self.params["imagesize"]//2*self.params["over_sample"]
+        return s_nyquist*s_nyquist/n if plot_s2 else s_nyquist/n
+
+    def aliasing_resolution(self, apix, samples_per_period=2, plot_s2=False):
+        """s beyond which the rings of each member are sampled by fewer than samples_per_period pixels per period at its
+        imagesize/over_sample, nan if all rings up to Nyquist are sampled finely enough"""
+        ds = self.sampling_interval(apix, plot_s2)[:, None]
+        ret = np.full(len(self), np.inf)
+        for z, spacing in self._zero_spacings(apix, plot_s2):
+            with np.errstate(invalid='ignore'):
+                aliased = 2*spacing < samples_per_period*ds
+            first = z[np.arange(len(self)), np.argmax(aliased, axis=1)]
+            ret = np.minimum(ret, np.where(aliased.any(axis=1), first, np.inf))
+        if plot_s2: ret = np.sqrt(ret)
+        return np.where(np.isinf(ret), np.nan, ret)
+
+    def min_over_sample(self, apix, samples_per_period=2, plot_s2=False):
+        # the smallest over_sample of each member that samples all rings up to Nyquist without aliasing
+        ds = self.sampling_interval(apix, plot_s2) * self.params["over_sample"]
+        spacing = np.full(len(self), np.inf)
+        for _, d in self._zero_spacings(apix, plot_s2):
+            if d.shape[1] == 0: continue
+            # not nanmin(..., initial=np.inf), which needs numpy >= 1.22
+            spacing = np.minimum(spacing, np.min(np.where(np.isnan(d), np.inf, d), axis=1))
+        return np.maximum(1, np.ceil(samples_per_period*ds/(2*spacing))).astype(int)
+
+    @result_cache.memoize
+    def ctf1d(self, apix, abs, plot_s2=False, defocus_override=None):
+        ret = [None] * len(self)
+        for (imagesize, over_sample), indices in self.groups().items():
+            s, s2 = ctf1d_axis(apix, imagesize, over_sample, plot_s2)
+            p = self.broadcast_params(indices)
+            if defocus_override is not None:
+                p["defocus"] = np.broadcast_to(np.asarray(defocus_override, dtype=float), (len(self),))[indices].reshape(-1, 1)
+            ctf = ctf_formula(s, s2, abs, p, cache=get_envelope_cache())
+            for row, i in enumerate(indices):
+                ret[i] = (s, s2, ctf[row])
+        return ret
+
+    @result_cache.memoize
+    def ctf1d_rotavg(self, apix, abs, plot_s2=False, n_angles=360):
+        # rotational average of the 2D CTFs on the ctf1d axis, computed as the mean of the 1D CTFs
+        # of the defocuses along n_angles directions, i.e. without computing the 2D CTFs
+        ret = [None] * len(self)
+        theta = np.arange(n_angles).reshape(1, -1, 1) * np.pi/n_angles   # defocus2d has a period of 180°
+        for (imagesize, over_sample), indices in self.groups().items():
+            s, s2 = ctf1d_axis(apix, imagesize, over_sample, plot_s2)
+            p = self.broadcast_params(indices, ndim=2)
+            defocus = p["defocus"] + p["dfdiff"]/2*np.cos( 2*(theta-p["dfang"]*np.pi/180.))
+            ctf = ctf_formula(s, s2, abs, dict(p, defocus=defocus), defocus_alpha=p["defocus"], cache=get_envelope_cache()).mean(axis=1)
+            for row, i in enumerate(indices):
+                ret[i] = (s, s2, ctf[row])
+        return ret
+
+    @result_cache.memoize
+    def psf1d(self, apix, abs, defocus_override=None):
+        ret = [None] * len(self)
+        for (imagesize,), indices in self.groups(attrs=("imagesize",)).items():
+            s, s2 = psf1d_axis(apix, imagesize)
+            p = self.broadcast_params(indices)
+            if defocus_override is not None:
+                p["defocus"] = np.broadcast_to(np.asarray(defocus_override, dtype=float), (len(self),))[indices].reshape(-1, 1)
+            ctf = ctf_formula(s, s2, abs, p, cache=get_envelope_cache())
+            psf = np.abs( np.fft.ifft( np.fft.ifftshift(ctf, axes=-1), axis=-1 ) )
+            psf = np.fft.fftshift(psf, axes=-1)
+            psf /= np.linalg.norm(psf, ord=2, axis=-1, keepdims=True)
+            x = (np.arange(imagesize)-imagesize//2) * apix
+            for row, i in enumerate(indices):
+                ret[i] = (x, psf[row])
+        return ret
+
+    @result_cache.memoize
+    def ctf2d(self, apix, abs, plot_s2=False, lut_tolerance=1e-4, dtype=np.float64, memory_budget=None, layout="centered"):
+        # layout: "centered" for display, or "rfft" for the half-plane used by apply_ctf()
+        # lut_tolerance: max abs error allowed for the radial lookup table used for non-astigmatic CTFs. 0/None to disable the lookup table
+        # dtype: np.float64 or np.float32, used for both the computation and the returned images
+        # memory_budget: max bytes for the returned images plus the working arrays. Grids too large for it are computed in tiles of rows
+        dtype = np.dtype(dtype)
+        if memory_budget is None: memory_budget = get_memory_budget()
+        groups = self.groups()
+        sizes = {key: key[0]*key[1] for key in groups}
+        ncols = {key: sizes[key]//2+1 if layout == "rfft" else sizes[key] for key in groups}
+        output_bytes = sum(len(indices)*sizes[key]*ncols[key] for key, indices in groups.items()) * dtype.itemsize
+        row_bytes = max(sizes.values()) * dtype.itemsize * CTF2D_TEMPORARIES   # working memory needed per row of a tile
+        if output_bytes + row_bytes > memory_budget:
+            raise CTFMemoryError(f"{len(self)} 2D CTF(s) of {'/'.join(f'{n}x{n}' for n in sorted(set(sizes.values())))} pixels in {dtype.name} need {output_bytes/2**20:.0f} MB, more than the memory budget of {memory_budget/2**20:.0f} MB")
+        work_bytes = memory_budget - output_bytes
+
+        grid_cache = get_frequency_grid_cache()
+        ret = [None] * len(self)
+        for (imagesize, over_sample), indices in groups.items():
+            grid = grid_cache.get(imagesize, over_sample, apix, plot_s2, dtype, layout)
+            n = grid.shape[0]
+            output = np.empty((len(indices),)+grid.shape, dtype=dtype)
+            for row, i in enumerate(indices):
+                ret[i] = (grid.ds, grid.ds2, output[row])
+
+            lut = None
+            rows_lut = np.zeros(0, dtype=int)
+            rows_direct = np.arange(len(indices))
+            if lut_tolerance:
+                symmetric = self.params["dfdiff"][indices] == 0
+                if np.any(symmetric):
+                    lut = ctf2d_radial_lookup_table(grid, self.broadcast_params(indices[symmetric]), abs, lut_tolerance)
+                    if lut is not None:
+                        rows_lut, rows_direct = np.nonzero(symmetric)[0], np.nonzero(~symmetric)[0]
+            if len(rows_direct): fields = ["s2", "s", "theta", "cos2theta", "sin2theta"]
+            else: fields = ["s2"] if plot_s2 else ["s2", "s"]
+            if len(fields) * grid.shape[0] * grid.shape[1] * dtype.itemsize <= grid_cache.max_bytes:
+                for name in fields: grid.get(name)   # cache the full grids. Otherwise each tile computes its own part
+
+            tile_rows = int(np.clip(work_bytes // row_bytes, 1, n))
+            chunk = int(np.clip(work_bytes // (row_bytes * tile_rows), 1, max(1, len(rows_direct))))
+            for r0 in range(0, n, tile_rows):
+                tile = grid.tile(r0, r0+tile_rows)
+                r1 = r0 + tile.shape[0]
+                if len(rows_lut):
+                    ctf2d_radial_lookup(tile.r, lut, abs, [output[row, r0:r1] for row in rows_lut])
+                for c0 in range(0, len(rows_direct), chunk):
+                    rows = rows_direct[c0:c0+chunk]
+                    p = self.broadcast_params(indices[rows], ndim=2, dtype=dtype)
+                    axis_key = ("ctf2d", imagesize, over_sample, apix, plot_s2, dtype.str, layout, r0, r1)
+                    output[rows, r0:r1] = ctf2d_formula(tile, p, abs, axis_key=axis_key)
+        return ret
+
+    @result_cache.memoize
+    def ctf2d_zoom(self, apix, abs, center, width, samples=256, plot_s2=False, dtype=np.float64, memory_budget=None):
+        """The 2D CTFs evaluated directly on samples x samples points of the square region of the given width around
+        center (axis 0, axis 1), both in 1/Å (1/Å^2 if plot_s2) like the axes of ctf2d(layout="centered"). A zoomed view at
+        any sampling costs O(samples^2) per CTF instead of a higher over_sample of the whole 2D CTF
+        Returns [(ds, ds2, ctf), ...] like ctf2d, ds/ds2 being the sampling of the region
+        """
+        dtype = np.dtype(dtype)
+        if memory_budget is None: memory_budget = get_memory_budget()
+        nbytes = (len(self) + CTF2D_TEMPORARIES) * samples * samples * dtype.itemsize
+        if nbytes > memory_budget:
+            raise CTFMemoryError(f"{len(self)} zoomed 2D CTF(s) of {samples}x{samples} pixels in {dtype.name} need {nbytes/2**20:.0f} MB, more than the memory budget of {memory_budget/2**20:.0f} MB")
+        d = width/samples
+        axes = [(np.arange(samples) - samples//2)*d + c for c in center]
+        grid = FrequencyGrid(int(self.params["imagesize"][0]), int(self.params["over_sample"][0]), apix, plot_s2, dtype, axes=axes)
+        ctfs = ctf2d_formula(grid, self.broadcast_params(np.arange(len(self)), ndim=2, dtype=dtype), abs)
+        ctfs = np.broadcast_to(ctfs, (len(self),)+grid.shape).astype(dtype)
+        return [(grid.ds, grid.ds2, ctf) for ctf in ctfs]
+
+    @result_cache.memoize
+    def psf1d_zoom(self, apix, abs, window, samples=512, defocus_override=None):
+        """The PSFs at samples points of x in [-window, window) Å, by zoom_dft of the CTF sampled on the imagesize*over_sample
+        points of the PSF frequency axis. window and samples set the extent and the sampling of the PSF, e.g. finer than
+        apix without computing more CTF samples, and over_sample extends the field of view (the PSF has a period of
+        imagesize*over_sample*apix Å). Normalized like psf1d: unit L2 norm over the field of view at apix Å/sample
+        Returns [(x, psf), ...]
+        """
+        ret = [None] * len(self)
+        dx = 2.*window/samples
+        x = (np.arange(samples) - samples//2) * dx
+        for (imagesize, over_sample), indices in self.groups().items():
+            s, s2 = psf1d_axis(apix, imagesize, over_sample)
+            ds = 1./(2*apix)/(imagesize//2*over_sample)
+            p = self.broadcast_params(indices)
+            if defocus_override is not None:
+                p["defocus"] = np.broadcast_to(np.asarray(defocus_override, dtype=float), (len(self),))[indices].reshape(-1, 1)
+            ctf = ctf_formula(s, s2, abs, p, cache=get_envelope_cache())
+            ctf = np.broadcast_to(ctf, (len(indices), len(s)))
+            psf = np.abs(zoom_dft(ctf, -(len(s)//2)*ds, ds, x[0], dx, samples))
+            psf /= np.sqrt(len(s) * np.sum(np.square(ctf, dtype=np.float64), axis=-1, keepdims=True))
+            for row, i in enumerate(indices):
+                ret[i] = (x, psf[row])
+        return ret
+
+    @result_cache.memoize
+    def psf2d(self, apix, abs, window, samples=256, dtype=np.float64, memory_budget=None):
+        """The 2D PSFs on samples x samples points of [-window, window) Å along both axes, by zoom_dft of the 2D CTFs
+        (ctf2d, layout="centered") along each axis. Normalized like psf1d_zoom. Returns [(dx, psf), ...]
+        """
+        if memory_budget is None: memory_budget = get_memory_budget()
+        dx = 2.*window/samples
+        x0 = -(samples//2) * dx
+        ret = []
+        for ds, _, ctf in self.ctf2d(apix, abs, plot_s2=False, dtype=dtype, memory_budget=memory_budget, layout="centered"):
+            n = ctf.shape[0]
+            s0 = -(n//2) * ds
+            # axis 1 first, in chunks of rows that keep the complex work arrays of zoom_dft within a quarter of the budget
+            rows = int(np.clip(memory_budget//4 // (4 * 16 * (n+samples)), 1, n))
+            half = np.concatenate([zoom_dft(ctf[r0:r0+rows], s0, ds, x0, dx, samples, axis=1) for r0 in range(0, n, rows)])
+            psf = np.abs(zoom_dft(half, s0, ds, x0, dx, samples, axis=0))
+            psf /= np.sqrt(ctf.size * np.sum(np.square(ctf, dtype=np.float64)))
+            ret.append((dx, psf.astype(dtype)))
+        return ret
+
+def ctf2d_formula(grid, p, abs, axis_key=None):
+    # the 2D CTFs of the members p ((n,1,1) arrays) on a FrequencyGrid or a tile of it
+    dfang2 = 2*p["dfang"]*np.pi/180.
+    # cos(2*(theta-dfang)) expanded to use the cached cos/sin(2*theta) grids
+    defocus2d = p["defocus"] + p["dfdiff"]/2*(grid.cos2theta*np.cos(dfang2) + grid.sin2theta*np.sin(dfang2))
+    return ctf_formula(grid.s, grid.s2, abs, dict(p, defocus=defocus2d), defocus_alpha=p["defocus"], cache=get_envelope_cache(), axis_key=axis_key)
+
+CTF2D_TEMPORARIES = 12  # number of grid-sized arrays alive at the same time while evaluating a 2D CTF
+
+class CTFMemoryError(MemoryError):
+    pass
+
+def get_memory_budget():
+    return int(float(os.environ.get("CTF_MEMORY_BUDGET_MB", 1024))*2**20)
+
+def radial_lookup_table(func, rmax, tolerance, n=256, n_max=1<<16):
+    """Sample func(r) on [0, rmax] finely enough that linear interpolation between the samples is accurate to within tolerance.
+    Returns None if more than n_max samples would be needed
+    """
+    while n <= n_max:
+        r = np.linspace(0, rmax, n+1)
+        f = func(r)
+        err = np.max(np.abs(func((r[:-1]+r[1:])/2) - (f[..., :-1]+f[..., 1:])/2))
+        if err <= tolerance: return r, f
+        n = int(n * min(16, max(2, np.ceil(np.sqrt(err/tolerance)))))
+    return None
+
+def ctf2d_radial_lookup_table(grid, p, abs, tolerance):
+    # p: parameters of n rotationally symmetric CTFs as (n,1) arrays
+    def ctf_profile(r_lut):
+        if grid.plot_s2: s_lut, s2_lut = np.sqrt(r_lut), r_lut
+        else: s_lut, s2_lut = r_lut, r_lut*r_lut
+        return ctf_formula(s_lut, s2_lut, 0, p, cache=get_envelope_cache())    # interpolate the signed CTF to avoid the kinks of |CTF| at the zeros
+    n_max = min(1<<16, grid.shape[0]*grid.shape[1]//16)
+    lut = radial_lookup_table(ctf_profile, grid.rmax, tolerance/2 if abs>=2 else tolerance, n_max=n_max)
+    if lut is None: return None
+    r_lut, ctf_lut = lut
+    return r_lut[-1], ctf_lut.astype(grid.dtype)
+
+def ctf2d_radial_lookup(r, lut, abs, outputs):
+    # fill each of the outputs by linear interpolation of the corresponding lookup table at the radius r
+    rmax, ctf_lut = lut
+    n_lut = ctf_lut.shape[-1]-1
+    x = r * (n_lut/rmax)
+    i0 = np.minimum(x.astype(np.intp), n_lut-1)
+    w1 = x - i0
+    for f, ctf in zip(ctf_lut, outputs):
+        np.multiply(f[i0], 1-w1, out=ctf)
+        ctf += f[i0+1]*w1
+        if abs>=2: ctf *= ctf
+        elif abs==1: np.abs(ctf, out=ctf)
+
+@result_cache.memoize
+def normalize(data, percentile=(0, 100)):
+    p0, p1 = percentile
+    vmin, vmax = sorted(np.percentile(data, (p0, p1)))
+    data2 = (data-vmin)/(vmax-vmin)
+    return data2
+
+def resample_image(image, shape):
+    # one step of anti-aliased bilinear resampling with the pixel centers aligned, like skimage.transform.resize(anti_aliasing=True)
+    shape = tuple(shape)
+    if image.shape == shape: return image
+    from scipy import ndimage
+    zoom = [n/m for m, n in zip(image.shape, shape)]
+    sigma = [max(0., (1/z-1)/2) for z in zoom]
+    if any(sigma): image = ndimage.gaussian_filter(image, sigma, mode="mirror")
+    return ndimage.zoom(image, zoom, order=1, mode="nearest", grid_mode=True)
+
+class ImagePyramid:
+    """Copies of an image at 1/2, 1/4, ... of its size (2x2 block means), from which an image of any size is resampled in one
+    step from the smallest level that is at least as large. The resampled images are cached by size and dtype, so that the
+    CTFs with the same image size share one copy of the input image"""
+    def __init__(self, image, min_size=16, max_cached=8):
+        self.levels = [np.asarray(image)]
+        while min(self.levels[-1].shape) >= 2*min_size:
+            level = self.levels[-1]
+            h, w = level.shape[0]//2*2, level.shape[1]//2*2
+            self.levels.append(level[:h, :w].reshape(h//2, 2, w//2, 2).mean(axis=(1, 3)))
+        self.max_cached = max_cached
+        self.resized = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def shape(self):
+        return self.levels[0].shape
+
+    def resize(self, shape, dtype=None):
+        # read-only image of the given shape
+        shape = tuple(int(n) for n in shape)
+        dtype = np.dtype(dtype or self.levels[0].dtype)
+        key = (shape, dtype.str)
+        with self.lock:
+            if key in self.resized:
+                self.resized.move_to_end(key)
+                return self.resized[key]
+        level = self.levels[0]
+        for candidate in self.levels[1:]:
+            if candidate.shape[0] < shape[0] or candidate.shape[1] < shape[1]: break
+            level = candidate
+        image = resample_image(level, shape).astype(dtype)  # always a copy: the levels are not exposed
+        image.setflags(write=False)
+        with self.lock:
+            self.resized[key] = image
+            while len(self.resized) > self.max_cached: self.resized.popitem(last=False)
+        return image
+
+def apply_ctf(image, ctf, workers=-1):
+    """Apply a 2D CTF in the "rfft" layout (see CTFSet.ctf2d) to a real image using real-input FFTs
+    workers: number of threads used by the FFTs. -1 to use all cpus
+    """
+    from scipy import fft
+    image_fft = fft.rfft2(image, workers=workers)
+    image_fft *= ctf
+    return np.abs(fft.irfft2(image_fft, s=image.shape, workers=workers))
+
+def iter_apply_ctfs(image, ctfs, workers=-1):
+    """Apply several 2D CTFs in the "rfft" layout to the same real image: the image is transformed once and the filtered
+    spectra are transformed back in batched multithreaded inverse FFTs. Yields (k, (n, ny, nx) stack of the images of
+    ctfs[k:k+n]) for each batch, so that the caller does not need to keep all images. The batches are kept within half
+    of the memory budget
+    """
+    from scipy import fft
+    image_fft = fft.rfft2(image, workers=workers)
+    batch = max(1, get_memory_budget()//2//(2*image_fft.nbytes))    # the spectra and the output of irfft2
+    for b0 in range(0, len(ctfs), batch):
+        b1 = min(b0+batch, len(ctfs))
+        spectra = np.empty((b1-b0,) + image_fft.shape, dtype=image_fft.dtype)
+        for k in range(b0, b1):
+            np.multiply(image_fft, ctfs[k], out=spectra[k-b0])
+        images = fft.irfft2(spectra, s=image.shape, axes=(-2, -1), workers=workers, overwrite_x=True)
+        del spectra
+        yield b0, np.abs(images, out=images)
+
+def apply_ctfs(image, ctfs, workers=-1):
+    """The (len(ctfs), ny, nx) stack of the images of iter_apply_ctfs(). The stack has to fit in the other half of the
+    memory budget, otherwise CTFMemoryError is raised
+    """
+    dtype = np.result_type(image.dtype, np.float32)
+    output_bytes = len(ctfs) * image.size * dtype.itemsize
+    memory_budget = get_memory_budget()
+    if output_bytes > memory_budget//2:
+        raise CTFMemoryError(f"{len(ctfs)} image(s) of {image.shape[0]}x{image.shape[1]} pixels in {dtype.name} need {output_bytes/2**20:.0f} MB, more than half of the memory budget of {memory_budget/2**20:.0f} MB")
+    output = np.empty((len(ctfs),) + image.shape, dtype=dtype)
+    for b0, images in iter_apply_ctfs(image, ctfs, workers):
+        output[b0:b0+len(images)] = images
+    return output
+
+@result_cache.memoize
+def compute_radial_profile(image, method="histogram", bin_width=1.0, weights=None):
+    # image: one image or a stack of images of the same shape
+    # method: "histogram" - exact average of the pixels in each radial bin of bin_width pixels, optionally weighted by weights
+    #         "interpolation" - mean of 360 angular samples on each integer radius
+    if method == "interpolation":
+        if image.ndim == 3: return np.array([compute_radial_profile(im, method=method) for im in image])
+        ny, nx = image.shape
+        rmax = min(nx//2, ny//2)+1
+
+        r = np.arange(0, rmax, 1, dtype=np.float32)
+        theta = np.arange(0, 360, 1, dtype=np.float32) * np.pi/180.
+        n_theta = len(theta)
+
+        theta_grid, r_grid = np.meshgrid(theta, r, indexing='ij', copy=False)
+        y_grid = ny//2 + r_grid * np.sin(theta_grid)
+        x_grid = nx//2 + r_grid * np.cos(theta_grid)
+
+        coords = np.vstack((y_grid.flatten(), x_grid.flatten()))
+
+        from scipy.ndimage.interpolation import map_coordinates
+        polar = map_coordinates(image, coords, order=1).reshape(r_grid.shape)
+
+        rad_profile = polar.mean(axis=0)
+        return rad_profile
+    elif method == "histogram":
+        images = image.reshape((-1,)+image.shape[-2:])
+        index, nbins = radial_bin_index(image.shape[-2:], bin_width)
+        if weights is None:
+            counts = np.bincount(index, minlength=nbins+1)
+        else:
+            counts = np.bincount(index, weights=weights.ravel(), minlength=nbins+1)
+            images = images * weights
+        # one bincount for all images by giving each image its own range of bins
+        index_stack = (index + (nbins+1)*np.arange(len(images))[:, None]).ravel()
+        sums = np.bincount(index_stack, weights=images.ravel(), minlength=len(images)*(nbins+1)).reshape(len(images), nbins+1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rad_profile = sums[:, :nbins] / counts[:nbins]   # nan for empty bins
+        return rad_profile.reshape(image.shape[:-2] + (nbins,))
+    else:
+        raise ValueError(f"unknown method {method}")
+
+@functools.lru_cache(maxsize=16)
+def radial_bin_index(shape, bin_width=1.0):
+    # the radial bin of each pixel (flattened). Bin i is centered at radius i*bin_width from the pixel (ny//2, nx//2)
+    # pixels beyond the largest full circle go to the extra bin nbins
+    ny, nx = shape
+    rmax = min(nx//2, ny//2)+1
+    nbins = int((rmax-1)/bin_width)+1
+    r = np.hypot(np.arange(ny)[:, None] - ny//2, np.arange(nx)[None, :] - nx//2)
+    index = np.minimum(np.floor(r/bin_width + 0.5).astype(np.intp), nbins).ravel()
+    index.setflags(write=False)
+    return index, nbins
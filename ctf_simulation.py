@@ -22,24 +22,11 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-def import_with_auto_install(packages, scope=locals()):
-    if isinstance(packages, str): packages=[packages]
-    for package in packages:
-        if package.find(":")!=-1:
-            package_import_name, package_pip_name = package.split(":")
-        else:
-            package_import_name, package_pip_name = package, package
-        try:
-            scope[package_import_name] = __import__(package_import_name)
-        except ImportError:
-            import subprocess
-            subprocess.call(f'pip install {package_pip_name}', shell=True)
-            scope[package_import_name] =  __import__(package_import_name)
-required_packages = "streamlit numpy scipy bokeh skimage:scikit_image".split()
-import_with_auto_install(required_packages)
-
 import streamlit as st
 import numpy as np
+import ctf_core, data_export, perf
+from ctf_core import CTF, CTFSet, CTFMemoryError, ImagePyramid, compute_radial_profile, iter_apply_ctfs, normalize
+from image_fetch import ImageFetchError
 
 def main():
     title = "CTF Simulation"
@@ -50,14 +37,16 @@ def main():
     if magic not in session_state:  # only run once at the start of the session
         st.session_state[magic] = True
         st._shown_default_value_warning = True
-        ctfs, plot_settings, embed = parse_query_parameters()
+        with perf.span("query_parsing"):
+            ctfs, plot_settings, embed = parse_query_parameters()
         session_state.plot_settings = plot_settings
         session_state.embed = embed
         if ctfs is not None: session_state.ctfs = ctfs
         if "ctfs" not in session_state:
             session_state.ctfs = [CTF()]
         session_state.n0 = len(session_state.ctfs)
-        update_session_state_from_ctfs()
+        with perf.span("session_state_sync"):
+            update_session_state_from_ctfs()
     plot_settings = session_state.plot_settings
     embed = session_state.embed
     ctfs = session_state.ctfs
@@ -98,7 +87,8 @@ def main():
                     if attr_i in session_state:
                         del session_state[attr_i]
         
-        update_ctfs_from_session_state()
+        with perf.span("session_state_sync"):
+            update_ctfs_from_session_state()
         assert(n == len(ctfs))
         if n>1:
             i = int(st.number_input('CTF i=?', value=1, min_value=1, max_value=n, step=1))
@@ -127,6 +117,8 @@ def main():
             if n==1 and ctfs[i].dfdiff:
                 value = ctf_type=='CTF^2'
                 rotavg = st.checkbox(label='plot rotational average', value=value)
+                if rotavg:
+                    rotavg_method = st.selectbox('rotational average method', options=('analytic', 'histogram', 'interpolation'), help="analytic: average of the 1D CTFs of the defocuses at 360 angles, without computing the 2D CTF. histogram: exact average of the pixels at each radius of the 2D CTF. interpolation: mean of 360 interpolated angular samples at each radius of the 2D CTF")
             else:
                 rotavg = False
             ctfs[i].dfang = st.number_input('astigmatism angle (°)', value=ctfs[i].dfang, min_value=0.0, max_value=360., step=1.0, format="%g", key=f"dfang_{i}")
@@ -153,15 +145,28 @@ def main():
         ctfs[i].voltage = st.number_input('voltage (kV)', value=ctfs[i].voltage, min_value=10., step=100., format="%g", key=f"voltage_{i}")
         ctfs[i].cs = st.number_input('cs (mm)', value=ctfs[i].cs, min_value=0.0, step=0.1, format="%g", key=f"cs_{i}")
         ctfs[i].ampcontrast = st.number_input('amplitude contrast (percent)', value=ctfs[i].ampcontrast, min_value=0.0, max_value=100., step=10.0, format="%g", key=f"ampcontrast_{i}")
+        if not embed:
+            aliasing_s = ctfs[i].aliasing_resolution(apix)
+            if not np.isnan(aliasing_s):
+                over_sample = ctfs[i].min_over_sample(apix)
+                fix = f"over-sample ≥{over_sample}" if over_sample<=6 else f"image size ≥{ctfs[i].imagesize*over_sample}"
+                st.warning(f"The CTF rings beyond {1/aliasing_s:.2f} Å are aliased. Use {fix} to avoid aliasing")
 
         if embed:
             show_1d = True
             show_2d = False
             show_psf = False
             show_marker = False
+            show_zeros = False
             plot_s2 = False
             show_data = False
+            float32 = False
+            psf_window, psf_samples, show_psf2d = 0., 512, False
+            ctf_zoom = None
+            sweeps = None
             share_url = False
+            show_perf = False
+            preview = bool(int(plot_settings.get("preview", 0)))
         else:
             value = int(plot_settings.get("show_1d", 1))
             show_1d = st.checkbox('show 1D CTF', value=value)
@@ -172,21 +177,51 @@ def main():
                 show_psf = st.checkbox('show point spread function', value=value)
                 value = int(plot_settings.get("show_marker", 0))
                 show_marker = st.checkbox(label='show markers on CTF line plots', value=value)
+                value = int(plot_settings.get("show_zeros", 0))
+                show_zeros = st.checkbox(label='mark CTF zeros and peaks', value=value, help="Mark the zeros and peaks of the 1D CTFs, computed exactly from the CTF formula, and the resolution where the envelope falls below 10%")
                 value = int(plot_settings.get("plot_s2", 0))
                 plot_s2 = st.checkbox(label='plot s^2 as x-axis/radius', value=value)
+                value = int(plot_settings.get("preview", 0))
+                preview = st.checkbox(label='instant preview in the browser', value=value, help=f"Add defocus, phase shift and b-factor sliders above the 1D CTF plot that recompute the curves of CTF {i+1} in the browser while dragging, without waiting for the server. Set the final values with the inputs above to update the other plots")
                 show_data = st.checkbox('Show CTF raw data', value=False)
             else:
                 show_2d = True
                 show_psf = False
                 show_marker = False
+                show_zeros = False
                 plot_s2 = False            
+                preview = False
+            psf_window, psf_samples, show_psf2d = 0., 512, False
+            if show_psf:
+                with st.beta_expander("point spread function", expanded=False):
+                    psf_window = st.number_input('PSF half-width (Å)', value=0.0, min_value=0.0, step=10.0, format="%g", help="Show the PSF on [-half-width, half-width) with the number of samples below, e.g. sampled finer than the pixel size. It is computed with a zoom FFT that only evaluates this window. 0: the whole image at the pixel size")
+                    psf_samples = int(st.number_input('PSF samples', value=512, min_value=16, max_value=8192, step=64))
+                    show_psf2d = st.checkbox('show 2D PSF', value=False, help="The 2D PSF on the same window, with at most 512x512 samples. The whole image if the half-width is 0")
+            ctf_zoom = None
+            if show_2d:
+                with st.beta_expander("2D CTF zoom", expanded=False):
+                    if st.checkbox('show a zoomed region of the 2D CTF', value=False, help="Evaluate the 2D CTF directly on a small region at any sampling, e.g. to inspect aliased rings, instead of increasing the over-sampling of the whole 2D CTF. The 2D CTF plot itself shows images larger than 1024x1024 pixels as block means"):
+                        unit = "1/Å^2" if plot_s2 else "1/Å"
+                        s_max = 1./(2*apix)**2 if plot_s2 else 1./(2*apix)
+                        zoom_x = st.number_input(f'zoom center x ({unit})', value=round(s_max*0.75, 4), step=s_max/20, format="%g")
+                        zoom_y = st.number_input(f'zoom center y ({unit})', value=0.0, step=s_max/20, format="%g")
+                        zoom_width = st.number_input(f'zoom width ({unit})', value=round(s_max/8, 4), min_value=1e-6, step=s_max/40, format="%g")
+                        zoom_samples = int(st.number_input('zoom samples', value=256, min_value=16, max_value=1024, step=32))
+                        ctf_zoom = (zoom_x, zoom_y, zoom_width, zoom_samples)
+            value = int(plot_settings.get("float32", 0))
+            float32 = st.checkbox(label='compute 2D CTFs in single precision', value=value, help="Use float32 instead of float64 to halve the memory needed for large image size/over-sample. It is also used automatically if float64 would exceed the memory budget")
+            with st.beta_expander("parameter sweep", expanded=False):
+                sweeps = get_sweep_settings(ctfs[i], i)
+                sweep_ctf = CTF(**ctfs[i].get_dict())
+            show_perf = st.checkbox('Show performance panel', value=False, help="Time and memory use of each stage of this rerun, e.g. computing the CTFs, fetching the image and sending the plots to the browser")
             share_url = st.checkbox('Show sharable URL', value=False, help="Include relevant parameters in the browser URL to allow you to share the URL and reproduce the plots")
             if share_url:
-                set_query_parameters(ctfs, ctf_type, apix, show_1d, show_2d, show_psf, plot_s2, show_marker)
+                set_query_parameters(ctfs, ctf_type, apix, show_1d, show_2d, show_psf, plot_s2, show_marker, float32, show_zeros, preview)
             else:
                 st.experimental_set_query_params()
 
-    ctf_labels = ctf_varying_parameter_labels(ctfs)
+    ctfset = CTFSet(ctfs)
+    ctf_labels = ctfset.varying_parameter_labels()
 
     if not embed:
         if show_1d:
@@ -205,10 +240,12 @@ def main():
             from bokeh.models import LegendItem
             if plot_s2:
                 x_label = "s^2 (1/Å^2)"
+                x_unit = "1/Å^2"
                 hover_x_var = "s^2"
                 hover_x_val = "$x 1/Å^2"
             else:
                 x_label = "s (1/Å)"
+                x_unit = "1/Å"
                 hover_x_var = "s"
                 hover_x_val = "$x 1/Å"
             y_label = f"{ctf_type}"
@@ -225,41 +262,73 @@ def main():
             colors = Category10[10]
             line_dashes = 'dashed solid dotted dotdash dashdot'.split()
 
+            signatures = [(ctf_signature(ctf), apix, plot_abs, plot_s2, n==1) for ctf in ctfs]   # n==1: the 3 defocuses of an astigmatic CTF
+            if n==1 and ctfs[0].dfdiff:
+                defocuses = [[ctfs[0].defocus - ctfs[0].dfdiff, ctfs[0].defocus, ctfs[0].defocus + ctfs[0].dfdiff]]
+                curves = reuse_panels("ctf1d", signatures, lambda indices: [CTFSet(ctfs*3).ctf1d(apix, plot_abs, plot_s2, defocus_override=defocuses[0])])
+            else:
+                defocuses = [[ctf.defocus] for ctf in ctfs]
+                curves = reuse_panels("ctf1d", signatures, lambda indices: [[curve] for curve in CTFSet([ctfs[j] for j in indices]).ctf1d(apix, plot_abs, plot_s2)])
+            if show_zeros:
+                landmarks_all = reuse_panels("landmarks", signatures, lambda indices: [[ctf_landmarks(CTF(**dict(ctfs[j].get_dict(), defocus=defocus)), plot_abs, curves[j][0][0][-1]) for defocus in defocuses[j]] for j in indices])
+
             legends = []
             raw_data = []
+            landmark_renderers = []
+            landmark_tables = []
+            preview_i = i   # the CTF selected in the sidebar
+            preview_sources = []
+            preview_hidden = []
             for i in range(n):
                 label0 = ctf_labels[i]
                 color = colors[ i % len(colors) ]
-                if n==1 and ctfs[i].dfdiff:
-                    defocuses = [ctfs[i].defocus - ctfs[i].dfdiff, ctfs[i].defocus, ctfs[i].defocus + ctfs[i].dfdiff]
-                else:
-                    defocuses = [ctfs[i].defocus]
-                for di, defocus in enumerate(defocuses):
-                    s, s2, ctf = ctfs[i].ctf1d(apix, plot_abs, plot_s2, defocus_override=defocus)
+                for di, defocus in enumerate(defocuses[i]):
+                    s, s2, ctf = curves[i][di]
                     x = s2 if plot_s2 else s
                     res = np.hstack(([1e6],  1/s[1:]))
                     source = dict(x=x, res=res, y=ctf)
                     if n>1 or (n==1 and ctfs[0].dfdiff): source["defocus"] = [defocus] * len(x)
-                    line_dash = line_dashes[di] if len(defocuses)>1 else "solid"
-                    line_width = 2 if len(defocuses)==1 or di==1 else 1
+                    line_dash = line_dashes[di] if len(defocuses[i])>1 else "solid"
+                    line_width = 2 if len(defocuses[i])==1 or di==1 else 1
                     line = fig.line(x='x', y='y', color=color, source=source, line_dash=line_dash, line_width=line_width)
                     if show_marker:
-                        fig.circle(x='x', y='y', color=color, source=source)
-                    if len(defocuses)>1:
+                        fig.circle(x='x', y='y', color=color, source=line.data_source)
+                    if preview and i == preview_i:
+                        preview_sources.append((line.data_source, defocus - ctfs[i].defocus))
+                    if show_zeros:
+                        landmarks = landmarks_all[i][di]
+                        landmark_source = dict(x=landmarks["s"]**2 if plot_s2 else landmarks["s"], y=landmarks["ctf"], res=1/landmarks["s"], feature=landmarks["feature"], marker=landmarks["marker"])
+                        landmark_renderers.append(fig.scatter(x='x', y='y', marker='marker', size=10, line_color=color, fill_color=None, source=landmark_source))
+                        if preview and i == preview_i: preview_hidden.append(landmark_renderers[-1])
+                        if not np.isnan(landmarks["envelope"]) and (len(defocuses[i])==1 or di==1):
+                            from bokeh.models import Span
+                            x_env = landmarks["envelope"]**2 if plot_s2 else landmarks["envelope"]
+                            span = Span(location=x_env, dimension='height', line_color=color, line_dash='dotted', line_width=2)
+                            fig.add_layout(span)
+                            if preview and i == preview_i: preview_hidden.append(span)
+                    if len(defocuses[i])>1:
                         label = f"defocus={round(defocus, 4):g} µm"
                     else:
                         label = label0
                     legends.append(LegendItem(label=label, renderers=[line]))
                     if show_data:
-                        if len(ctfs)>1 or len(defocuses)>1:
+                        if len(ctfs)>1 or len(defocuses[i])>1:
                             label = f"{y_label} ({label})"
                         else:
                             label = f"{y_label}"
-                        raw_data.append((label, s, x, ctf))
+                        raw_data.append(("ctf", label, x_unit, x, s, ctf))
+                        if show_zeros: landmark_tables.append((label, x_unit, landmarks))
 
+                rad_profile = None
                 if n==1 and rotavg:
-                    _, _, ctf_2d = ctfs[i].ctf2d(apix, plot_abs, plot_s2)
-                    rad_profile = compute_radial_profile(ctf_2d)
+                    def compute_rotavg(indices):
+                        if rotavg_method == 'analytic':
+                            return [ctfs[i].ctf1d_rotavg(apix, plot_abs, plot_s2)[2]]
+                        ctf2ds_rotavg = compute_ctf2ds(ctfset, apix, plot_abs, plot_s2, float32)
+                        if ctf2ds_rotavg is None: return [None]
+                        return [compute_radial_profile(ctf2ds_rotavg[0][2], method=rotavg_method)]
+                    rad_profile = reuse_panels("rotavg", [signatures[i] + (rotavg_method, float32)], compute_rotavg)[0]
+                if rad_profile is not None:
                     x = s2 if plot_s2 else s
                     source = dict(x=x, res=1/s, y=rad_profile)
                     line = fig.line(x='x', y='y', source=source, color='red', line_dash="solid", line_width=2)
@@ -267,8 +336,13 @@ def main():
                     legends.append(LegendItem(label=label, renderers=[line]))
                     if show_data:
                         label = f"{y_label} ({label})"
-                        raw_data.append((label, s, x, rad_profile))
+                        raw_data.append(("rotavg", label, x_unit, x, s, rad_profile))
 
+            if landmark_renderers:
+                from bokeh.models.tools import HoverTool
+                fig.hover[0].renderers = [r for r in fig.renderers if r not in landmark_renderers]
+                landmark_tips = [("", "@feature"), ("Res", "@res Å"), (hover_x_var, hover_x_val), (f"{ctf_type}", "@y")]
+                fig.add_tools(HoverTool(renderers=landmark_renderers, tooltips=landmark_tips))
             fig.x_range.start = 0
             fig.x_range.end = source['x'][-1]
             fig.y_range.start = -1 if ctf_type == 'CTF' else 0
@@ -289,7 +363,10 @@ def main():
                     }
                 """)
                 fig.js_on_event(DoubleTap, toggle_legend_js)
-            st.bokeh_chart(fig, use_container_width=True)
+            if preview_sources:
+                bokeh_chart(client_side_ctf_preview(fig, preview_sources, ctfs[preview_i], plot_abs, plot_s2, hidden=preview_hidden))
+            else:
+                bokeh_chart(fig)
 
             if not embed:
                 if show_psf:
@@ -301,12 +378,19 @@ def main():
                     fig.title.align = "center"
                     fig.title.text_font_size = "18px"     
                     legends = []           
+                    signatures = [(ctf_signature(ctf), apix, plot_abs, psf_window, psf_samples) for ctf in ctfs]
+                    if psf_window:
+                        psfs = reuse_panels("psf1d", signatures, lambda indices: CTFSet([ctfs[j] for j in indices]).psf1d_zoom(apix, plot_abs, psf_window, psf_samples))
+                    else:
+                        psfs = reuse_panels("psf1d", signatures, lambda indices: CTFSet([ctfs[j] for j in indices]).psf1d(apix, abs=plot_abs))
                     for i in range(n):
-                        x_psf, psf = ctfs[i].psf1d(apix, abs=plot_abs)
+                        x_psf, psf = psfs[i]
                         source = dict(x=x_psf, y=psf)
                         if n>1: source["defocus"] = [ctfs[i].defocus] * len(x_psf)
                         line = fig.line(x='x', y='y', source=source, line_width=2, color=colors[i%len(colors)])
                         legends.append(LegendItem(label=ctf_labels[i], renderers=[line]))
+                        if show_data:
+                            raw_data.append(("psf", f"PSF of {y_label} ({ctf_labels[i]})" if n>1 else f"PSF of {y_label}", "Å", x_psf, None, psf))
                     if len(legends)>1:
                         from bokeh.models import Legend
                         legend = Legend(items=legends, location="top_center", spacing=10, orientation="horizontal")
@@ -324,38 +408,62 @@ def main():
                         """)
                         fig.js_on_event(DoubleTap, toggle_legend_js)
                     st.text("") # workaround for a layout bug in streamlit 
-                    st.bokeh_chart(fig, use_container_width=True)
+                    bokeh_chart(fig)
+
+                if show_psf and show_psf2d:
+                    dtype = np.float32 if float32 else np.float64
+                    signatures = [(ctf_signature(ctf), apix, plot_abs, psf_window, psf_samples, float32) for ctf in ctfs]
+                    def compute_psf2d(indices):
+                        values = []
+                        for j in indices:
+                            window = psf_window or ctfs[j].imagesize*apix/2
+                            try:
+                                dx, psf2d = ctfs[j].psf2d(apix, plot_abs, window, min(psf_samples, 512), dtype=dtype)
+                            except CTFMemoryError as err:
+                                st.warning(f"{err}. Please reduce the image size/over-sample or use single precision")
+                                values.append(None)
+                                continue
+                            values.append(dict(dx=dx, display=image_display_data(psf2d)))
+                        return values
+                    psf2ds = reuse_panels("psf2d", signatures, compute_psf2d)
+                    fig2ds = []
+                    for i in range(n):
+                        if psf2ds[i] is None: continue
+                        title = f"2D PSF - {i+1}" if n>1 else "2D PSF"
+                        fig2ds.append(generate_image_figure(psf2ds[i]["display"], dxy=psf2ds[i]["dx"], ctf_type=None, title=title))
+                    if len(fig2ds)>1:
+                        from bokeh.layouts import gridplot
+                        bokeh_chart(gridplot(children=[fig2ds], toolbar_location=None))
+                    elif fig2ds:
+                        bokeh_chart(fig2ds[0])
 
                 if show_data:
                     import pandas as pd
-                    for i, (col3_label, s, x, ctf) in enumerate(raw_data):
-                        columns = [x_label, "Res (Å)", col3_label]
-                        maxlen = max(map(len, columns))
-                        columns = [col.rjust(maxlen+10) for col in columns]
-                        data = np.zeros((len(x), 3))
-                        data[:,0] = x
-                        data[:,1] = 1./s
-                        data[:,2] = ctf
-                        df = pd.DataFrame(data, columns=columns)
-                        st.dataframe(df, width=None)
-                        label = f"Download the data - {col3_label}"
-                        st.markdown(get_table_download_link(df, label=label), unsafe_allow_html=True)
+                    # one long table of all curves and zeros/peaks, and one file of it generated only when requested
+                    df = pd.DataFrame(data_export.curves_table(raw_data, landmark_tables))
+                    st.dataframe(df, width=None)
+                    download_widget("the CTF data", data_export.table_formats(), lambda fmt: data_export.export_table(df, fmt), "ctf_data", key="export_curves")
 
+    ctf2ds = None
     if show_2d and not embed:
         with col3:
             st.text("") # workaround for a layout bug in streamlit 
+            signatures = [(ctf_signature(ctf), apix, plot_abs, plot_s2, float32) for ctf in ctfs]
+            ctf2ds = reuse_panels("ctf2d", signatures, lambda indices: ctf2d_panels(CTFSet([ctfs[j] for j in indices]), apix, plot_abs, plot_s2, float32))
+            if any(panel is None for panel in ctf2ds): ctf2ds = None
 
+    if ctf2ds is not None:
+        with col3:
             show_color = False
 
             fig2ds = []
             for i in range(n):
-                ds, ds2, ctf_2d = ctfs[i].ctf2d(apix, plot_abs, plot_s2)
-                dxy = ds2 if plot_s2 else ds
+                dxy = ctf2ds[i]["ds2"] if plot_s2 else ctf2ds[i]["ds"]
                 if n>1:
                     title = f"{ctf_type} - {i+1}"
                 else:
                     title = f"{ctf_type}"
-                fig2d = generate_image_figure(ctf_2d, dxy, ctf_type, title, plot_s2, show_color)
+                fig2d = generate_image_figure(ctf2ds[i]["display"], dxy, ctf_type, title, plot_s2, show_color)
                 fig2ds.append(fig2d)
             if len(fig2ds)>1:
                 from bokeh.models import CrosshairTool
@@ -364,24 +472,53 @@ def main():
                 for fig in fig2ds: fig.add_tools(crosshair)
                 from bokeh.layouts import gridplot
                 figs_grid = gridplot(children=[fig2ds], toolbar_location=None)
-                st.bokeh_chart(figs_grid, use_container_width=True)
+                bokeh_chart(figs_grid)
             else:
-                st.bokeh_chart(fig2d, use_container_width=True)
+                bokeh_chart(fig2d)
+            # the levels sent to the browser stop at max_size pixels per side: finer detail is evaluated on request by the zoom panel
+            factor = max(panel["display"]["levels"][-1][1] for panel in ctf2ds)
+            if factor>1 and not ctf_zoom:
+                shape = max((panel["shape"] for panel in ctf2ds), key=max)
+                st.markdown(f"*The {shape[0]}x{shape[1]} 2D CTF is shown at most as block means of {factor}x{factor} pixels, also when zoomed in. Use '2D CTF zoom' in the sidebar to see a region at the full or a finer sampling*")
+
+            if ctf_zoom:
+                zoom_x, zoom_y, zoom_width, zoom_samples = ctf_zoom
+                dtype = ctf2ds[0]["dtype"]
+                signatures = [(ctf_signature(ctf), apix, plot_abs, plot_s2, dtype, ctf_zoom) for ctf in ctfs]
+                # the display y axis is axis 0 of the 2D CTF
+                zooms = reuse_panels("ctf2d_zoom", signatures, lambda indices: [image_display_data(ctf) for _, _, ctf in CTFSet([ctfs[j] for j in indices]).ctf2d_zoom(apix, plot_abs, (zoom_y, zoom_x), zoom_width, zoom_samples, plot_s2, dtype)])
+                fig2ds = []
+                for i in range(n):
+                    title = f"{ctf_type} zoom - {i+1}" if n>1 else f"{ctf_type} zoom"
+                    fig2ds.append(generate_image_figure(zooms[i], zoom_width/zoom_samples, ctf_type, title, plot_s2, show_color, center=(zoom_x, zoom_y)))
+                if len(fig2ds)>1:
+                    from bokeh.layouts import gridplot
+                    bokeh_chart(gridplot(children=[fig2ds], toolbar_location=None))
+                else:
+                    bokeh_chart(fig2ds[0])
+
+            with st.beta_expander("Export the 2D CTFs"):
+                def export_ctf2ds(fmt):
+                    # the panels only keep the display levels: the full 2D CTFs are fetched again from the result cache or recomputed
+                    ctf2ds_full = CTFSet(ctfs).ctf2d(apix, plot_abs, plot_s2, dtype=ctf2ds[0]["dtype"])
+                    unit = "1/Å^2" if plot_s2 else "1/Å"
+                    labels = [f"ctfsimu: 2D {ctf_type}, pixel size {ctf2ds_full[0][1 if plot_s2 else 0]:g} {unit}"] + [f"{i+1}: {ctf_labels[i]}" for i in range(n)]
+                    return data_export.export_images([ctf_2d for _, _, ctf_2d in ctf2ds_full], fmt, labels=labels, names=[f"ctf_{i+1}" for i in range(n)])
+                download_widget("the 2D CTFs", data_export.image_formats([panel["shape"] for panel in ctf2ds]), export_ctf2ds, "ctf2d", key="export_ctf2d")
             
             with st.beta_expander("Simulate the CTF effect"):
                 input_modes = ["Delta Function"]
                 emdb_ids = get_emdb_ids()
                 input_modes += ["Random EMDB ID", "Input an EMDB ID"]
                 if "emd_id" not in session_state:
-                    import random
-                    session_state.emd_id = random.choice(emdb_ids)
+                    session_state.emd_id = emdb_ids.random_id()
                 input_modes += ["Input an image url"]
                 input_mode = st.radio(label="Choose an input mode:", options=input_modes, index=3)
                 if input_mode == "Random EMDB ID":
                     button_clicked = st.button(label="Change EMDB ID")
                     if button_clicked:
-                        import random
-                        session_state.emd_id = random.choice(emdb_ids)
+                        queue = session_state.emd_id_queue if "emd_id_queue" in session_state else []
+                        session_state.emd_id = queue.pop(0) if queue else emdb_ids.random_id()
                     input_txt = f"EMD-{session_state.emd_id}"
                 elif input_mode == "Input an EMDB ID":
                     emd_id = session_state.emd_id        
@@ -397,46 +534,90 @@ def main():
             image = None
             link = None
             if input_mode == "Delta Function":
-                image = np.zeros_like(ctf_2d)
+                image = np.zeros(ctf2ds[-1]["shape"])
                 ny, nx = image.shape
                 image[ny//2, nx//2] = 255
             elif emdb_ids and input_txt.startswith("EMD-"):
                 emd_id = input_txt[4:]
                 if emd_id in emdb_ids:
                     session_state.emd_id = emd_id
-                    image = get_emdb_image(emd_id, invert_contrast=-1, rgb2gray=True, output_shape=(ctfs[0].imagesize*ctfs[0].over_sample, ctfs[0].imagesize*ctfs[0].over_sample))
+                    try:
+                        image = get_emdb_image(emd_id, invert_contrast=-1, rgb2gray=True)
+                    except ImageFetchError as err:
+                        st.warning(f"EMD-{emd_id}: {err}")
                     link = f'[EMD-{emd_id}](https://www.emdataresource.org/EMD-{emd_id})'
+                    if input_mode == "Random EMDB ID":
+                        prefetch_random_emdb_images(emdb_ids)
                 else:
                     emd_id_bad = emd_id
-                    emd_id = random.choice(emdb_ids)
+                    emd_id = emdb_ids.random_id()
                     st.warning(f"EMD-{emd_id_bad} does not exist. Please input a valid id (for example, a randomly selected valid id {emd_id})")
             elif input_txt.startswith("http") or input_txt.startswith("ftp"):   # input is a url
                 url = input_txt
-                image = get_image(url, invert_contrast=0, rgb2gray=True, output_shape=(ctfs[0].imagesize*ctfs[0].over_sample, ctfs[0].imagesize*ctfs[0].over_sample))
-                if image is not None:
+                try:
+                    image = get_image(url, invert_contrast=0, rgb2gray=True)
                     image = image[::-1, :]
                     link = f'[Image Link]({url})'
-                else:
-                    st.warning(f"{url} is not a valid image link")
+                except ImageFetchError as err:
+                    st.warning(f"{url} is not a valid image link ({err})")
             elif len(input_txt):
                 st.warning(f"{input_txt} is not a valid image link")
             if image is not None:
                 if link: st.markdown(link, unsafe_allow_html=True)
                 image = normalize(image)
-                fig2d = generate_image_figure(image, dxy=1.0, ctf_type=None, title="Original Image", plot_s2=False, show_color=show_color)
-                st.bokeh_chart(fig2d, use_container_width=True)
+                image_key = (input_mode, "" if input_mode == "Delta Function" else input_txt, image.shape)
+                # the input image at its original size, resized for each CTF from the nearest level of the pyramid
+                pyramid = reuse_panels("image_pyramid", [image_key], lambda indices: [ImagePyramid(image)])[0]
+                shape0 = (ctfs[0].imagesize*ctfs[0].over_sample, ctfs[0].imagesize*ctfs[0].over_sample)
+                display = reuse_panels("image", [image_key + (shape0,)], lambda indices: [image_display_data(pyramid.resize(shape0))])[0]
+                fig2d = generate_image_figure(display, dxy=1.0, ctf_type=None, title="Original Image", plot_s2=False, show_color=show_color)
+                bokeh_chart(fig2d)
+
+                dtype = ctf2ds[0]["dtype"]
+                def simulated_images(indices):
+                    # yields (k, the simulated image of CTF indices[k]) one group of image sizes at a time. CTFs that do not fit in the memory budget are skipped
+                    try:
+                        ctf_rffts = CTFSet([ctfs[j] for j in indices]).ctf2d(apix, abs=plot_abs, plot_s2=False, dtype=dtype, layout="rfft")
+                    except CTFMemoryError as err:
+                        if len(indices) == 1:
+                            st.warning(f"{err}. Please reduce the image size/over-sample or use single precision")
+                            return
+                        # more CTFs may be recomputed together here than in the 2D CTF panel: fall back to one CTF at a time
+                        st.warning(f"{err}. The images are simulated one CTF at a time")
+                        for k, j in enumerate(indices):
+                            for _, image2 in simulated_images([j]):
+                                yield k, image2
+                        return
+                    # the CTFs with the same image size are applied together: one FFT of the input image, batched inverse FFTs
+                    groups = {}
+                    for k, j in enumerate(indices):
+                        groups.setdefault(ctfs[j].imagesize*ctfs[j].over_sample, []).append(k)
+                    for size, ks in groups.items():
+                        with perf.span("resize", size=size):
+                            image_work = pyramid.resize((size, size), ctf_rffts[ks[0]][2].dtype)
+                        # one batch of images at a time, instead of a stack of all of them
+                        batches = iter_apply_ctfs(image_work, [ctf_rffts[k][2] for k in ks])
+                        while True:
+                            with perf.span("fft", size=size, n=len(ks)):
+                                b0, images = next(batches, (None, None))
+                            if images is None: break
+                            yield from zip(ks[b0:b0+len(images)], images)
+                def simulate(indices):
+                    displays = [None] * len(indices)
+                    for k, image2 in simulated_images(indices):
+                        displays[k] = image_display_data(image2)
+                    return displays
+                signatures = [(ctf_signature(ctf), apix, plot_abs, dtype, image_key) for ctf in ctfs]
+                displays = reuse_panels("simulated_image", signatures, simulate)
 
                 fig2ds = []
                 for i in range(n):
-                    _, _, ctf_2d = ctfs[i].ctf2d(apix, abs=plot_abs, plot_s2=False)
-                    from skimage.transform import resize
-                    image_work = resize(image, (ctfs[i].imagesize*ctfs[i].over_sample, ctfs[i].imagesize*ctfs[i].over_sample), anti_aliasing=True)
-                    image2 = np.abs(np.fft.ifft2(np.fft.fft2(image_work)*np.fft.fftshift(ctf_2d)))
+                    if displays[i] is None: continue
                     if n>1:
                         title = f"{ctf_type} Applied - {i+1}"
                     else:
                         title = f"{ctf_type} Applied"
-                    fig2d = generate_image_figure(image2, dxy=1.0, ctf_type=None, title=title, plot_s2=False, show_color=show_color)
+                    fig2d = generate_image_figure(displays[i], dxy=1.0, ctf_type=None, title=title, plot_s2=False, show_color=show_color)
                     fig2ds.append(fig2d)
                 if len(fig2ds)>1:
                     from bokeh.models import CrosshairTool
@@ -445,9 +626,24 @@ def main():
                     for fig in fig2ds: fig.add_tools(crosshair)
                     from bokeh.layouts import gridplot
                     figs_grid = gridplot(children=[fig2ds], toolbar_location=None)
-                    st.bokeh_chart(figs_grid, use_container_width=True)
-                else:
-                    st.bokeh_chart(fig2d, use_container_width=True)
+                    bokeh_chart(figs_grid)
+                elif fig2ds:
+                    bokeh_chart(fig2ds[0])
+
+                with st.beta_expander("Export the simulated images"):
+                    def export_simulated_images(fmt):
+                        images = [None] * n
+                        for k, image2 in simulated_images(list(range(n))):
+                            images[k] = image2
+                        if any(image2 is None for image2 in images): raise CTFMemoryError("Not all the simulated images fit in the memory budget")
+                        labels = [f"ctfsimu: {image_key[1] or input_mode} with {ctf_type} applied"] + [f"{i+1}: {ctf_labels[i]}" for i in range(n)]
+                        return data_export.export_images(images, fmt, voxel_size=apix, labels=labels, names=[f"image_{i+1}" for i in range(n)])
+                    shapes = [(ctf.imagesize*ctf.over_sample,)*2 for ctf in ctfs]
+                    download_widget("the simulated images", data_export.image_formats(shapes), export_simulated_images, "ctf_simulated_images", key="export_images")
+
+    if sweeps:
+        with col_info:
+            show_sweep(sweep_ctf, sweeps, apix, plot_abs, plot_s2, ctf_type)
 
     with col_info:
         if not embed:
@@ -455,6 +651,9 @@ def main():
 
         st.markdown("*Developed by the [Jiang Lab@Purdue University](https://jiang.bio.purdue.edu). Report problems to Wen Jiang (jiang12 at purdue.edu)*")
 
+        if show_perf:
+            show_performance_panel()
+
     hide_streamlit_style = """
     <style>
     #MainMenu {visibility: hidden;}
@@ -463,12 +662,258 @@ def main():
     """
     st.markdown(hide_streamlit_style, unsafe_allow_html=True) 
 
-def generate_image_figure(image, dxy, ctf_type, title, plot_s2=False, show_color=False):
-    w, h = image.shape
+def bokeh_chart(fig, container=None):
+    # the Bokeh figure is serialized to JSON when it is sent to the browser, often the slowest stage of a rerun
+    if container is None: container = st
+    with perf.span("bokeh"):
+        container.bokeh_chart(fig, use_container_width=True)
+
+def download_widget(what, formats, make_file, basename, key):
+    """A choice of the file format and a button that generates the file only when clicked: make_file(format) returns its bytes.
+    It is then offered with st.download_button if this version of Streamlit has it, otherwise as a data link
+    """
+    fmt = st.selectbox(f"Export {what} as", formats, key=f"{key}_format") if len(formats)>1 else formats[0]
+    if not st.button(f"Prepare the .{fmt} file", key=f"{key}_prepare"): return
+    filename = f"{basename}.{fmt}"
+    try:
+        with perf.span("export", file=filename):
+            data = make_file(fmt)
+    except CTFMemoryError as err:
+        st.warning(f"{err}. Please reduce the image size/over-sample or use single precision")
+        return
+    size = f"{len(data)/2**20:.1f} MB" if len(data) >= 2**20 else f"{len(data)/2**10:.0f} kB"
+    mime = data_export.mime_types[fmt]
+    if hasattr(st, "download_button"):
+        st.download_button(f"Download {filename} ({size})", data, file_name=filename, mime=mime, key=f"{key}_download")
+    else:
+        import base64
+        b64 = base64.b64encode(data).decode()
+        st.markdown(f'<a href="data:{mime};base64,{b64}" download="{filename}">Download {filename}</a> ({size})', unsafe_allow_html=True)
+
+def show_performance_panel():
+    recorder = perf.current()
+    if recorder is None: return
+    import pandas as pd, time
+    with st.beta_expander("performance", expanded=False):
+        rows = []
+        for span in recorder.spans:
+            seconds = span["seconds"] if "seconds" in span else time.time() - recorder.start - span["start"]  # still running
+            attrs = ", ".join(f"{k}={v}" for k, v in span.items() if k not in ("name", "depth", "start", "seconds", "rss_mb", "rss_delta_mb"))
+            rows.append({"stage": ". "*span["depth"] + span["name"], "start (ms)": span["start"]*1e3, "time (ms)": seconds*1e3,
+                "memory (MB)": span.get("rss_mb", np.nan), "memory change (MB)": span.get("rss_delta_mb", np.nan), "details": attrs})
+        st.dataframe(pd.DataFrame(rows).style.format({col: "{:.1f}" for col in ("start (ms)", "time (ms)", "memory (MB)", "memory change (MB)")}), width=None)
+        totals = recorder.totals()
+        totals.pop("rerun", None)
+        st.markdown("**Total of each stage:** " + ", ".join(f"{name} {seconds*1e3:.1f} ms" + (f" ({count}x)" if count>1 else "") for name, (count, seconds) in sorted(totals.items(), key=lambda item: -item[1][1])))
+        import base64
+        b64 = base64.b64encode(recorder.to_json_lines().encode()).decode()
+        st.markdown(f'<a href="data:application/x-ndjson;base64,{b64}" download="ctf_perf.jsonl">Download the spans of this rerun as JSON lines</a>', unsafe_allow_html=True)
+        st.markdown("Set `CTF_PERF_LOG=file` to log the spans of all reruns, and `CTF_METRICS_PORT=port` to serve the totals of all sessions at `http://host:port/metrics` in the Prometheus text format")
+
+def ctf_landmarks(ctf, abs, s_max, envelope_threshold=0.1):
+    # the zeros and peaks of the 1D CTF up to s_max in increasing order, and where its envelope falls below envelope_threshold
+    ctfset = CTFSet([ctf])
+    zeros, peaks = ctfset.zeros(s_max=s_max)[0], ctfset.extrema(s_max=s_max)[0]
+    zeros, peaks = zeros[~np.isnan(zeros)], peaks[~np.isnan(peaks)]
+    s = np.concatenate([zeros, peaks])
+    feature = np.array([f"zero {k+1}" for k in range(len(zeros))] + [f"peak {k+1}" for k in range(len(peaks))])
+    marker = np.array(["x"]*len(zeros) + ["triangle"]*len(peaks))
+    order = np.argsort(s, kind="stable")
+    s = s[order]
+    return dict(s=s, ctf=ctfset.ctf_at(s[None, :], abs)[0], feature=feature[order], marker=marker[order],
+        envelope=ctfset.envelope_resolution(envelope_threshold, s_max=s_max)[0])
+
+def compute_ctf2ds(ctfset, apix, abs, plot_s2, float32=False):
+    # fall back to single precision, and then to not showing the 2D CTFs, if the images would not fit in the memory budget
+    dtypes = [np.float32] if float32 else [np.float64, np.float32]
+    for dtype in dtypes:
+        try:
+            ctf2ds = ctfset.ctf2d(apix, abs, plot_s2, dtype=dtype)
+            if dtype != dtypes[0]:
+                st.info("The 2D CTFs are computed in single precision (float32) to fit in the memory budget")
+            return ctf2ds
+        except CTFMemoryError as err:
+            msg = str(err)
+    st.warning(f"{msg}. Please reduce the image size or over-sample")
+    return None
+
+def ctf2d_panels(ctfset, apix, abs, plot_s2, float32=False):
+    # what the 2D CTF panel keeps of each CTF for later reruns: the pixel size, shape and dtype, and the display levels instead of the full image
+    ctf2ds = compute_ctf2ds(ctfset, apix, abs, plot_s2, float32)
+    if ctf2ds is None: return [None]*len(ctfset)
+    return [dict(ds=ds, ds2=ds2, shape=ctf_2d.shape, dtype=ctf_2d.dtype, display=image_display_data(ctf_2d)) for ds, ds2, ctf_2d in ctf2ds]
+
+def ctf_signature(ctf):
+    return tuple(ctf.get_dict().items())
+
+def reuse_panels(panel, signatures, compute):
+    """Per-CTF results of a panel that are kept in the session state across reruns: values[i] is only recomputed if
+    signatures[i] (the parameters of CTF i and the plot settings that the panel depends on) changed since the last rerun.
+    compute(indices) returns the values of the changed CTFs, e.g. evaluated together as one CTFSet. None values are not kept
+    """
+    if "panel_cache" not in st.session_state:
+        st.session_state.panel_cache = {}
+    cache = st.session_state.panel_cache.setdefault(panel, {})
+    for i in [i for i in cache if i >= len(signatures)]:
+        del cache[i]    # CTFs that were removed
+    dirty = [i for i, signature in enumerate(signatures) if i not in cache or cache[i][0] != signature]
+    values = {i: cache[i][1] for i in range(len(signatures)) if i not in dirty}
+    if dirty:
+        with perf.span(panel, n=len(dirty)):
+            computed = compute(dirty)
+        for i, value in zip(dirty, computed):
+            values[i] = value
+            if value is not None: cache[i] = (signatures[i], value)
+            else: cache.pop(i, None)
+    return [values[i] for i in range(len(signatures))]
+
+def get_sweep_settings(ctf, i):
+    # sidebar controls of a sweep of one or two parameters of ctf (CTF i). Returns [(attr, values), ...] or None
+    from ctf_sweep import sweep_ranges
+    enabled = st.checkbox(f"sweep parameters of CTF {i+1}", value=False, help="Compute the 1D CTFs for a range of values of one or two parameters and show them as heatmaps")
+    if not enabled: return None
+    sweeps = []
+    for si in range(2):
+        options = list(sweep_ranges) if si==0 else ["none"] + [attr for attr in sweep_ranges if attr != sweeps[0][0]]
+        attr = st.selectbox(f"parameter {si+1}", options=options, index=0, key=f"sweep_attr_{si}")
+        if attr == "none": break
+        start, stop = sweep_ranges[attr]
+        start = st.number_input(f"{attr} from", value=start, step=(stop-start)/10, format="%g", key=f"sweep_start_{si}_{attr}")
+        stop = st.number_input(f"{attr} to", value=stop, step=(stop-start)/10, format="%g", key=f"sweep_stop_{si}_{attr}")
+        steps = int(st.number_input(f"{attr} steps", value=200 if si==0 else 20, min_value=2, max_value=10000, step=10, key=f"sweep_steps_{si}_{attr}"))
+        sweeps.append((attr, np.linspace(start, stop, steps)))
+    return sweeps
+
+def show_sweep(ctf, sweeps, apix, abs, plot_s2, ctf_type):
+    import time
+    from ctf_sweep import sweep_ctfset, sweep_ctf1d
+    ctfset = sweep_ctfset(ctf, sweeps)
+    attrs = [attr for attr, _ in sweeps]
+    x_label = "s^2 (1/Å^2)" if plot_s2 else "s (1/Å)"
+    vrange = (-1, 1) if abs==0 else (0, 1)
+    shape = tuple(len(values) for _, values in sweeps)
+
+    st.markdown(f"**Parameter sweep: {' x '.join(attrs)} ({len(ctfset)} CTFs)**")
+    j = 0
+    if len(sweeps)>1:
+        attr2, values2 = sweeps[1]
+        j = st.select_slider(f"{attr2} of the {ctf_type} vs {attrs[0]} map", options=list(range(len(values2))), value=0, format_func=lambda k: f"{values2[k]:g}")
+    progress = st.progress(0)
+    placeholder = st.empty()
+
+    from ctf_core import ctf1d_axis
+    s, s2 = ctf1d_axis(apix, ctf.imagesize, ctf.over_sample, plot_s2)
+    x = s2 if plot_s2 else s
+
+    def curves_figure(curves):
+        data = curves.reshape(shape + (len(x),))
+        if len(sweeps)>1: data = data[:, j, :]
+        title = f"{ctf_type}" + (f" at {attr2}={values2[j]:g}" if len(sweeps)>1 else "")
+        return generate_sweep_figure(data, x, sweeps[0][1], x_label, attrs[0], ctf_type, title, vrange)
+
+    last_update = [0]
+    def update(done, n, curves):
+        progress.progress(done/n)
+        if time.time() - last_update[0] > 0.5 or done == n:    # limit the rate of sending partial heatmaps to the browser
+            bokeh_chart(curves_figure(curves), placeholder)
+            last_update[0] = time.time()
+
+    try:
+        with perf.span("sweep", n=len(ctfset)):
+            _, _, curves = sweep_ctf1d(ctfset, apix, abs, plot_s2, callback=update)
+    except CTFMemoryError as err:
+        progress.empty()
+        st.warning(f"{err}. Please reduce the number of steps or the image size")
+        return
+    progress.empty()
+    bokeh_chart(curves_figure(curves), placeholder)
+
+    if len(sweeps)>1:
+        k = st.select_slider(f"resolution of the {attrs[0]} vs {attrs[1]} map", options=list(range(1, len(x))), value=len(x)//4, format_func=lambda k: f"{1/s[k]:.2f} Å")
+        data = curves.reshape(shape + (len(x),))[:, :, k]
+        title = f"{ctf_type} at {1/s[k]:.2f} Å"
+        fig = generate_sweep_figure(data, sweeps[1][1], sweeps[0][1], attrs[1], attrs[0], ctf_type, title, vrange)
+        bokeh_chart(fig)
+
+    if st.checkbox("Export the sweep curves", value=False):
+        def export_sweep(fmt):
+            import pandas as pd
+            grids = np.meshgrid(*[values for _, values in sweeps], indexing='ij')
+            df = pd.DataFrame(curves, columns=[repr(v) for v in x.tolist()])
+            for attr, grid in reversed(list(zip(attrs, grids))):
+                df.insert(0, attr, grid.ravel())
+            # the .npz file keeps the curves as an array of the sweep shape instead of one column per point
+            arrays = dict({attr: np.asarray(values) for attr, values in sweeps}, x=x, curves=curves.reshape(shape + (len(x),)))
+            return data_export.export_table(df, fmt, arrays=arrays)
+        st.markdown(f"{len(ctfset)} CTFs. Table columns: {', '.join(attrs)}, {ctf_type} at each {x_label}. The .npz file has the arrays {', '.join(attrs)}, x and curves ({' x '.join(map(str, shape + (len(x),)))})")
+        download_widget("the sweep curves", data_export.table_formats(), export_sweep, "ctf_sweep", key="export_sweep")
+
+def downsample_image(image, max_size=512):
+    # block mean along each axis to at most max_size pixels. Trailing rows/columns that do not fill a block are dropped
+    fy, fx = [max(1, -(-n//max_size)) for n in image.shape]
+    h, w = image.shape[0]//fy*fy, image.shape[1]//fx*fx
+    return image[:h, :w].reshape(h//fy, fy, w//fx, fx).mean(axis=(1, 3)), (fy, fx)
+
+def generate_sweep_figure(data, x, y, x_label, y_label, value_label, title, vrange, display_size=512):
+    # heatmap of data[iy, ix] on the uniformly spaced axes x, y. Unfinished (nan) rows are transparent
+    if y[-1] < y[0]:
+        data, y = data[::-1], y[::-1]
+    image, (fy, fx) = downsample_image(data, display_size)
+    dx, dy = x[1]-x[0], y[1]-y[0]
+    from bokeh.plotting import figure
+    from bokeh.models import ColorBar, LinearColorMapper
+    tools = 'box_zoom,crosshair,pan,reset,save,wheel_zoom'
+    tooltips = [(y_label, "$y"), (x_label, "$x"), (value_label, "@image")]
+    fig = figure(title=title, x_axis_label=x_label, y_axis_label=y_label, tools=tools, tooltips=tooltips,
+        x_range=(x[0]-dx/2, x[0]+(image.shape[1]*fx-0.5)*dx), y_range=(y[0]-dy/2, y[0]+(image.shape[0]*fy-0.5)*dy))
+    fig.title.align = "center"
+    fig.title.text_font_size = "18px"
+    color_mapper = LinearColorMapper(palette="Greys256", low=vrange[0], high=vrange[1])
+    source_data = dict(image=[image.astype(np.float32)], x=[x[0]-dx/2], y=[y[0]-dy/2], dw=[image.shape[1]*fx*dx], dh=[image.shape[0]*fy*dy])
+    fig.image(source=source_data, image='image', x='x', y='y', dw='dw', dh='dh', color_mapper=color_mapper)
+    fig.add_layout(ColorBar(color_mapper=color_mapper, width=10), "right")
+    return fig
+
+def image_display_levels(image, display_size=512, max_size=1024):
+    """Block-averaged copies of image for display: the coarsest one has at most display_size pixels per side and each
+    following level doubles the resolution up to max_size pixels per side (or the full resolution). Returns a list of (image, factor)"""
+    n = max(image.shape[-2:])
+    factor = max(1, -(-n//display_size))
+    min_factor = max(1, -(-n//max(max_size, display_size)))
+    levels = []
+    while True:
+        h, w = image.shape[0]//factor*factor, image.shape[1]//factor*factor
+        level = image[:h, :w].reshape(h//factor, factor, w//factor, factor).mean(axis=(1, 3)) if factor>1 else image
+        levels.append((level, factor))
+        if factor <= min_factor: break
+        factor = max(min_factor, factor//2)
+    return levels
+
+def quantize_image(image, vmin, vmax, quantize="uint8"):
+    # uint8: 1 byte/pixel, value = vmin + q*(vmax-vmin)/255. float32 is the smallest float type that Bokeh can send in binary
+    if quantize == "uint8":
+        scale = 255./(vmax-vmin) if vmax>vmin else 0.
+        return np.rint((image - vmin)*scale).astype(np.uint8)
+    return np.asarray(image, dtype=np.float32)
+
+def image_display_data(image, display_size=512, max_size=1024, quantize="uint8"):
+    # the quantized display levels of image and what is needed to show them, small enough to keep for later reruns
+    vmin, vmax = float(np.min(image)), float(np.max(image))
+    levels = [(quantize_image(level, vmin, vmax, quantize), factor) for level, factor in image_display_levels(image, display_size, max_size)]
+    return dict(shape=image.shape, vmin=vmin, vmax=vmax, quantize=quantize, levels=levels)
+
+def generate_image_figure(image, dxy, ctf_type, title, plot_s2=False, show_color=False, display_size=512, max_size=1024, quantize="uint8", center=(0., 0.)):
+    # only a downsampled and quantized copy of the image is sent to the browser. Higher resolution levels are shown when zoomed in
+    # image: an image or the output of image_display_data()
+    # center: the (x, y) coordinates of the center pixel, e.g. of a zoomed region
+    data = image if isinstance(image, dict) else image_display_data(image, display_size, max_size, quantize)
+    w, h = data["shape"]
+    cx, cy = center
+    vmin, vmax, quantize, levels = data["vmin"], data["vmax"], data["quantize"], data["levels"]
     tools = 'box_zoom,crosshair,pan,reset,save,wheel_zoom'
     from bokeh.plotting import figure
-    fig2d = figure(frame_width=w, frame_height=h,
-        x_range=(-w//2*dxy, (w//2-1)*dxy), y_range=(-h//2*dxy, (h//2-1)*dxy),
+    fig2d = figure(frame_width=levels[0][0].shape[0], frame_height=levels[0][0].shape[1],
+        x_range=(cx + -w//2*dxy, cx + (w//2-1)*dxy), y_range=(cy + -h//2*dxy, cy + (h//2-1)*dxy),
         tools=tools)
     fig2d.grid.visible = False
     fig2d.axis.visible = False
@@ -480,40 +925,66 @@ def generate_image_figure(image, dxy, ctf_type, title, plot_s2=False, show_color
 
     if ctf_type is not None:
         if plot_s2:
-            source_data = dict(image=[image], x=[-w//2*dxy], y=[-h//2*dxy], dw=[w*dxy], dh=[h*dxy])
             tooltips = [
                 ("Res", "@res Å"),
                 ("s", "@s 1/Å"),
                 ("s2", "@s2 1/Å^2"),
                 ('angle', '@ang °'),
-                (ctf_type, '@image')
+                (ctf_type, '@image{custom}')
             ]
         else:
-            source_data = dict(image=[image], x=[-w//2*dxy], y=[-h//2*dxy], dw=[w*dxy], dh=[h*dxy])
             tooltips = [
                 ("Res", "@res Å"),
                 ("s", "@s 1/Å"),
                 ('angle', '@ang °'),
-                (ctf_type, '@image')
+                (ctf_type, '@image{custom}')
             ]
     else:
-        source_data = dict(image=[image], x=[-w//2*dxy], y=[-h//2*dxy], dw=[w*dxy], dh=[h*dxy])
         tooltips = [
             ("x", "$x Å"),
             ("y", "$y Å"),
-            ("val", '@image')
+            ("val", '@image{custom}')
         ]
 
+    from bokeh.models import LinearColorMapper
     palette = "Spectral11" if show_color else "Greys256"    # "Viridis256"   
-    fig2d_image = fig2d.image(source=source_data, image='image', palette=palette, x='x', y='y', dw='dw', dh='dh')
+    if quantize == "uint8":
+        color_mapper = LinearColorMapper(palette=palette, low=0, high=255)
+    else:
+        color_mapper = LinearColorMapper(palette=palette, low=vmin, high=vmax)
+    renderers = []
+    for li, (level, factor) in enumerate(levels):
+        lw, lh = level.shape
+        source_data = dict(image=[level], x=[cx + -w//2*dxy], y=[cy + -h//2*dxy], dw=[lw*factor*dxy], dh=[lh*factor*dxy])
+        renderer = fig2d.image(source=source_data, image='image', color_mapper=color_mapper, x='x', y='y', dw='dw', dh='dh')
+        renderer.visible = li==0
+        renderers.append(renderer)
     
+    from bokeh.models import CustomJS, CustomJSHover
     from bokeh.models.tools import HoverTool
-    image_hover = HoverTool(renderers=[fig2d_image], tooltips=tooltips)
+    scale = (vmax-vmin)/255. if quantize == "uint8" else 1.0
+    offset = vmin if quantize == "uint8" else 0.0
+    value_formatter = CustomJSHover(code=f"return ({offset!r} + value*{scale!r}).toPrecision(4)")
+    image_hover = HoverTool(renderers=renderers, tooltips=tooltips, formatters={"@image":value_formatter})
     fig2d.add_tools(image_hover)
 
+    if len(renderers)>1:
+        # show the coarsest level that still has at least one image pixel per screen pixel in the visible range
+        zoom_callback_code = """
+        var width = Math.abs(xr.end - xr.start)
+        var screen = fig.inner_width || frame_width
+        var best = renderers.length - 1
+        for (var i = 0; i < renderers.length; i++) {
+            if (width/(dxy*factors[i]) >= screen) { best = i; break }
+        }
+        for (var i = 0; i < renderers.length; i++) renderers[i].visible = (i == best)
+        """
+        zoom_callback = CustomJS(args={"xr":fig2d.x_range, "fig":fig2d, "renderers":renderers, "factors":[f for _, f in levels], "dxy":dxy, "frame_width":levels[0][0].shape[0]}, code=zoom_callback_code)
+        fig2d.x_range.js_on_change('start', zoom_callback)
+        fig2d.x_range.js_on_change('end', zoom_callback)
+
     if ctf_type is not None:
         # avoid the need for embedding res/s/s2 image -> smaller fig object and less data to transfer
-        from bokeh.models import CustomJS
         from bokeh.events import MouseMove
         mousemove_callback_code = """
         var x = cb_obj.x
@@ -543,6 +1014,72 @@ def generate_image_figure(image, dxy, ctf_type, title, plot_s2=False, show_color
     
     return fig2d
 
+def client_side_ctf_preview(fig, sources, ctf, abs, plot_s2, hidden=()):
+    """Sliders above the 1D CTF figure that recompute the curves of ctf in the browser, using the same formula as ctf_core.ctf_formula.
+    sources: [(ColumnDataSource of a curve, defocus offset of the curve from ctf.defocus), ...]
+    hidden: renderers/annotations (e.g. the zeros and peaks) that are hidden once the sliders move as they are not recomputed
+    Returns the layout to show instead of fig
+    """
+    from bokeh.models import CustomJS, Slider
+    from bokeh.layouts import column
+    sliders = dict(
+        defocus = Slider(title="defocus (µm)", start=0.0, end=max(0.1, ctf.defocus*2.0), value=ctf.defocus, step=max(1e-4, ctf.defocus*2.0/1000), format="0[.]0000"),
+        phaseshift = Slider(title="phase shift (°)", start=0.0, end=360.0, value=ctf.phaseshift, step=1.0),
+        bfactor = Slider(title="b-factor (Å^2)", start=0.0, end=max(200.0, ctf.bfactor*2.0), value=ctf.bfactor, step=1.0)
+    )
+    ctf_js_code = """
+    function j0(x) {   // rational approximation of the Bessel function J0 (Numerical Recipes), |error| < 1e-8
+        const ax = Math.abs(x)
+        if (ax < 8.0) {
+            const y = x*x
+            const n = 57568490574.0+y*(-13362590354.0+y*(651619640.7+y*(-11214424.18+y*(77392.33017+y*(-184.9052456)))))
+            const d = 57568490411.0+y*(1029532985.0+y*(9494680.718+y*(59272.64853+y*(267.8532712+y*1.0))))
+            return n/d
+        }
+        const z = 8.0/ax, y = z*z, xx = ax-0.785398164
+        const p = 1.0+y*(-0.1098628627e-2+y*(0.2734510407e-4+y*(-0.2073370639e-5+y*0.2093887211e-6)))
+        const q = -0.1562499995e-1+y*(0.1430488765e-3+y*(-0.6911147651e-5+y*(0.7621095161e-6-y*0.934935152e-7)))
+        return Math.sqrt(0.636619772/ax)*(Math.cos(xx)*p-z*Math.sin(xx)*q)
+    }
+    const p = Object.assign({}, params)
+    for (const name in sliders) p[name] = sliders[name].value
+    const wl = 12.2639 / Math.sqrt(p.voltage * 1000.0 + 0.97845 * p.voltage * p.voltage)
+    const phaseshift = p.phaseshift * Math.PI / 180.0 + Math.asin(p.ampcontrast/100.)
+    const ln2 = Math.log(2)
+    for (let k = 0; k < sources.length; k++) {
+        const data = sources[k].data
+        const defocus = p.defocus + offsets[k]
+        const y = new Array(data.x.length)
+        for (let j = 0; j < data.x.length; j++) {
+            const s = s2_axis ? Math.sqrt(data.x[j]) : data.x[j]
+            const s2 = s*s
+            const gamma = 2*Math.PI*(-0.5*defocus*1e4*wl*s2 + .25*p.cs*1e7*wl**3*s2**2) - phaseshift
+            let ctf = Math.sin(gamma)
+            if (p.bfactor) ctf *= Math.exp(-p.bfactor*s2/4.0)
+            if (p.alpha) ctf *= Math.exp(-Math.pow(Math.PI*p.alpha*(1.0e7*p.cs*wl*wl*s*s*s-1e4*defocus*s), 2.0)*1e-6)
+            if (p.dE) ctf *= Math.exp(-Math.pow(Math.PI*p.cc*wl*s*s*p.dE/p.voltage, 2.0)/(16*ln2)*1e8)
+            if (p.dI) ctf *= Math.exp(-Math.pow(Math.PI*p.cc*wl*s*s*p.dI, 2.0)/(4*ln2)*1e2)
+            if (p.dZ) ctf *= j0(Math.PI*p.dZ*wl*s*s)
+            if (p.dXY) {   // np.sinc(x) = sin(pi*x)/(pi*x)
+                const x = Math.PI*Math.PI*p.dXY*s
+                if (x) ctf *= Math.sin(x)/x
+            }
+            if (abs>=2) ctf = ctf*ctf
+            else if (abs==1) ctf = Math.abs(ctf)
+            y[j] = ctf
+        }
+        data.y = y
+        if ("defocus" in data) data.defocus = new Array(data.x.length).fill(defocus)
+        sources[k].change.emit()
+    }
+    for (const r of hidden) r.visible = false
+    """
+    callback = CustomJS(args=dict(sources=[source for source, _ in sources], offsets=[float(offset) for _, offset in sources],
+        sliders=sliders, params=ctf.get_dict(), abs=abs, s2_axis=plot_s2, hidden=list(hidden)), code=ctf_js_code)
+    for slider in sliders.values():
+        slider.js_on_change('value', callback)
+    return column(*sliders.values(), fig, sizing_mode="stretch_width")
+
 def update_session_state_from_ctfs():
     for ci, ctf in enumerate(st.session_state.ctfs):
         d = ctf.get_dict()
@@ -560,7 +1097,7 @@ def update_ctfs_from_session_state():
         ctf.imagesize = int(ctf.imagesize)
         ctf.over_sample = int(ctf.over_sample)
 
-def set_query_parameters(ctfs, ctf_type, apix, show_1d, show_2d, show_psf, plot_s2, show_marker):
+def set_query_parameters(ctfs, ctf_type, apix, show_1d, show_2d, show_psf, plot_s2, show_marker, float32=False, show_zeros=False, preview=False):
     d = {}
     if ctf_type != "CTF": d["ctf_type"] = ctf_type
     if apix != 1.0: d["apix"] = apix
@@ -569,277 +1106,66 @@ def set_query_parameters(ctfs, ctf_type, apix, show_1d, show_2d, show_psf, plot_
     if not show_psf: d["show_psf"] = 0
     if plot_s2: d["plot_s2"] = 1
     if show_marker: d["show_marker"] = 1
+    if show_zeros: d["show_zeros"] = 1
+    if float32: d["float32"] = 1
+    if preview: d["preview"] = 1
     default_vals = CTF().get_dict()
+    ctf_params = CTFSet(ctfs).params
     for attr in default_vals.keys():
-        vals = np.array([getattr(ctfs[i], attr) for i in range(len(ctfs))])
+        vals = ctf_params[attr]
         if np.any(vals - default_vals[attr]):
             d[attr] = vals
     st.experimental_set_query_params(**d)
 
 def parse_query_parameters():
     query_params = st.experimental_get_query_params()
-    embed = "embed" in query_params and query_params["embed"][0]!='0'
-    attrs = CTF().get_dict().keys()
-    ns = [len(query_params[attr]) for attr in attrs if attr in query_params]
-    if not ns:
-        ctfs = None
-    else:
-        n = int(max(ns))
-        ctfs = [CTF() for i in range(n)]
-        for attr in attrs:
-            if attr in query_params:
-                for i in range(n):
-                    setattr(ctfs[i], attr, float(query_params[attr][-1]))
-                for i in range(len(query_params[attr])):
-                    setattr(ctfs[i], attr, float(query_params[attr][i]))
-        for i in range(len(ctfs)):
-            ctfs[i].imagesize = max(32, int(ctfs[i].imagesize))
-            ctfs[i].over_sample = max(1, int(ctfs[i].over_sample))
-
-    attrs = "ctf_type apix show_1d show_2d show_psf plot_s2 show_marker".split()
-    plot_settings = {}
-    for attr in attrs:
-        if attr in query_params:
-            plot_settings[attr] = query_params[attr][0]
+    try:
+        ctfs, plot_settings, embed = ctf_core.parse_query_parameters(query_params)
+    except ValueError as err:
+        st.warning(f"Invalid URL parameters ({err}). The default parameters are used")
+        ctfs, plot_settings, embed = None, {}, False
     print(query_params, ctfs, plot_settings, embed)
     return ctfs, plot_settings, embed
 
 def ctf_varying_parameter_labels(ctfs):
-    ret = []
-    attrs = ctf_varying_parameters(ctfs)
-    if attrs:
-        for ctf in ctfs:
-            for attr in attrs:
-                s = '/'.join([f'{attr}={getattr(ctf, attr)}' for attr in attrs])
-            ret.append(s)
-    else:
-        ret = [f'{i+1}' for i in range(len(ctfs))]
-    return ret
+    ctfset = ctfs if isinstance(ctfs, CTFSet) else CTFSet(ctfs)
+    return ctfset.varying_parameter_labels()
 
 def ctf_varying_parameters(ctfs):
-    if len(ctfs)<2: return []
-    attrs = "voltage cs ampcontrast defocus dfdiff dfang phaseshift bfactor alpha cc dE dI dZ dXY imagesize over_sample".split()
-    ret = []
-    for attr in attrs:
-        vals = np.array([getattr(ctfs[i], attr) for i in range(len(ctfs))])
-        if np.std(vals):
-            ret.append(attr)
-    return ret
-
-class CTF:
-    def __init__(self, voltage=300.0, cs=2.7, ampcontrast=7.0, defocus=0.5, dfdiff=0.0, dfang=0.0, phaseshift=0.0, bfactor=0.0, alpha=0.0, cc=2.7, dE=0.0, dI=0.0, dZ=0.0, dXY=0.0, imagesize=256, over_sample=1):
-        self.voltage = voltage
-        self.cs = cs
-        self.ampcontrast = ampcontrast
-        self.defocus = defocus
-        self.dfdiff = dfdiff
-        self.dfang = dfang
-        self.phaseshift = phaseshift
-        self.bfactor = bfactor
-        self.alpha = alpha
-        self.cc = cc
-        self.dE = dE
-        self.dI = dI
-        self.dZ = dZ
-        self.dXY = dXY
-        self.imagesize = int(imagesize)
-        self.over_sample = int(over_sample)
-    
-    def __str__(self):
-        return str(self.get_dict())
-
-    def __repr__(self):
-        return self.__str__()
-    
-    def get_dict(self):
-        ret = {}
-        ret.update(self.__dict__)
-        return ret
-
-    @st.cache(persist=True, show_spinner=False)
-    def ctf1d(self, apix, abs, plot_s2=False, defocus_override=None):
-        defocus_final = defocus_override if defocus_override is not None else self.defocus
-        s_nyquist = 1./(2*apix)
-        if plot_s2:
-            ds2 = s_nyquist*s_nyquist/(self.imagesize//2*self.over_sample)
-            s2 = np.arange(self.imagesize//2*self.over_sample+1, dtype=np.float32)*ds2
-            s = np.sqrt(s2)
-        else:
-            ds = s_nyquist/(self.imagesize//2*self.over_sample)
-            s = np.arange(self.imagesize//2*self.over_sample+1, dtype=np.float32)*ds
-            s2 = s*s
-        wl = 12.2639 / np.sqrt(self.voltage * 1000.0 + 0.97845 * self.voltage * self.voltage)  # Angstrom
-        phaseshift = self.phaseshift * np.pi / 180.0 + np.arcsin(self.ampcontrast/100.)
-        gamma =2*np.pi*(-0.5*defocus_final*1e4*wl*s2 + .25*self.cs*1e7*wl**3*s2**2) - phaseshift
-        
-        from scipy.special import j0, sinc
-        env = np.ones_like(gamma)
-        if self.bfactor: env *= np.exp(-self.bfactor*s2/4.0)
-        if self.alpha: env *= np.exp(-np.power(np.pi*self.alpha*(1.0e7*self.cs*wl*wl*s*s*s-1e4*defocus_final*s), 2.0)*1e-6)
-        if self.dE: env *= np.exp(-np.power(np.pi*self.cc*wl*s*s* self.dE/self.voltage, 2.0)/(16*np.log(2))*1e8)
-        if self.dI: env *= np.exp(-np.power(np.pi*self.cc*wl*s*s* self.dI,              2.0)/(4*np.log(2))*1e2)
-        if self.dZ: env *= j0(np.pi*self.dZ*wl*s*s)
-        if self.dXY: env *= sinc(np.pi*self.dXY*s)
-
-        ctf = np.sin(gamma) * env
-        if abs>=2: ctf = ctf*ctf
-        elif abs==1: ctf = np.abs(ctf)
-
-        return s, s2, ctf
-
-    @st.cache(persist=True, show_spinner=False)
-    def psf1d(self, apix, abs, defocus_override=None):
-        defocus_final = defocus_override if defocus_override is not None else self.defocus
-        s_nyquist = 1./(2*apix)
-        ds = s_nyquist/(self.imagesize//2)
-        s = (np.arange(self.imagesize, dtype=np.float32) - self.imagesize//2)*ds
-        s2 = s*s
-        wl = 12.2639 / np.sqrt(self.voltage * 1000.0 + 0.97845 * self.voltage * self.voltage)  # Angstrom
-        phaseshift = self.phaseshift * np.pi / 180.0 + np.arcsin(self.ampcontrast/100.)
-        gamma =2*np.pi*(-0.5*defocus_final*1e4*wl*s2 + .25*self.cs*1e7*wl**3*s2**2) - phaseshift
-        
-        from scipy.special import j0, sinc
-        env = np.ones_like(gamma)
-        if self.bfactor: env *= np.exp(-self.bfactor*s2/4.0)
-        if self.alpha: env *= np.exp(-np.power(np.pi*self.alpha*(1.0e7*self.cs*wl*wl*s*s*s-1e4*defocus_final*s), 2.0)*1e-6)
-        if self.dE: env *= np.exp(-np.power(np.pi*self.cc*wl*s*s* self.dE/self.voltage, 2.0)/(16*np.log(2))*1e8)
-        if self.dI: env *= np.exp(-np.power(np.pi*self.cc*wl*s*s* self.dI,              2.0)/(4*np.log(2))*1e2)
-        if self.dZ: env *= j0(np.pi*self.dZ*wl*s*s)
-        if self.dXY: env *= sinc(np.pi*self.dXY*s)
-
-        ctf = np.sin(gamma) * env
-        if abs>=2: ctf = ctf*ctf
-        elif abs==1: ctf = np.abs(ctf)
-
-        unity = np.ones((self.imagesize,), dtype=np.complex64)
-        psf = np.abs( np.fft.ifft( unity * np.fft.ifftshift(ctf) ) )
-        psf = np.fft.fftshift(psf)
-        psf /= np.linalg.norm(psf, ord=2)
-        x = (np.arange(self.imagesize)-self.imagesize//2) * apix
-
-        return x, psf
-
-    @st.cache(persist=True, show_spinner=False)
-    def ctf2d(self, apix, abs, plot_s2=False):    
-        s_nyquist = 1./(2*apix)
-        if plot_s2:
-            ds = None
-            ds2 = s_nyquist*s_nyquist/(self.imagesize//2*self.over_sample)
-            sx2 = np.arange(-self.imagesize*self.over_sample//2, self.imagesize*self.over_sample//2) * ds2
-            sy2 = np.arange(-self.imagesize*self.over_sample//2, self.imagesize*self.over_sample//2) * ds2
-            sx2, sy2 = np.meshgrid(sx2, sy2, indexing='ij')
-            theta = -np.arctan2(sy2, sx2)
-            s2 = np.hypot(sx2, sy2)
-            s = np.sqrt(s2)
-        else:
-            ds2 = None
-            ds = s_nyquist/(self.imagesize//2*self.over_sample)
-            sx = np.arange(-self.imagesize*self.over_sample//2, self.imagesize*self.over_sample//2) * ds
-            sy = np.arange(-self.imagesize*self.over_sample//2, self.imagesize*self.over_sample//2) * ds
-            sx, sy = np.meshgrid(sx, sy, indexing='ij')
-            theta = -np.arctan2(sy, sx)
-            s2 = sx*sx + sy*sy
-            s = np.sqrt(s2)
-
-        defocus2d = self.defocus + self.dfdiff/2*np.cos( 2*(theta-self.dfang*np.pi/180.))
-
-        wl = 12.2639 / np.sqrt(self.voltage * 1000.0 + 0.97845 * self.voltage * self.voltage)  # Angstrom
-        phaseshift = self.phaseshift * np.pi / 180.0 + np.arcsin(self.ampcontrast/100.)
-
-        gamma =2*np.pi*(-0.5*defocus2d*1e4*wl*s2 + .25*self.cs*1e7*wl**3*s2**2) - phaseshift
+    ctfset = ctfs if isinstance(ctfs, CTFSet) else CTFSet(ctfs)
+    return ctfset.varying_parameters()
 
-        from scipy.special import j0, sinc
-        env = np.ones_like(gamma)
-        if self.bfactor: env *= np.exp(-self.bfactor*s2/4.0)
-        if self.alpha: env *= np.exp(-np.power(np.pi*self.alpha*(1.0e7*self.cs*wl*wl*s*s*s-1e4*self.defocus*s), 2.0)*1e-6)
-        if self.dE: env *= np.exp(-np.power(np.pi*self.cc*wl*s*s* self.dE/self.voltage, 2.0)/(16*np.log(2))*1e8)
-        if self.dI: env *= np.exp(-np.power(np.pi*self.cc*wl*s*s* self.dI,              2.0)/(4*np.log(2))*1e2)
-        if self.dZ: env *= j0(np.pi*self.dZ*wl*s*s)
-        if self.dXY: env *= sinc(np.pi*self.dXY*s)
-
-        ctf = np.sin(gamma) * env
-        if abs>=2: ctf = ctf*ctf
-        elif abs==1: ctf = np.abs(ctf)
-
-        return ds, ds2, ctf
-
-@st.cache(persist=True, show_spinner=False)
-def compute_radial_profile(image):
-    ny, nx = image.shape
-    rmax = min(nx//2, ny//2)+1
-    
-    r = np.arange(0, rmax, 1, dtype=np.float32)
-    theta = np.arange(0, 360, 1, dtype=np.float32) * np.pi/180.
-    n_theta = len(theta)
-
-    theta_grid, r_grid = np.meshgrid(theta, r, indexing='ij', copy=False)
-    y_grid = ny//2 + r_grid * np.sin(theta_grid)
-    x_grid = nx//2 + r_grid * np.cos(theta_grid)
-
-    coords = np.vstack((y_grid.flatten(), x_grid.flatten()))
-
-    from scipy.ndimage.interpolation import map_coordinates
-    polar = map_coordinates(image, coords, order=1).reshape(r_grid.shape)
-
-    rad_profile = polar.mean(axis=0)
-    return rad_profile
-
-@st.cache(persist=True, show_spinner=False)
-def normalize(data, percentile=(0, 100)):
-    p0, p1 = percentile
-    vmin, vmax = sorted(np.percentile(data, (p0, p1)))
-    data2 = (data-vmin)/(vmax-vmin)
-    return data2
-
-@st.cache(persist=True, show_spinner=False, ttl=24*60*60.) # refresh every day
 def get_emdb_ids():
-    try:
-        import pandas as pd
-        emdb_ids = pd.read_csv("https://wwwdev.ebi.ac.uk/emdb/api/search/*%20AND%20current_status:%22REL%22?wt=csv&download=true&fl=emdb_id")
-        emdb_ids = list(emdb_ids.iloc[:,0].str.split('-', expand=True).iloc[:, 1].values)
-    except:
-        emdb_ids = ["11638"]
-    return emdb_ids
+    # sorted integer index of the EMDB IDs, supports len(), "id in emdb_ids" and emdb_ids.random_id(). Refreshed daily in the background
+    from emdb_index import get_emdb_index
+    return get_emdb_index()
+
+def emdb_image_url(emd_id):
+    from emdb_index import format_emdb_id
+    emd_id = format_emdb_id(emd_id)
+    return f"https://www.ebi.ac.uk/emdb/images/entry/EMD-{emd_id}/400_{emd_id}.gif"
 
-@st.cache(persist=True, show_spinner=False)
 def get_emdb_image(emd_id, invert_contrast=-1, rgb2gray=True, output_shape=None):
     emdb_ids = get_emdb_ids()
     if emd_id in emdb_ids:
-        url = f"https://www.ebi.ac.uk/emdb/images/entry/EMD-{emd_id}/400_{emd_id}.gif"
-        return get_image(url, invert_contrast, rgb2gray, output_shape)
+        return get_image(emdb_image_url(emd_id), invert_contrast, rgb2gray, output_shape)
     else:
         return None
 
-@st.cache(persist=True, show_spinner=False)
-def get_image(url, invert_contrast=-1, rgb2gray=True, output_shape=None):
-    from skimage.io import imread
-    try:
-        image = imread( url, as_gray=rgb2gray)    # return: numpy array
-    except:
-        return None
-    if output_shape:
-        from skimage.transform import resize
-        image = resize(image, output_shape=output_shape)
-    vmin, vmax = np.percentile(image, (5, 95))
-    image = (image-vmin)/(vmax-vmin)    # set to range [0, 1]
-    if invert_contrast<0: # detect if the image contrast should be inverted (i.e. to make background black)
-        edge_vals = np.mean([image[0, :].mean(), image[-1, :].mean(), image[:, 0].mean(), image[:, -1].mean()])
-        invert_contrast = edge_vals>0.5
-    if invert_contrast>0:
-        image = -image + 1
-    return image
+def prefetch_random_emdb_images(emdb_ids, n=2):
+    # download the images of the next n "Change EMDB ID" clicks in the background so that they show up without waiting
+    if "emd_id_queue" not in st.session_state:
+        st.session_state.emd_id_queue = []
+    queue = st.session_state.emd_id_queue
+    while len(queue) < n: queue.append(emdb_ids.random_id())
+    from image_fetch import get_image_fetcher
+    get_image_fetcher().prefetch([emdb_image_url(emd_id) for emd_id in queue], invert_contrast=-1, rgb2gray=True)
 
-@st.cache(persist=True, show_spinner=False)
-def get_table_download_link(df, label="Download the CTF data"):
-    """Generates a link allowing the data in a given panda dataframe to be downloaded
-    in:  dataframe
-    out: href string
-    """
-    csv = df.to_csv(index=False)
-    import base64
-    b64 = base64.b64encode(csv.encode()).decode()  # some strings <-> bytes conversions necessary here
-    href = f'<a href="data:file/csv;base64,{b64}" download="ctf_curve_table.csv">{label}</a>'
-    return href
+def get_image(url, invert_contrast=-1, rgb2gray=True, output_shape=None):
+    # decoded and normalized grayscale image, kept in an in-memory cache shared by all sessions. Raises ImageFetchError
+    from image_fetch import get_image_fetcher
+    with perf.span("image_fetch"):
+        return get_image_fetcher().get(url, invert_contrast, rgb2gray, output_shape)
 
 @st.cache(persist=True, show_spinner=False)
 def setup_anonymous_usage_tracking():
@@ -862,4 +1188,5 @@ def print_memory_usage():
 
 if __name__ == "__main__":
     setup_anonymous_usage_tracking()
-    main()
+    with perf.rerun():
+        main()
@@ -0,0 +1,96 @@
+"""
+Parameter sweeps: the 1D CTFs of one CTF with one or two of its parameters varied over a range of values
+
+The members of a sweep are evaluated in chunks on a process pool that is shared by all sweeps of the process, and the
+caller is notified as each chunk finishes so that partial results can be shown while the rest are computed.
+It does not depend on Streamlit
+"""
+
+import concurrent.futures, multiprocessing, os, threading
+import numpy as np
+import result_cache
+from ctf_core import CTFSet, CTFMemoryError, ctf1d_axis, ctf_formula, get_memory_budget
+
+# parameters that can be swept and their default ranges. imagesize/over_sample change the s axis and cannot be swept.
+# The 1D CTF does not depend on the astigmatism (dfdiff, dfang), so sweeping it would only show constant maps
+sweep_ranges = dict(defocus=(0.1, 5.0), phaseshift=(0.0, 180.0),
+    bfactor=(0.0, 200.0), alpha=(0.0, 1.0), voltage=(100.0, 300.0), cs=(0.0, 5.0), ampcontrast=(0.0, 20.0),
+    cc=(0.0, 5.0), dE=(0.0, 2.0), dI=(0.0, 2.0), dZ=(0.0, 1000.0), dXY=(0.0, 10.0))
+
+def sweep_ctfset(ctf, sweeps):
+    """The CTFSet of ctf with the parameters in sweeps = [(attr, values), ...] set to all combinations of the values.
+    The last parameter varies fastest, i.e. the results reshape to (len(values1), len(values2), ...)"""
+    attrs = [attr for attr, _ in sweeps]
+    for attr in attrs:
+        if attr not in sweep_ranges: raise ValueError(f"{attr} cannot be swept")
+    grids = np.meshgrid(*[np.asarray(values, dtype=float) for _, values in sweeps], indexing='ij')
+    return CTFSet([ctf], **{attr: grid.ravel() for attr, grid in zip(attrs, grids)})
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+def get_process_pool_workers():
+    return int(os.environ.get("CTF_SWEEP_WORKERS", 0)) or os.cpu_count() or 1
+
+def get_process_pool():
+    # one pool per process, shared by all sessions. Workers are spawned rather than forked from the (multithreaded) server
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=get_process_pool_workers(), mp_context=multiprocessing.get_context("spawn"))
+        return _process_pool
+
+def reset_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is not None: _process_pool.shutdown(wait=False)
+        _process_pool = None
+
+def sweep_chunk(params, apix, abs, plot_s2, imagesize, over_sample):
+    # evaluated in the worker processes: the 1D CTFs of the members described by params (dict of (n,) arrays)
+    s, s2 = ctf1d_axis(apix, imagesize, over_sample, plot_s2)
+    p = {attr: vals.reshape(-1, 1) for attr, vals in params.items()}
+    return ctf_formula(s, s2, abs, p).astype(np.float32)
+
+@result_cache.memoize(ignore=("callback", "parallel"))
+def sweep_ctf1d(ctfset, apix, abs, plot_s2=False, callback=None, parallel=True):
+    """The 1D CTFs of all members of the sweep ctfset as a (n, len(s)) float32 array. Returns (s, s2, curves)
+    callback(done, n, curves) is called after each chunk finishes, with the rows of the unfinished chunks of curves set to nan
+    """
+    imagesize, over_sample = int(ctfset.params["imagesize"][0]), int(ctfset.params["over_sample"][0])
+    if len(ctfset.groups()) > 1: raise ValueError("all members of a sweep must have the same imagesize and over_sample")
+    s, s2 = ctf1d_axis(apix, imagesize, over_sample, plot_s2)
+    n, ns = len(ctfset), len(s)
+    if n*ns*4 > get_memory_budget():
+        raise CTFMemoryError(f"a sweep of {n} CTFs x {ns} frequencies needs {n*ns*4/2**20:.0f} MB, more than the memory budget of {get_memory_budget()/2**20:.0f} MB")
+    curves = np.full((n, ns), np.nan, dtype=np.float32)
+    args = (apix, abs, plot_s2, imagesize, over_sample)
+
+    # chunks of about 1M values, at least 4 chunks per worker for load balancing and frequent progress updates
+    if not parallel or n*ns <= 1<<20:
+        chunk = n
+    else:
+        pool = get_process_pool()
+        chunk = max(1, min((1<<20)//ns, -(-n//(4*get_process_pool_workers()))))
+    chunks = [(c0, min(c0+chunk, n)) for c0 in range(0, n, chunk)]
+    if len(chunks) == 1:
+        curves[:] = sweep_chunk(ctfset.params, *args)
+        if callback: callback(n, n, curves)
+        return s, s2, curves
+
+    futures = {}
+    try:
+        for c0, c1 in chunks:
+            futures[pool.submit(sweep_chunk, {attr: vals[c0:c1] for attr, vals in ctfset.params.items()}, *args)] = (c0, c1)
+        done = 0
+        for future in concurrent.futures.as_completed(futures):
+            c0, c1 = futures[future]
+            curves[c0:c1] = future.result()
+            done += c1-c0
+            if callback: callback(done, n, curves)
+    except concurrent.futures.process.BrokenProcessPool:
+        reset_process_pool()    # e.g. a worker was killed. The next sweep starts a new pool
+        raise
+    finally:
+        for future in futures: future.cancel()
+    return s, s2, curves
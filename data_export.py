@@ -0,0 +1,118 @@
+"""
+Files of the data shown by the web app, generated on request. It does not depend on Streamlit
+
+- curves: one long table of all 1D curves (CTFs, rotational averages, PSFs) and the zeros/peaks, one row per point,
+  as CSV, NumPy .npz (one array per column) or Parquet if pyarrow or fastparquet is installed
+- images: stacks of 2D CTFs or simulated images as .npy or MRC (MRC2014, float32), or .npz if their shapes differ
+"""
+
+import importlib.util, io
+import numpy as np
+
+curve_columns = ["kind", "curve", "feature", "x", "unit", "resolution (Å)", "value"]
+
+mime_types = dict(csv="text/csv", npz="application/octet-stream", parquet="application/octet-stream",
+    npy="application/octet-stream", mrc="application/octet-stream")
+
+def table_formats():
+    formats = ["csv", "npz"]
+    if importlib.util.find_spec("pyarrow") or importlib.util.find_spec("fastparquet"): formats.append("parquet")
+    return formats
+
+def curves_table(curves, landmarks=()):
+    """The columns of the long table of curves [(kind, label, unit, x, s, values), ...] (s: the spatial frequency of each point,
+    None for PSFs) and of the zeros/peaks [(label, unit, landmarks), ...] (landmarks: see ctf_simulation.ctf_landmarks)
+    """
+    parts = []
+    for kind, label, unit, x, s, values in curves:
+        n = len(x)
+        with np.errstate(divide='ignore'):
+            res = 1./np.asarray(s, dtype=np.float64) if s is not None else np.full(n, np.nan)
+        parts.append(dict(kind=[kind]*n, curve=[label]*n, feature=[""]*n, x=x, unit=[unit]*n, res=res, value=values))
+    for label, unit, marks in landmarks:
+        feature, s, values = list(marks["feature"]), np.asarray(marks["s"]), np.asarray(marks["ctf"])
+        if not np.isnan(marks["envelope"]):
+            feature.append("envelope<10%")
+            s = np.append(s, marks["envelope"])
+            values = np.append(values, np.nan)
+        n = len(s)
+        x = s*s if unit == "1/Å^2" else s
+        parts.append(dict(kind=["landmark"]*n, curve=[label]*n, feature=feature, x=x, unit=[unit]*n, res=1./s, value=values))
+    columns = {}
+    for name, key in zip(curve_columns, ("kind", "curve", "feature", "x", "unit", "res", "value")):
+        values = [part[key] for part in parts]
+        if key in ("x", "res", "value"):
+            columns[name] = np.concatenate([np.asarray(v, dtype=np.float64) for v in values]) if values else np.zeros(0)
+        else:
+            columns[name] = np.array(sum((list(v) for v in values), []), dtype=str)
+    return columns
+
+def export_table(df, fmt, arrays=None):
+    """The bytes of the pandas DataFrame df as a csv, npz or parquet file
+    arrays: {name: array} saved in the .npz file instead of the columns of df, e.g. a 2D array of curves
+    """
+    buffer = io.BytesIO()
+    if fmt == "csv":
+        buffer.write(df.to_csv(index=False).encode())
+    elif fmt == "npz":
+        if arrays is None:
+            arrays = {str(name): df[name].to_numpy() for name in df.columns}
+            arrays = {name: a.astype(str) if a.dtype == object else a for name, a in arrays.items()}   # no pickled objects
+        np.savez_compressed(buffer, **arrays)
+    elif fmt == "parquet":
+        df = df.copy()
+        df.columns = [str(name) for name in df.columns]
+        for name in df.columns:
+            if df[name].dtype == object: df[name] = df[name].astype("category")  # repeated labels are stored once
+        df.to_parquet(buffer, index=False)
+    else:
+        raise ValueError(f"unknown table format {fmt}")
+    return buffer.getvalue()
+
+def image_formats(shapes):
+    # the formats of images of these shapes: stacks need images of the same shape
+    return ["mrc", "npy"] if len(set(map(tuple, shapes))) == 1 else ["npz"]
+
+def export_images(images, fmt, voxel_size=1.0, labels=(), names=None):
+    """The bytes of a stack of 2D images as an npy or MRC file, or of the separate images as an npz file (names: their array names)"""
+    buffer = io.BytesIO()
+    if fmt == "npy":
+        np.save(buffer, np.stack(images))
+    elif fmt == "mrc":
+        write_mrc(buffer, np.stack(images), voxel_size, labels)
+    elif fmt == "npz":
+        if names is None: names = [f"image_{i+1}" for i in range(len(images))]
+        np.savez_compressed(buffer, **{name: np.asarray(image) for name, image in zip(names, images)})
+    else:
+        raise ValueError(f"unknown image format {fmt}")
+    return buffer.getvalue()
+
+def write_mrc(fp, data, voxel_size=1.0, labels=()):
+    """Write an image (ny, nx) or a stack of images (nz, ny, nx) as a little-endian MRC2014 file in float32 (mode 2)
+    voxel_size: Å/pixel. labels: up to 10 strings of at most 80 characters
+    """
+    data = np.asarray(data, dtype="<f4")
+    if data.ndim == 2: data = data[None]
+    nz, ny, nx = data.shape
+    header = np.zeros(256, dtype="<i4")
+    floats = header.view("<f4")
+    header[0:3] = nx, ny, nz
+    header[3] = 2                           # mode: 32-bit float
+    header[7:10] = nx, ny, 1                # mx, my, mz: an image stack
+    floats[10:13] = nx*voxel_size, ny*voxel_size, voxel_size
+    floats[13:16] = 90.0
+    header[16:19] = 1, 2, 3                 # columns, rows, sections = x, y, z
+    if data.size:
+        floats[19:22] = data.min(), data.max(), data.mean(dtype=np.float64)
+        floats[54] = data.std(dtype=np.float64)
+    header[22] = 0                          # ispg: image stack
+    header[27] = 20140                      # nversion
+    raw = bytearray(header.tobytes())
+    raw[208:212] = b"MAP "
+    raw[212:216] = bytes([0x44, 0x44, 0, 0])  # little-endian
+    labels = [label[:80] for label in labels][:10]
+    raw[220:224] = np.int32(len(labels)).astype("<i4").tobytes()
+    for i, label in enumerate(labels):
+        raw[224+80*i:224+80*(i+1)] = label.replace("Å", "A").encode("ascii", errors="replace").ljust(80)
+    fp.write(bytes(raw))
+    fp.write(data.tobytes())
@@ -0,0 +1,164 @@
+"""
+Index of the IDs of the released EMDB entries, stored as a sorted integer array
+
+Membership is a binary search and a random choice is O(1), instead of scans of a list of tens of thousands of strings.
+The index is loaded from a local copy, or from the snapshot bundled with the app (emdb_ids.txt, written at build time by
+bin/post_compile on Heroku), or failing both from a few known entries, so a new session never waits for the download of
+the EMDB CSV. A local copy older than max_age is refreshed in a background thread, and the downloaded IDs are merged
+into it, so a truncated download or a failure does not lose the known IDs.
+The source is any URL that urllib can open, e.g. file:// or a local HTTP server for testing. It does not depend on Streamlit
+
+Write the bundled snapshot (e.g. before deploying to a host without a build hook) with:
+    python emdb_index.py --snapshot
+"""
+
+import argparse, os, threading, time, urllib.request
+import numpy as np
+import result_cache
+
+emdb_ids_url = "https://wwwdev.ebi.ac.uk/emdb/api/search/*%20AND%20current_status:%22REL%22?wt=csv&download=true&fl=emdb_id"
+snapshot_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "emdb_ids.txt")   # one ID per line, # for comments
+# well-known released entries, only used if neither a local copy nor the snapshot is available
+fallback_ids = [2660, 2984, 3061, 5778, 5995, 11638, 11668, 21375, 21452]
+
+def parse_emdb_ids(text):
+    # the sorted unique IDs in the EMDB CSV (a header line, then EMD-xxxx per line) or in a list of IDs, one per line
+    ids = []
+    for line in text.splitlines():
+        token = line.split(",")[0].strip().strip('"').upper()
+        if token.startswith("EMD-"): token = token[4:]
+        if token.isdigit(): ids.append(int(token))
+    return np.unique(np.array(ids, dtype=np.int32))
+
+def format_emdb_id(emd_id):
+    # EMDB IDs have at least 4 digits, e.g. 0001 and 11638
+    return f"{int(emd_id):04d}"
+
+def load_ids(path):
+    # a saved index (.npy) or a list of IDs, one per line (.txt)
+    if path.endswith(".txt"):
+        with open(path) as fp:
+            return parse_emdb_ids(fp.read())
+    return np.load(path)
+
+def save_snapshot(path, ids):
+    header = ["# IDs of the released EMDB entries bundled with the app, one per line, used until the local index has been downloaded",
+              f"# (see emdb_index.py). Written by: python emdb_index.py --snapshot, {time.strftime('%Y-%m-%d')}"]
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as fp:
+        fp.write("\n".join(header + [str(i) for i in ids]) + "\n")
+    os.replace(tmp, path)
+
+def save_ids(path, ids):
+    # written to a temporary file first so that readers never see a partial file
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as fp:
+        np.save(fp, np.asarray(ids, dtype=np.int32))
+    os.replace(tmp, path)
+
+class EMDBIndex:
+    def __init__(self, path=None, url=emdb_ids_url, snapshot=snapshot_path, max_age=24*60*60., timeout=30.):
+        if path is None: path = os.path.join(result_cache.default_cache.directory, "emdb_ids.npy")
+        self.path = path
+        self.url = url
+        self.snapshot = snapshot
+        self.max_age = max_age
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.refresh_thread = None
+        self.last_error = None
+        self.fallback = False   # True while the index only has fallback_ids, which a download replaces instead of being merged into
+        self.ids = self.load()
+
+    def load(self):
+        for path in (self.path, self.snapshot):
+            try:
+                ids = load_ids(path)
+                if ids.ndim == 1 and len(ids): return np.unique(ids.astype(np.int32))
+            except (OSError, ValueError):
+                pass
+        self.fallback = True
+        return np.array(fallback_ids, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, emd_id):
+        # emd_id: int or a string like 11638, 0001 or EMD-0001
+        try:
+            emd_id = int(str(emd_id).upper().replace("EMD-", "").replace("EMD_", ""))
+        except ValueError:
+            return False
+        ids = self.ids
+        i = np.searchsorted(ids, emd_id)
+        return bool(i < len(ids) and ids[i] == emd_id)
+
+    def random_id(self, rng=None):
+        # a random ID as a string (e.g. "0001")
+        ids = self.ids
+        i = rng.integers(len(ids)) if rng is not None else np.random.randint(len(ids))
+        return format_emdb_id(ids[i])
+
+    def age(self):
+        # seconds since the local copy was last refreshed, inf if there is none
+        try:
+            return time.time() - os.path.getmtime(self.path)
+        except OSError:
+            return np.inf
+
+    def refresh(self):
+        """Downloads the current IDs and merges them into the index and the local copy. Returns the number of new IDs.
+        Raises OSError if the download fails and ValueError if it contains no IDs"""
+        with urllib.request.urlopen(self.url, timeout=self.timeout) as response:
+            text = response.read().decode("utf-8", errors="replace")
+        downloaded = parse_emdb_ids(text)
+        if not len(downloaded): raise ValueError(f"no EMDB IDs found in {self.url}")
+        with self.lock:
+            ids = self.ids if not self.fallback else np.zeros(0, dtype=np.int32)
+            new = np.setdiff1d(downloaded, ids, assume_unique=True)
+            if len(new): ids = np.union1d(ids, new).astype(np.int32)
+            save_ids(self.path, ids)    # also when nothing is new, to restart the max_age period
+            self.ids = ids
+            self.fallback = False
+        return len(new)
+
+    def refresh_in_background(self, force=False):
+        # starts a refresh if the local copy is older than max_age (or force) and no refresh is running. Does not wait for it
+        with self.lock:
+            if self.refresh_thread is not None and self.refresh_thread.is_alive(): return self.refresh_thread
+            if not force and self.age() < self.max_age: return None
+            def run():
+                try:
+                    self.refresh()
+                    self.last_error = None
+                except (OSError, ValueError) as err:
+                    self.last_error = err
+            self.refresh_thread = threading.Thread(target=run, name="emdb-index-refresh", daemon=True)
+            self.refresh_thread.start()
+            return self.refresh_thread
+
+_emdb_index = None
+_emdb_index_lock = threading.Lock()
+
+def get_emdb_index():
+    # one index per process, shared by all sessions. It is refreshed in the background when it gets old
+    global _emdb_index
+    with _emdb_index_lock:
+        if _emdb_index is None: _emdb_index = EMDBIndex()
+    _emdb_index.refresh_in_background()
+    return _emdb_index
+
+def main():
+    parser = argparse.ArgumentParser(description="download the IDs of the released EMDB entries into the local index")
+    parser.add_argument("--url", default=emdb_ids_url, help="CSV of EMDB IDs (default: the EMDB search API)")
+    parser.add_argument("--path", help="local index file (default: emdb_ids.npy in the result cache directory)")
+    parser.add_argument("--snapshot", action="store_true", help=f"also write the snapshot bundled with the app ({snapshot_path})")
+    args = parser.parse_args()
+    index = EMDBIndex(path=args.path, url=args.url)
+    n_new = index.refresh()
+    if args.snapshot: save_snapshot(snapshot_path, index.ids)
+    print(f"{len(index)} EMDB IDs ({n_new} new) in {index.path}" + (f" and {snapshot_path}" if args.snapshot else ""))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Download and decode the images that the CTF is applied to, without blocking on slow or broken URLs
+
+- timeouts: each socket operation and the whole download have a time limit
+- size limit: downloads larger than max_bytes are aborted
+- connection reuse: HTTP(S) connections are kept alive per thread and host
+- prefetch: images can be fetched in background threads before they are requested (e.g. the next random EMDB entries)
+- cache: a memory-bounded LRU cache of the decoded and normalized grayscale images
+Failures raise ImageFetchError with the reason. It does not depend on Streamlit
+"""
+
+import collections, concurrent.futures, http.client, io, os, socket, threading, time, urllib.parse, urllib.request
+import numpy as np
+
+class ImageFetchError(Exception):
+    pass
+
+class ConnectionPool:
+    # keep-alive HTTP(S) connections, one per thread and host as http.client connections are not thread-safe
+    def __init__(self, timeout=10.):
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def get(self, scheme, netloc):
+        connections = self.local.__dict__.setdefault("connections", {})
+        if (scheme, netloc) not in connections:
+            cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+            connections[(scheme, netloc)] = cls(netloc, timeout=self.timeout)
+        return connections[(scheme, netloc)]
+
+    def discard(self, scheme, netloc):
+        conn = self.local.__dict__.get("connections", {}).pop((scheme, netloc), None)
+        if conn is not None: conn.close()
+
+def read_limited(response, max_bytes, deadline, url):
+    length = response.getheader("Content-Length") if hasattr(response, "getheader") else None
+    if length and length.isdigit() and int(length) > max_bytes:
+        raise ImageFetchError(f"{url} is too large ({int(length)/2**20:.1f} MB > {max_bytes/2**20:.1f} MB)")
+    chunks = []
+    nbytes = 0
+    while True:
+        if time.monotonic() > deadline: raise ImageFetchError(f"{url} timed out")
+        chunk = response.read(1<<16)
+        if not chunk: break
+        chunks.append(chunk)
+        nbytes += len(chunk)
+        if nbytes > max_bytes:
+            raise ImageFetchError(f"{url} is too large (> {max_bytes/2**20:.1f} MB)")
+    return b"".join(chunks)
+
+def decode_image(data, invert_contrast=-1, rgb2gray=True, output_shape=None):
+    # same processing as the original get_image(): resize, set the 5-95 percentile range to [0, 1], and make the background black
+    from skimage.io import imread
+    try:
+        image = imread(io.BytesIO(data), as_gray=rgb2gray)
+    except Exception as err:    # the image plugins raise many different types of errors
+        raise ImageFetchError(f"cannot decode the image: {err}")
+    if image.ndim == 3 and rgb2gray: image = image[0]  # the first frame of an animated gif
+    if output_shape:
+        from skimage.transform import resize
+        image = resize(image, output_shape=output_shape)
+    vmin, vmax = np.percentile(image, (5, 95))
+    image = (image-vmin)/(vmax-vmin) if vmax>vmin else image-vmin   # set to range [0, 1]
+    if invert_contrast<0: # detect if the image contrast should be inverted (i.e. to make background black)
+        edge_vals = np.mean([image[0, :].mean(), image[-1, :].mean(), image[:, 0].mean(), image[:, -1].mean()])
+        invert_contrast = edge_vals>0.5
+    if invert_contrast>0:
+        image = -image + 1
+    return image
+
+class ImageFetcher:
+    def __init__(self, timeout=10., total_timeout=30., max_bytes=20*2**20, max_cache_bytes=256*2**20, max_workers=4, max_redirects=5):
+        self.timeout = timeout
+        self.total_timeout = total_timeout
+        self.max_bytes = max_bytes
+        self.max_cache_bytes = max_cache_bytes
+        self.max_redirects = max_redirects
+        self.pool = ConnectionPool(timeout)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-fetch")
+        self.lock = threading.Lock()
+        self.images = collections.OrderedDict()    # key -> decoded image
+        self.pending = {}    # key -> Future of the images being fetched
+        self.hits = 0
+        self.misses = 0
+
+    def fetch_bytes(self, url):
+        deadline = time.monotonic() + self.total_timeout
+        for _ in range(self.max_redirects+1):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme not in ("http", "https"):   # e.g. ftp:// or file://
+                try:
+                    with urllib.request.urlopen(url, timeout=self.timeout) as response:
+                        return read_limited(response, self.max_bytes, deadline, url)
+                except (OSError, ValueError) as err:
+                    raise ImageFetchError(f"cannot download {url}: {err}")
+            path = parts.path or "/"
+            if parts.query: path += "?" + parts.query
+            for attempt in range(2):   # a kept-alive connection may have been closed by the server: retry once with a new one
+                conn = self.pool.get(parts.scheme, parts.netloc)
+                try:
+                    conn.request("GET", path, headers={"User-Agent": "ctf-simulation", "Accept": "image/*"})
+                    response = conn.getresponse()
+                    if 300 <= response.status < 400 and response.getheader("Location"):
+                        response.read()
+                        url = urllib.parse.urljoin(url, response.getheader("Location"))
+                        break
+                    if response.status != 200:
+                        response.read()
+                        raise ImageFetchError(f"cannot download {url}: HTTP {response.status} {response.reason}")
+                    try:
+                        return read_limited(response, self.max_bytes, deadline, url)
+                    except ImageFetchError:
+                        self.pool.discard(parts.scheme, parts.netloc)  # the rest of the response is not read
+                        raise
+                except (OSError, http.client.HTTPException) as err:
+                    self.pool.discard(parts.scheme, parts.netloc)
+                    # a timeout is not retried. socket.timeout is only an alias of TimeoutError from Python 3.10
+                    if attempt or isinstance(err, (socket.timeout, TimeoutError)) or time.monotonic() > deadline:
+                        raise ImageFetchError(f"cannot download {url}: {str(err) or type(err).__name__}")
+        else:
+            raise ImageFetchError(f"cannot download {url}: too many redirects")
+
+    def load(self, key):
+        url, invert_contrast, rgb2gray, output_shape = key
+        image = decode_image(self.fetch_bytes(url), invert_contrast, rgb2gray, output_shape)
+        image.setflags(write=False)
+        with self.lock:
+            self.images[key] = image
+            nbytes = sum(a.nbytes for a in self.images.values())
+            while nbytes > self.max_cache_bytes and len(self.images)>1:
+                _, a = self.images.popitem(last=False)
+                nbytes -= a.nbytes
+        return image
+
+    def submit(self, key):
+        # the cached image, or a Future of it. Concurrent requests of the same image share one download
+        with self.lock:
+            if key in self.images:
+                self.images.move_to_end(key)
+                self.hits += 1
+                return self.images[key]
+            self.misses += 1
+            future = self.pending.get(key)
+            if future is None:
+                future = self.executor.submit(self.load, key)
+                self.pending[key] = future
+                future.add_done_callback(lambda f: self.pop_pending(key, f))
+            return future
+
+    def pop_pending(self, key, future):
+        with self.lock:
+            if self.pending.get(key) is future: del self.pending[key]
+
+    def get(self, url, invert_contrast=-1, rgb2gray=True, output_shape=None):
+        """The decoded image at url as a read-only float array. Raises ImageFetchError"""
+        key = (url, invert_contrast, rgb2gray, tuple(output_shape) if output_shape else None)
+        result = self.submit(key)
+        if not isinstance(result, concurrent.futures.Future): return result
+        try:
+            return result.result(timeout=self.total_timeout + self.timeout)
+        except concurrent.futures.TimeoutError:
+            raise ImageFetchError(f"{url} timed out")
+
+    def prefetch(self, urls, invert_contrast=-1, rgb2gray=True, output_shape=None):
+        # starts fetching urls in the background. Failures are ignored until the image is requested with get()
+        for url in urls:
+            self.submit((url, invert_contrast, rgb2gray, tuple(output_shape) if output_shape else None))
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, entries=len(self.images), pending=len(self.pending),
+                nbytes=sum(a.nbytes for a in self.images.values()), max_bytes=self.max_cache_bytes)
+
+_image_fetcher = None
+_image_fetcher_lock = threading.Lock()
+
+def get_image_fetcher():
+    # one fetcher per process, shared by all sessions
+    global _image_fetcher
+    with _image_fetcher_lock:
+        if _image_fetcher is None:
+            _image_fetcher = ImageFetcher(timeout=float(os.environ.get("CTF_IMAGE_TIMEOUT", 10)),
+                max_bytes=int(float(os.environ.get("CTF_IMAGE_MAX_MB", 20))*2**20),
+                max_cache_bytes=int(float(os.environ.get("CTF_IMAGE_CACHE_MB", 256))*2**20))
+        return _image_fetcher
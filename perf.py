@@ -0,0 +1,175 @@
+"""
+Timing and memory spans of the stages of the app, e.g.
+    with perf.rerun():              # one rerun of the app script
+        with perf.span("ctf2d", n=3):
+            ...
+Each span records its wall time and the change of the resident memory (RSS) of the process. The spans of the current
+rerun are kept for the performance panel of the app and can be exported as JSON lines. All spans are also aggregated
+per stage for the whole process and exported in the Prometheus text format. A span costs about 10 µs.
+It does not depend on Streamlit
+
+Configuration (environment variables):
+    CTF_PERF_LOG      append the spans of each rerun as JSON lines to this file
+    CTF_METRICS_PORT  serve the aggregated metrics at http://<host>:<port>/metrics
+"""
+
+import contextlib, contextvars, json, os, resource, sys, threading, time
+
+try:
+    _page_size = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+    _page_size = 4096
+
+_statm = None    # (pid, file descriptor of /proc/self/statm), kept open as opening it costs more than reading it
+
+def current_rss():
+    # resident memory of the process in bytes. /proc is much cheaper than psutil; elsewhere the peak RSS is used instead
+    global _statm
+    try:
+        if _statm is None or _statm[0] != os.getpid():
+            _statm = (os.getpid(), os.open("/proc/self/statm", os.O_RDONLY))
+        return int(os.pread(_statm[1], 128, 0).split()[1]) * _page_size
+    except (OSError, ValueError, IndexError, AttributeError):
+        return peak_rss()
+
+def peak_rss():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss*1024     # bytes on macOS, kB on Linux
+
+class Recorder:
+    """The spans of one rerun, in the order they started"""
+    def __init__(self):
+        self.spans = []
+        self.depth = 0
+        self.start = time.time()
+
+    def to_json_lines(self):
+        return "".join(json.dumps(span) + "\n" for span in self.spans)
+
+    def totals(self):
+        # {stage: (count, seconds)} of the finished spans of each stage, not counting a stage nested in itself twice
+        totals = {}
+        stack = []
+        for span in self.spans:
+            del stack[span["depth"]:]
+            if span["name"] not in stack and "seconds" in span:
+                count, seconds = totals.get(span["name"], (0, 0.))
+                totals[span["name"]] = (count+1, seconds+span["seconds"])
+            stack.append(span["name"])
+        return totals
+
+class Metrics:
+    """Process-wide aggregates of the spans of each stage: count, total time and a histogram of the durations"""
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1., 5., 10., float("inf"))
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}    # stage -> dict(count, seconds, max, buckets)
+        self.reruns = 0
+
+    def add(self, name, seconds):
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = dict(count=0, seconds=0., max=0., buckets=[0]*len(self.buckets))
+            stage["count"] += 1
+            stage["seconds"] += seconds
+            stage["max"] = max(stage["max"], seconds)
+            for i, le in enumerate(self.buckets):
+                if seconds <= le: stage["buckets"][i] += 1
+
+    def prometheus_text(self):
+        lines = ["# HELP ctf_stage_seconds Wall time of the stages of the app",
+                 "# TYPE ctf_stage_seconds histogram"]
+        with self.lock:
+            for name, stage in sorted(self.stages.items()):
+                for le, count in zip(self.buckets, stage["buckets"]):
+                    lines.append(f'ctf_stage_seconds_bucket{{stage="{name}",le="{"+Inf" if le == float("inf") else le}"}} {count}')
+                lines.append(f'ctf_stage_seconds_sum{{stage="{name}"}} {stage["seconds"]:.6f}')
+                lines.append(f'ctf_stage_seconds_count{{stage="{name}"}} {stage["count"]}')
+            reruns = self.reruns
+        lines += ["# HELP ctf_reruns_total Number of reruns of the app script", "# TYPE ctf_reruns_total counter",
+            f"ctf_reruns_total {reruns}",
+            "# HELP ctf_process_resident_memory_bytes Resident memory of the process", "# TYPE ctf_process_resident_memory_bytes gauge",
+            f"ctf_process_resident_memory_bytes {current_rss()}",
+            "# HELP ctf_process_peak_resident_memory_bytes Peak resident memory of the process", "# TYPE ctf_process_peak_resident_memory_bytes gauge",
+            f"ctf_process_peak_resident_memory_bytes {peak_rss()}"]
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+_recorder = contextvars.ContextVar("ctf_perf_recorder", default=None)
+
+def current():
+    # the Recorder of the current rerun, or None
+    return _recorder.get()
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """Times the enclosed code as stage name. attrs (e.g. the number of CTFs) are kept with the span of the current rerun"""
+    recorder = _recorder.get()
+    if recorder is not None:    # memory is only sampled for the panel and the log, the aggregates are times only
+        rss0 = current_rss()
+        record = dict(name=name, depth=recorder.depth, start=time.time()-recorder.start, **attrs)
+        recorder.spans.append(record)
+        recorder.depth += 1
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter()-t0
+        if recorder is not None:
+            recorder.depth -= 1
+            rss = current_rss()
+            record.update(seconds=seconds, rss_mb=rss/2**20, rss_delta_mb=(rss-rss0)/2**20)
+        metrics.add(name, seconds)
+
+@contextlib.contextmanager
+def rerun():
+    """Collects the spans of one rerun of the app script. Also starts the metrics server if CTF_METRICS_PORT is set"""
+    port = os.environ.get("CTF_METRICS_PORT")
+    if port: start_metrics_server(int(port))
+    recorder = Recorder()
+    token = _recorder.set(recorder)
+    try:
+        with span("rerun"):
+            yield recorder
+    finally:
+        _recorder.reset(token)
+        with metrics.lock:
+            metrics.reruns += 1
+        log = os.environ.get("CTF_PERF_LOG")
+        if log:
+            try:
+                with open(log, "a") as fp:
+                    fp.write(recorder.to_json_lines())
+            except OSError:
+                pass
+
+_metrics_server = None
+_metrics_server_lock = threading.Lock()
+
+def start_metrics_server(port, host=""):
+    # serves metrics.prometheus_text() at /metrics in a daemon thread. Only one server per process
+    global _metrics_server
+    with _metrics_server_lock:
+        if _metrics_server is not None: return _metrics_server
+        import http.server
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        try:
+            _metrics_server = http.server.ThreadingHTTPServer((host, port), Handler)
+        except OSError:     # e.g. the port is used by another process of the app
+            return None
+        threading.Thread(target=_metrics_server.serve_forever, name="ctf-metrics", daemon=True).start()
+        return _metrics_server
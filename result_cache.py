@@ -0,0 +1,245 @@
+"""
+Bounded, content-addressed on-disk cache of function results. It does not depend on Streamlit
+
+Each result is stored in its own directory named by a hash of the function, the source file that defines it and the call arguments:
+    meta.json   the structure of the result (tuples/lists/dicts/numbers/strings) with the arrays replaced by references to
+    0.npy ...   the arrays, which are memory-mapped read-only when the result is loaded
+Arguments are hashed canonically (numbers by value, arrays by their bytes, objects with get_dict() by their parameters) instead of being pickled.
+Old entries are evicted by age and the least recently used ones by the total size of the cache.
+
+Configuration (environment variables):
+    CTF_CACHE_DIR           cache directory (default: ~/.cache/ctf_simulation)
+    CTF_CACHE_MAX_MB        max total size (default: 1024)
+    CTF_CACHE_MAX_AGE_DAYS  max age of an entry since its last use (default: 7)
+    CTF_CACHE_DISABLE       set to 1 to disable the cache
+"""
+
+import functools, hashlib, inspect, json, os, shutil, threading, time, uuid
+import numpy as np
+
+class ResultCache:
+    def __init__(self, directory=None, max_bytes=None, max_age=None, enabled=None):
+        if directory is None: directory = os.environ.get("CTF_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "ctf_simulation"))
+        if max_bytes is None: max_bytes = int(float(os.environ.get("CTF_CACHE_MAX_MB", 1024))*2**20)
+        if max_age is None: max_age = float(os.environ.get("CTF_CACHE_MAX_AGE_DAYS", 7))*24*3600
+        if enabled is None: enabled = os.environ.get("CTF_CACHE_DISABLE", "0") in ("", "0")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_bytes//4
+        self.max_age = max_age
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._nbytes = None     # estimated total size, updated by writes and evict()
+        self._last_evict = 0
+
+    def memoize(self, func=None, version="", ignore=()):
+        """Decorator that caches the results of func. Calls with arguments that cannot be hashed are not cached
+        ignore: names of the arguments that do not change the result (e.g. progress callbacks) and are left out of the key
+        """
+        if func is None: return functools.partial(self.memoize, version=version, ignore=ignore)
+        signature = inspect.signature(func)
+        namespace = f"{func.__qualname__}/{version}/{source_file_hash(func)}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self.enabled: return func(*args, **kwargs)
+            try:
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                key = self.key(namespace, {k: v for k, v in bound.arguments.items() if k not in ignore})
+            except TypeError:
+                return func(*args, **kwargs)
+            found, value = self.load(key)
+            if found: return value
+            value = func(*args, **kwargs)
+            self.store(key, value)
+            return value
+        wrapper.cache = self
+        return wrapper
+
+    def key(self, namespace, arguments):
+        h = hashlib.sha256(namespace.encode())
+        update_hash(h, arguments)
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def load(self, key):
+        path = self.path(key)
+        try:
+            with open(os.path.join(path, "meta.json")) as fp:
+                meta = json.load(fp)
+            arrays = [load_array(os.path.join(path, f"{i}.npy")) for i in range(meta["n_arrays"])]
+            value = decode(meta["value"], arrays)
+            os.utime(os.path.join(path, "meta.json"))    # mark as recently used
+        except (OSError, ValueError, KeyError):
+            with self.lock: self.misses += 1
+            return False, None
+        with self.lock: self.hits += 1
+        return True, value
+
+    def store(self, key, value):
+        if value is None: return    # e.g. a failed download. Let the next call try again
+        arrays = []
+        try:
+            meta = dict(value=encode(value, arrays), n_arrays=len(arrays))
+        except TypeError:
+            return
+        nbytes = sum(a.nbytes for a in arrays)
+        if nbytes > self.max_entry_bytes: return
+        path = self.path(key)
+        tmp = os.path.join(self.directory, f"tmp-{uuid.uuid4().hex}")
+        try:
+            os.makedirs(tmp)
+            for i, a in enumerate(arrays):
+                np.save(os.path.join(tmp, f"{i}.npy"), a, allow_pickle=False)
+            with open(os.path.join(tmp, "meta.json"), "w") as fp:
+                json.dump(meta, fp)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp, path)
+        except OSError:     # e.g. another process has stored the same result, or the disk is full
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        with self.lock:
+            self.writes += 1
+            if self._nbytes is not None: self._nbytes += nbytes
+            evict = self._nbytes is None or self._nbytes > self.max_bytes or time.time()-self._last_evict > 600
+        if evict: self.evict()
+
+    def entries(self):
+        # (last use time, size in bytes, path) of each entry
+        ret = []
+        if not os.path.isdir(self.directory): return ret
+        for d in os.scandir(self.directory):
+            if not d.is_dir(): continue
+            if d.name.startswith("tmp-"):
+                if time.time() - d.stat().st_mtime > 3600: shutil.rmtree(d.path, ignore_errors=True)  # left over by a crash
+                continue
+            for e in os.scandir(d.path):
+                try:
+                    files = list(os.scandir(e.path))
+                    atime = max(f.stat().st_mtime for f in files if f.name == "meta.json")
+                    ret.append((atime, sum(f.stat().st_size for f in files), e.path))
+                except (OSError, ValueError):
+                    continue
+        return ret
+
+    def evict(self):
+        entries = sorted(self.entries())
+        now = time.time()
+        nbytes = sum(size for _, size, _ in entries)
+        evictions = 0
+        for atime, size, path in entries:
+            if now - atime <= self.max_age and nbytes <= self.max_bytes: break
+            shutil.rmtree(path, ignore_errors=True)
+            nbytes -= size
+            evictions += 1
+        with self.lock:
+            self._nbytes = nbytes
+            self._last_evict = now
+            self.evictions += evictions
+
+    def clear(self):
+        for _, _, path in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
+        with self.lock: self._nbytes = 0
+
+    def stats(self):
+        entries = self.entries()
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, writes=self.writes, evictions=self.evictions,
+                entries=len(entries), nbytes=sum(size for _, size, _ in entries),
+                max_bytes=self.max_bytes, max_age=self.max_age, directory=self.directory, enabled=self.enabled)
+
+def update_hash(h, value):
+    if value is None:
+        h.update(b"N")
+    elif isinstance(value, (bool, int, float, np.number, np.bool_)):
+        value = float(value)
+        h.update(f"n{int(value)}".encode() if value.is_integer() else f"n{value!r}".encode())   # 1 == 1.0 == True
+    elif isinstance(value, str):
+        h.update(b"s%d:" % len(value) + value.encode())
+    elif isinstance(value, bytes):
+        h.update(b"b%d:" % len(value) + value)
+    elif isinstance(value, np.ndarray):
+        if value.dtype.hasobject: raise TypeError("arrays of objects are not supported")
+        h.update(f"a{value.dtype.str}{value.shape}".encode())
+        h.update(hashlib.blake2b(np.ascontiguousarray(value).view(np.uint8).data, digest_size=32).digest() if value.size else b"")
+    elif isinstance(value, (list, tuple)):
+        h.update(b"l%d(" % len(value))
+        for v in value: update_hash(h, v)
+        h.update(b")")
+    elif isinstance(value, dict):
+        h.update(b"d%d{" % len(value))
+        for k in sorted(value, key=str):
+            update_hash(h, str(k))
+            update_hash(h, value[k])
+        h.update(b"}")
+    elif isinstance(value, type) and issubclass(value, np.generic) or isinstance(value, np.dtype):
+        h.update(f"t{np.dtype(value).str}".encode())
+    elif hasattr(value, "get_dict"):    # CTF, CTFSet
+        h.update(f"o{type(value).__name__}".encode())
+        update_hash(h, value.get_dict())
+    elif hasattr(value, "to_numpy") and hasattr(value, "columns"):  # pandas DataFrame
+        update_hash(h, [list(map(str, value.columns)), value.to_numpy()])
+    else:
+        raise TypeError(f"cannot hash {type(value)}")
+
+def encode(value, arrays):
+    # convert value to a json-compatible structure, with the arrays appended to arrays and replaced by their indices
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    elif isinstance(value, (np.number, np.bool_)):
+        return value.item()
+    elif isinstance(value, np.ndarray):
+        if value.dtype.hasobject: raise TypeError("arrays of objects are not supported")
+        for i, a in enumerate(arrays):
+            if a is value: return {"__array__": i}   # store shared arrays (e.g. the s axis of several curves) once
+        arrays.append(value)
+        return {"__array__": len(arrays)-1}
+    elif isinstance(value, tuple):
+        return {"__tuple__": [encode(v, arrays) for v in value]}
+    elif isinstance(value, list):
+        return [encode(v, arrays) for v in value]
+    elif isinstance(value, dict) and all(isinstance(k, str) for k in value):
+        return {"__dict__": {k: encode(v, arrays) for k, v in value.items()}}
+    else:
+        raise TypeError(f"cannot store {type(value)}")
+
+def decode(value, arrays):
+    if isinstance(value, list):
+        return [decode(v, arrays) for v in value]
+    elif isinstance(value, dict):
+        if "__array__" in value: return arrays[value["__array__"]]
+        if "__tuple__" in value: return tuple(decode(v, arrays) for v in value["__tuple__"])
+        return {k: decode(v, arrays) for k, v in value["__dict__"].items()}
+    return value
+
+def load_array(filename):
+    try:
+        return np.load(filename, mmap_mode='r', allow_pickle=False)
+    except ValueError:  # empty arrays cannot be memory-mapped
+        return np.load(filename, allow_pickle=False)
+
+@functools.lru_cache(maxsize=64)
+def _file_hash(filename, mtime):
+    with open(filename, "rb") as fp:
+        return hashlib.sha256(fp.read()).hexdigest()[:16]
+
+def source_file_hash(func):
+    # results are invalidated whenever the file that defines the function changes
+    try:
+        filename = inspect.getsourcefile(func)
+        return _file_hash(filename, os.path.getmtime(filename))
+    except (OSError, TypeError):
+        return ""
+
+default_cache = ResultCache()
+
+def memoize(func=None, version="", ignore=()):
+    return default_cache.memoize(func, version=version, ignore=ignore)
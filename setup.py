@@ -1,5 +1,22 @@
 #!/usr/bin/env python
-import os, pathlib
+import os, pathlib, sys
+
+if len(sys.argv) > 1:
+    # e.g. pip install . : install the Streamlit-free core and the ctf-simulate command line tool
+    from setuptools import setup
+    setup(
+        name="ctfsimu",
+        description="CTF simulation: CTF curves, 2D CTFs and PSFs of cryo-EM images",
+        license="MIT",
+        py_modules=["ctf_core", "ctf_cli", "result_cache"],
+        python_requires=">=3.6",
+        install_requires=["numpy", "scipy"],
+        extras_require={"app": ["streamlit", "bokeh", "scikit_image", "pandas"]},
+        entry_points={"console_scripts": ["ctf-simulate=ctf_cli:main"]},
+    )
+    sys.exit(0)
+
+# without arguments (see Procfile): configure streamlit for the web app
 home = str(pathlib.Path.home())
 
 os.makedirs(home+"/.streamlit", exist_ok=True)
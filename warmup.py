@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+Precompute the results of the first render of the web app for a list of URLs into the shared result cache (result_cache.py),
+so that the first visitors of these views get cache hits instead of waiting for the CTFs to be computed.
+The views are the default page, the default embedded page (?embed=true) and the URL query strings given on the command
+line or in a file (one per line, # for comments). The local EMDB ID index is also refreshed if it is old. It does not need Streamlit
+
+Usage:
+    python warmup.py                                     # the default and the embedded views
+    python warmup.py "defocus=1.5&dfdiff=0.2" "embed=true&preview=1"
+    python warmup.py --file warmup.txt                   # see the Procfile
+
+Only the results memoized with result_cache are precomputed, with the same arguments as the first run of
+ctf_simulation.main() for each view. Keep warm_view() in sync with it.
+"""
+
+import argparse, os, sys, time, urllib.parse
+import numpy as np
+import result_cache
+from ctf_core import CTF, CTFSet, CTFMemoryError, parse_query_parameters
+
+default_views = ["", "embed=true"]
+
+def read_views(filename):
+    with open(filename) as fp:
+        lines = [line.split("#")[0].strip() for line in fp]
+    return [line for line in lines if line]
+
+def parse_view(view):
+    # a query string with or without the URL, e.g. https://host/?embed=true, ?embed=true or embed=true
+    query = urllib.parse.urlsplit(view).query if "?" in view else view
+    return urllib.parse.parse_qs(query, keep_blank_values=True)
+
+def warm_view(query_params):
+    """Computes the memoized results of the first render of the view. Returns the names of the results"""
+    ctfs, plot_settings, embed = parse_query_parameters(query_params)
+    if ctfs is None: ctfs = [CTF()]
+    apix = float(plot_settings.get("apix", 1.0))
+    done = []
+    if embed:
+        ctfs = ctfs[:1]
+        ctfs[0].imagesize = int(plot_settings.get("imagesize", 1024))
+        ctfs[0].over_sample = 1
+        plot_abs, plot_s2, float32 = 0, False, False
+        show_1d, show_2d, show_psf = True, False, False
+        rotavg = False
+    else:
+        options = ('CTF', '|CTF|', 'CTF^2')
+        plot_abs = options.index(plot_settings.get("ctf_type", 'CTF'))
+        show_1d = bool(int(plot_settings.get("show_1d", 1)))
+        show_2d = bool(int(plot_settings.get("show_2d", 1))) or not show_1d
+        show_psf = bool(int(plot_settings.get("show_psf", 1))) and show_1d
+        plot_s2 = bool(int(plot_settings.get("plot_s2", 0))) and show_1d
+        float32 = bool(int(plot_settings.get("float32", 0)))
+        rotavg = len(ctfs)==1 and ctfs[0].dfdiff and plot_abs==2   # the default of 'plot rotational average'
+    n = len(ctfs)
+
+    if show_1d:
+        if n==1 and ctfs[0].dfdiff:
+            ctf = ctfs[0]
+            CTFSet(ctfs*3).ctf1d(apix, plot_abs, plot_s2, defocus_override=[ctf.defocus - ctf.dfdiff, ctf.defocus, ctf.defocus + ctf.dfdiff])
+        else:
+            CTFSet(ctfs).ctf1d(apix, plot_abs, plot_s2)
+        done.append("ctf1d")
+        if rotavg:
+            ctfs[0].ctf1d_rotavg(apix, plot_abs, plot_s2)
+            done.append("rotavg")
+    if show_psf:
+        CTFSet(ctfs).psf1d(apix, abs=plot_abs)
+        done.append("psf1d")
+    if show_2d:
+        for dtype in [np.float32] if float32 else [np.float64, np.float32]:
+            try:
+                CTFSet(ctfs).ctf2d(apix, plot_abs, plot_s2, dtype=dtype)
+                CTFSet(ctfs).ctf2d(apix, abs=plot_abs, plot_s2=False, dtype=dtype, layout="rfft")   # for the simulated images
+                done += ["ctf2d", "ctf2d (rfft)"]
+                break
+            except CTFMemoryError:
+                continue
+    return done
+
+def warm_emdb_index():
+    from emdb_index import get_emdb_index
+    index = get_emdb_index()    # starts a refresh if the local copy is older than a day
+    if index.refresh_thread is not None: index.refresh_thread.join()
+    return index
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="precompute the first render of the web app for a list of views into the result cache",
+        epilog="\n".join(__doc__.strip().split("\n")[4:]), formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("views", nargs="*", help="URL query strings of the views, e.g. \"defocus=1.5&dfdiff=0.2\"")
+    parser.add_argument("-f", "--file", action="append", default=[], help="file of views, one per line. Can be repeated. Missing files are ignored")
+    parser.add_argument("--no-defaults", action="store_true", help=f"do not precompute the default views ({', '.join(repr(v) for v in default_views)})")
+    parser.add_argument("--no-emdb", action="store_true", help="do not refresh the EMDB ID index")
+    args = parser.parse_args(argv)
+
+    if not result_cache.default_cache.enabled:
+        print("warmup: the result cache is disabled (CTF_CACHE_DISABLE), nothing to do", file=sys.stderr)
+        return
+    views = [] if args.no_defaults else list(default_views)
+    for filename in args.file:
+        if os.path.exists(filename): views += read_views(filename)
+    views += args.views
+    views = list(dict.fromkeys(views))  # unique, in order
+
+    t0 = time.perf_counter()
+    for view in views:
+        label = f"?{view}" if view else "the default view"
+        t = time.perf_counter()
+        try:
+            done = warm_view(parse_view(view))
+        except (ValueError, MemoryError) as err:
+            print(f"warmup: {label}: {err}", file=sys.stderr)
+            continue
+        print(f"warmup: {label}: {', '.join(done) or 'nothing to compute'} in {time.perf_counter()-t:.2f} s", file=sys.stderr)
+    if not args.no_emdb:
+        index = warm_emdb_index()
+        status = f" ({index.last_error})" if index.last_error else ""
+        print(f"warmup: {len(index)} EMDB IDs{status}", file=sys.stderr)
+    stats = result_cache.default_cache.stats()
+    print(f"warmup: {len(views)} views in {time.perf_counter()-t0:.2f} s. Result cache: {stats['entries']} entries, {stats['nbytes']/2**20:.0f} MB in {stats['directory']}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()